@@ -0,0 +1,104 @@
+from typing import Any, Callable, List, Optional
+import json
+import os
+import platform
+import resource
+import time
+import numpy as np
+
+Result = dict[str, Any]
+
+
+def peak_rss_mb() -> float:
+    # プロセスが起動してからの最大値。Linux では KB 単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(
+        fn: Callable[[], Any],
+        repeat: int,
+        warmup: int = 1) -> Result:
+    for _ in range(warmup):
+        fn()
+    times: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    t = np.array(times)
+    return {
+        "n": repeat,
+        "mean": float(t.mean()),
+        "p50": float(np.percentile(t, 50)),
+        "p95": float(np.percentile(t, 95)),
+        "p99": float(np.percentile(t, 99)),
+        "throughput": float(repeat / t.sum()),
+    }
+
+
+def environment() -> dict[str, Any]:
+    import cv2
+    import torch
+
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save(path: str, results: dict[str, Result]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "results": results},
+                  f, indent=2, sort_keys=True)
+
+
+def load(path: str) -> dict[str, Result]:
+    with open(path) as f:
+        results: dict[str, Result] = json.load(f)["results"]
+        return results
+
+
+def compare(
+        results: dict[str, Result],
+        baseline: dict[str, Result],
+        tolerance: float) -> List[str]:
+    # p50 が baseline より tolerance 以上遅くなったものを返す
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if r["p50"] > base["p50"] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def report(
+        results: dict[str, Result],
+        baseline: Optional[dict[str, Result]] = None) -> str:
+    lines = [f"{'name':<44} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+             f" {'ops/s':>9} {'rss MB':>8} {'vs base':>8}"]
+    cumulative = False
+    for name, r in results.items():
+        ratio = ""
+        if baseline and name in baseline:
+            ratio = f"{r['p50'] / baseline[name]['p50']:.2f}x"
+        # 同じプロセスで続けて計測した場合は、それまでの全体の最大値
+        if "peak_rss_mb" in r:
+            rss = f"{r['peak_rss_mb']:.0f}"
+        else:
+            rss = f"{r['cumulative_peak_rss_mb']:.0f}*"
+            cumulative = True
+        lines.append(
+            f"{name:<44} {r['p50'] * 1000:>9.2f} {r['p95'] * 1000:>9.2f}"
+            f" {r['p99'] * 1000:>9.2f} {r['throughput']:>9.1f}"
+            f" {rss:>8} {ratio:>8}")
+    if cumulative:
+        lines.append("* peak RSS of the run up to this benchmark"
+                     " (use --isolate for each benchmark's own)")
+    return "\n".join(lines)
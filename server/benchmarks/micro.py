@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Tuple
+import numpy as np
+import torch
+from src.card_detection import IMAGE_SIZE, YOLO_FILE, resize_square
+from src.models import Darknet, export_inference_model
+from src.parse_config import parse_model_config
+from src.utils import build_targets, non_max_suppression
+
+Benchmark = Tuple[str, Callable[[], Any]]
+
+
+def random_quads(n: int, size: float) -> torch.Tensor:
+    center = torch.rand(n, 1, 2) * size
+    return (center + (torch.rand(n, 4, 2) - 0.5) * size / 8).reshape(n, 8)
+
+
+@contextmanager
+def benchmarks() -> Iterator[List[Benchmark]]:
+    # 乱数の重みでも速度は変わらないので、学習済みの重みは読まない
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    result: List[Benchmark] = []
+
+    for h, w in ((480, 640), (960, 1280), (1944, 2592)):
+        img = rng.integers(0, 255, (h, w, 3), dtype=np.uint8)
+        result.append((f"micro/resize_square/{w}x{h}",
+                       lambda img=img: resize_square(img, IMAGE_SIZE)))
+
+    result.append(("micro/parse_model_config",
+                   lambda: parse_model_config(YOLO_FILE)))
+
+    model = Darknet(YOLO_FILE, IMAGE_SIZE).eval()
+    x = torch.rand(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+
+    def forward(m: Any) -> Any:
+        with torch.no_grad():
+            return m(x)
+
+    result.append(("micro/darknet_forward", lambda: forward(model)))
+    traced = export_inference_model(Darknet(YOLO_FILE, IMAGE_SIZE).eval())
+    result.append(("micro/darknet_forward_jit", lambda: forward(traced)))
+
+    for n in (100, 1000):
+        pred = torch.zeros(1, n, 13)
+        pred[0, :, :8] = random_quads(n, IMAGE_SIZE)
+        pred[0, :, 8] = torch.rand(n)
+        pred[0, :, 9:] = torch.randn(n, 4)
+        result.append((f"micro/non_max_suppression/{n}",
+                       lambda pred=pred: non_max_suppression(pred, 0.1, 0.2)))
+
+    nB, nA, nC, nG = 8, 3, 4, 19
+    anchors = torch.tensor([[3.6, 2.4], [4.1, 6.5], [10.2, 7.3]])
+    target = [torch.cat([torch.randint(0, nC, (5, 1)).float(),
+                         random_quads(5, 1.0).clamp(0, 1)], 1)
+              for _ in range(nB)]
+    pred_boxes = torch.rand(nB, nA, nG, nG, 8) * nG
+    pred_conf = torch.rand(nB, nA, nG, nG)
+    pred_cls = torch.rand(nB, nA, nG, nG, nC)
+    result.append(("micro/build_targets", lambda: build_targets(
+        pred_boxes, pred_conf, pred_cls, target, anchors, nA, nC, nG, True)))
+    yield result
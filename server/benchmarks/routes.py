@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Tuple
+from uuid import uuid4
+import glob
+import io
+import os
+import shutil
+import tempfile
+import cv2
+import numpy as np
+
+Benchmark = Tuple[str, Callable[[], Any]]
+
+IMG_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "tests", "img")
+
+FILTERS = [
+    "grayscale", "threshold", "blur", "bitwise_not", "contours",
+    "face_detection", "ocr", "card_detection",
+]
+
+
+def synthetic_image(width: int, height: int) -> np.ndarray:
+    # 輪郭抽出や OCR に引っかかるよう、四角と文字を描いておく
+    rng = np.random.default_rng(width)
+    img = rng.integers(100, 160, (height, width, 3), dtype=np.uint8)
+    s = width // 8
+    for i in range(3):
+        x, y = s + i * 2 * s, height // 4
+        cv2.rectangle(img, (x, y), (x + s, y + s * 3 // 2),
+                      (240, 240, 240), -1)
+        cv2.putText(img, "CARD", (x, y + s), cv2.FONT_HERSHEY_SIMPLEX,
+                    s / 100, (0, 0, 0), max(1, s // 40))
+    return img
+
+
+def images() -> List[Tuple[str, np.ndarray]]:
+    result = []
+    for path in sorted(glob.glob(os.path.join(IMG_DIR, "*"))):
+        img = cv2.imread(path)
+        if img is not None:
+            result.append((os.path.basename(path), img))
+    for w, h in ((640, 480), (1280, 960), (2592, 1944)):
+        result.append((f"synthetic_{w}x{h}", synthetic_image(w, h)))
+    return result
+
+
+@contextmanager
+def benchmarks() -> Iterator[List[Benchmark]]:
+    tmp = tempfile.mkdtemp(prefix="bench")
+    os.environ.setdefault("TASK_INDEX_PATH", os.path.join(tmp, "index"))
+    os.environ.setdefault("METRICS_DIR", os.path.join(tmp, "metrics"))
+    from src import app as app_module
+    from src.app import TASK_DIR, app, image_path
+
+    # 同じリクエストを繰り返すので、結果の使い回しは切っておく
+    app_module.DEDUP_ENABLED = False
+
+    client = app.test_client()
+    task_ids = []
+
+    def post(url: str, **kwargs: Any) -> Any:
+        res = client.post(url, **kwargs)
+        assert res.status_code == 200, res.get_json()
+        return res.get_json()
+
+    def upload(body: bytes) -> None:
+        data = post("/upload_image",
+                    data={"uploadFile": (io.BytesIO(body), "a.jpg")})
+        task_ids.append(data["result"]["image"]["task_id"])
+
+    def run_filter(name: str, source: dict[str, str]) -> Callable[[], Any]:
+        return lambda: post(f"/{name}", json=source)
+
+    def run_pipeline(source: dict[str, str]) -> Callable[[], Any]:
+        return lambda: post("/pipeline", json={**source, "operations": [
+            {"name": "grayscale"},
+            {"name": "threshold"},
+            {"name": "bitwise_not"},
+        ]})
+
+    result: List[Benchmark] = []
+    for name, img in images():
+        body = cv2.imencode(".jpg", img)[1].tobytes()
+        if len(body) < app.config["MAX_CONTENT_LENGTH"]:
+            result.append((f"route/upload_image/{name}",
+                           lambda body=body: upload(body)))
+
+        # 1MB を超える画像もあるので、アップロードせずに直接置く
+        task_id = str(uuid4())
+        task_ids.append(task_id)
+        os.makedirs(os.path.join(TASK_DIR, task_id))
+        cv2.imwrite(image_path(task_id, "source"), img)
+        source = {"task_id": task_id, "id": "source"}
+
+        for f in FILTERS:
+            result.append((f"route/{f}/{name}", run_filter(f, source)))
+        result.append((f"route/pipeline/{name}", run_pipeline(source)))
+
+    try:
+        yield result
+    finally:
+        for task_id in task_ids:
+            shutil.rmtree(os.path.join(TASK_DIR, task_id),
+                          ignore_errors=True)
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,78 @@
+from typing import Any
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from benchmarks import bench, micro, routes
+
+
+def run_isolated(suite: Any, name: str, repeat: int) -> bench.Result:
+    # 新しいプロセスで1つだけ計測し、そのベンチマークだけのピーク RSS を取る
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "result.json")
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.run",
+             "--suite", suite.__name__.rsplit(".", 1)[-1],
+             "--only", name, "--repeat", str(repeat), "--output", output],
+            check=True, stdout=subprocess.DEVNULL)
+        return bench.load(output)[name]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="エンドポイントとモデル周りの処理時間を計測する")
+    parser.add_argument("--suite", choices=["all", "micro", "routes"],
+                        default="all")
+    parser.add_argument("-k", "--filter", default="",
+                        help="名前にこの文字列を含むものだけ計測する")
+    parser.add_argument("--only", help=argparse.SUPPRESS)
+    parser.add_argument("--isolate", action="store_true",
+                        help="ベンチマークごとに別のプロセスで計測する")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", default="benchmarks/results.json")
+    parser.add_argument("--baseline",
+                        help="この結果と比べて遅くなっていたら失敗にする")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="p50 がこの割合以上遅くなったら失敗")
+    args = parser.parse_args()
+
+    suites = []
+    if args.suite in ("all", "micro"):
+        suites.append(micro)
+    if args.suite in ("all", "routes"):
+        suites.append(routes)
+
+    baseline = bench.load(args.baseline) if args.baseline else None
+    results = {}
+    for suite in suites:
+        with suite.benchmarks() as benchmarks:
+            for name, fn in benchmarks:
+                if args.filter not in name:
+                    continue
+                if args.only is not None and name != args.only:
+                    continue
+                if args.isolate:
+                    results[name] = run_isolated(suite, name, args.repeat)
+                else:
+                    results[name] = bench.measure(fn, args.repeat)
+                    # ru_maxrss はプロセス全体の最大値なので、1つだけ計測した
+                    # 場合以外は、それまでのベンチマークの分も含む
+                    key = "peak_rss_mb" if args.only else \
+                        "cumulative_peak_rss_mb"
+                    results[name][key] = bench.peak_rss_mb()
+                print(f"{name}: {results[name]['p50'] * 1000:.2f} ms",
+                      file=sys.stderr)
+
+    bench.save(args.output, results)
+    print(bench.report(results, baseline))
+    if baseline is None:
+        return 0
+    regressions = bench.compare(results, baseline, args.tolerance)
+    for name in regressions:
+        print(f"REGRESSION: {name}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+import gc
+import multiprocessing
+import os
+import shutil
+
+bind = "0.0.0.0:5000"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+
+# master でモデル (YOLO, EasyOCR) を読み込んでから fork する。
+# 重みのページは copy-on-write で全 worker から共有される。
+preload_app = os.environ.get("PRELOAD_MODELS", "1") == "1"
+
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR",
+    os.path.join(os.path.dirname(__file__), "data", "metrics"))
+
+
+def on_starting(server):  # type: ignore
+    # 前回起動時の worker のヒストグラムを /metrics に混ぜない
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+
+def pre_fork(server, worker):  # type: ignore
+    # 読み込み済みのオブジェクトを GC の対象から外し、
+    # fork 後の GC で共有ページが書き換えられ (コピーされ) ないようにする
+    gc.freeze()
+
+
+def post_fork(server, worker):  # type: ignore
+    import torch
+
+    # worker 同士で CPU を取り合わないよう、推論スレッド数を分け合う
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // workers))
+
+
+def post_worker_init(worker):  # type: ignore
+    from src.app import executor, job_queue
+
+    # process で動かす action があれば、最初のリクエストの前にプールを起動する
+    executor.warm()
+    # 終了した worker が受け付けたまま残ったジョブを failed にする
+    job_queue.fail_orphans()
@@ -1,18 +1,45 @@
-from flask import Flask, request, jsonify
+from contextlib import contextmanager
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
-from typing import Any, Tuple, Callable, Optional, List
-from uuid import uuid4
+from threading import get_ident
+from typing import Any, Tuple, Callable, Iterator, Optional, List
+from uuid import UUID, uuid4
 import os
 import cv2
 import numpy as np
 import easyocr
 import math
 import itertools
-from src.card_detection import detect as card_detect, init_model
+import time
+from src import storage
+from src.card_detection import detect as card_detect
+from src.card_detection import ensure_model, init_model
+from src.crops import (Crop, CropPool, apply_crop, quad_crop, read_spec,
+                       rect_crop, write_spec)
+from src.contours import (MAX_AREA, MIN_AREA, filter_contours, find_contours,
+                          find_quads, refine_contours)
+from src.dedup import content_hash, file_hash, result_key
+from src.faces import detect_faces, refine_faces
+from src.executor import (EXEC_ROUTES, ActionExecutor, in_action_worker,
+                          parse_routes)
+from src.image_cache import ImageCache, as_bgr, as_gray
+from src.task_index import TASK_INDEX_PATH, QuotaExceeded, TaskIndex
+from src.job.gc_daemon import (GC_LOCK_PATH, GC_METRICS_PATH, GarbageCollector,
+                               GCDaemon, SharedLatencyMonitor, read_metrics)
+from src.metrics import (MetricsStore, Sampler, begin_request, observe,
+                         request_timings, server_timing, stage, write_profile)
+from src.jobs import JOB_CONCURRENCY, JobQueue, is_callback_url
+from src.ocr import OCR_MAX_SIZE, TextReader, parse_regions
+from src.pyramid import choose_level, pyramid_level
+from src.storage import IMAGE_FORMAT
+from src.upload import (append_stream, is_jpeg, read_head, save_stream,
+                        upload_buffer)
 from src.utils import plot_one_box
 
 
-init_model()
+# action を実行する子プロセスでは、使う action のモデルだけを後で読み込む
+if not in_action_worker():
+    init_model()
 
 app = Flask(__name__, static_folder='../static')
 CORS(app)
@@ -25,20 +52,303 @@ TASK_DIR = os.path.join(
     ),
     "static", "task")
 
+# デコード済み画像のキャッシュ (プロセス単位)。
+# action の子プロセスで入れたものは呼び出し元から使えないので、子プロセスでは持たない
+IMAGE_CACHE_BYTES = int(os.environ.get(
+    "IMAGE_CACHE_BYTES", 256 * 1024 * 1024))  # 256MB
+image_cache = ImageCache(0 if in_action_worker() else IMAGE_CACHE_BYTES)
+crop_pool = CropPool()
+
+# 分割アップロードの上限と、JPEG をそのまま保存するかどうか
+MAX_UPLOAD_BYTES = int(os.environ.get(
+    "MAX_UPLOAD_BYTES", 32 * 1024 * 1024))  # 32MB
+UPLOAD_PASSTHROUGH = os.environ.get("UPLOAD_PASSTHROUGH", "1") == "1"
+
+# タスクごとの保存容量の上限 (0 なら無制限)
+TASK_MAX_BYTES = int(os.environ.get("TASK_MAX_BYTES", 0))
+task_index = TaskIndex(TASK_INDEX_PATH)
+# 同じ画像への同じ処理は結果を使い回す
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "1") == "1"
+
+# 処理時間の計測。ヒストグラムは worker ごとにファイルに書き出して合算する
+DATA_DIR = os.path.join(os.path.dirname(SRC_DIR), "data")
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(DATA_DIR, "metrics"))
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+# これより遅いリクエストのスタックを data/profiles に書き出す (0 なら無効)
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0))
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+metrics_store = MetricsStore(METRICS_DIR)
+sampler = Sampler()
+
+# 期限切れのタスクをアプリの中で少しずつ消す
+GC_ENABLED = os.environ.get("GC_ENABLED", "0") == "1"
+# GC はリクエストが遅くなっている間は削除を控える。
+# 処理時間は全 worker が書き出したヒストグラムから読む
+latency_monitor = SharedLatencyMonitor(METRICS_DIR)
+gc_daemon = GCDaemon(
+    GarbageCollector(task_index, TASK_DIR, GC_METRICS_PATH, latency_monitor),
+    GC_LOCK_PATH)
+
+
+def image_path(task_id: str, id: str, fmt: str = "jpg") -> str:
+    return os.path.join(TASK_DIR, task_id, f"{id}.{fmt}")
+
+
+def stored_path(task_id: str, id: str) -> Optional[str]:
+    # 保存した形式に関わらず、画像のファイルを探す
+    return storage.find(os.path.join(TASK_DIR, task_id, id))
+
+
+def cache_image(task_id: str, id: str, img: np.ndarray) -> None:
+    # 切り出し画像は元画像への view なので、元画像ごと保持しないようコピーする
+    if img.base is not None:
+        img = img.copy()
+    image_cache.put((task_id, id), img)
+
+
+def load_image(task_id: str, id: str) -> Optional[np.ndarray]:
+    img = image_cache.get((task_id, id))
+    if img is not None:
+        return img
+    path = stored_path(task_id, id)
+    if path is None:
+        # 遅延生成の画像なら、ここで作る
+        return materialize_image(task_id, id)
+    img = storage.read(path)
+    if img is not None:
+        image_cache.put((task_id, id), img)
+    return img
+
+
+def image_exists(task_id: str, id: str) -> bool:
+    return stored_path(task_id, id) is not None or \
+        os.path.exists(spec_path(task_id, id))
+
+
+def encode_image(img: np.ndarray, fmt: str = "jpg") -> np.ndarray:
+    return storage.encode(img, fmt)
+
+
+def write_image(
+        task_id: str,
+        id: str,
+        buf: np.ndarray,
+        img: np.ndarray,
+        fmt: str = "jpg") -> None:
+    path = image_path(task_id, id, fmt)
+    # 同じ画像を同時に書いた場合に、書きかけのファイルを読ませない
+    tmp = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    buf.tofile(tmp)
+    os.replace(tmp, path)
+    if DEDUP_ENABLED:
+        record_image_hash(task_id, id, content_hash(buf), fmt)
+    cache_image(task_id, id, img)
+
+
+@contextmanager
+def reserve_quota(task_id: str, nbytes: int, files: int) -> Iterator[None]:
+    # 書き込む前に容量を確保し、書き込めなかったら戻す
+    task_index.reserve(task_id, nbytes, files, TASK_MAX_BYTES)
+    try:
+        yield
+    except BaseException:
+        task_index.touch(task_id, -nbytes, -files)
+        raise
+
+
+def save_image(task_id: str, img: np.ndarray, fmt: str = "jpg") -> str:
+    id = str(uuid4())
+    buf = encode_image(img, fmt)
+    with reserve_quota(task_id, buf.nbytes, 1):
+        write_image(task_id, id, buf, img, fmt)
+    return id
+
 
-def image_path(task_id: str, id: str) -> str:
-    return os.path.join(TASK_DIR, task_id, f"{id}.jpg")
+def spec_path(task_id: str, id: str) -> str:
+    # 遅延生成する画像の作り方
+    return os.path.join(TASK_DIR, task_id, f"{id}.json")
+
+
+def save_crops(
+        data: dict[str, Any],
+        img: np.ndarray,
+        crops: List[Crop]) -> List[str]:
+    task_id = data.get("task_id", "")
+    source_id = data.get("id")
+    ids = [str(uuid4()) for _ in crops]
+    if data.get("lazy_crops") and source_id and \
+            stored_path(task_id, source_id) is not None:
+        # 取りに来るまで切り出さず、切り出し方だけ保存しておく
+        # 形式はすぐに切り出す場合と同じ jpg
+        for id, crop in zip(ids, crops):
+            write_spec(spec_path(task_id, id),
+                       {"source": source_id, "crop": crop, "format": "jpg"})
+        return ids
+
+    def encode_crop(crop: Crop) -> Tuple[np.ndarray, np.ndarray]:
+        out = apply_crop(img, crop)
+        return out, encode_image(out)
+
+    with stage("crop_write"):
+        encoded = crop_pool.map(encode_crop, crops)
+        nbytes = sum(buf.nbytes for _, buf in encoded)
+        with reserve_quota(task_id, nbytes, len(ids)):
+            for id, (out, buf) in zip(ids, encoded):
+                write_image(task_id, id, buf, out)
+    return ids
+
+
+def materialize_image(task_id: str, id: str) -> Optional[np.ndarray]:
+    spec = read_spec(spec_path(task_id, id))
+    if spec is None:
+        return None
+    src = load_image(task_id, spec["source"])
+    if src is None:
+        return None
+    with stage("render"):
+        if "crop" in spec:
+            img = apply_crop(src, spec["crop"])
+        else:
+            img = OVERLAYS[spec["overlay"]](src, spec["params"])
+        # 形式を持たない古い spec は jpg
+        fmt = spec.get("format", "jpg")
+        buf = encode_image(img, fmt)
+        with reserve_quota(task_id, buf.nbytes, 1):
+            write_image(task_id, id, buf, img, fmt)
+    return img
+
+
+def crop_url(data: dict[str, Any], id: str) -> dict[str, Any]:
+    if not data.get("lazy_crops"):
+        return {}
+    return {"url": f"/crops/{data.get('task_id', '')}/{id}"}
+
+
+def record_image_hash(
+        task_id: str,
+        id: str,
+        sha256: str,
+        fmt: str = "jpg") -> None:
+    st = os.stat(image_path(task_id, id, fmt))
+    task_index.set_image_hash(task_id, id, sha256, st.st_size, st.st_mtime_ns)
+
+
+def source_hash(task_id: str, id: str) -> Optional[str]:
+    path = stored_path(task_id, id)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    sha256 = task_index.image_hash(task_id, id, st.st_size, st.st_mtime_ns)
+    if sha256 is None:
+        sha256 = file_hash(path)
+        task_index.set_image_hash(
+            task_id, id, sha256, st.st_size, st.st_mtime_ns)
+    return sha256
+
+
+def store_upload(
+        task_id: str,
+        save_path: str,
+        sha256: str,
+        write: Callable[[], Any]) -> None:
+    # 同じ内容のアップロードは既存のファイルへのハードリンクにする。
+    # ディスクは増えないので、リンクした分は容量に数えない
+    path = task_index.find_blob(sha256) if DEDUP_ENABLED else None
+    if path is not None:
+        try:
+            os.link(path, save_path)
+            task_index.touch(task_id, 0, 1)
+            return
+        except OSError:
+            pass
+    write()
+    try:
+        task_index.reserve(
+            task_id, os.path.getsize(save_path), 1, TASK_MAX_BYTES)
+    except QuotaExceeded:
+        os.remove(save_path)
+        # 残ったディレクトリも GC で消えるよう、索引に載せる
+        task_index.touch(task_id)
+        raise
+    if DEDUP_ENABLED:
+        task_index.set_blob(sha256, task_id, save_path)
 
 
 def error_res(message: str) -> Tuple[Any, int]:
     return jsonify({"error": message}), 400
 
 
+@app.errorhandler(QuotaExceeded)
+def quota_exceeded(e: QuotaExceeded) -> Tuple[Any, int]:
+    return error_res(str(e))
+
+
+@app.before_request
+def before_request() -> None:
+    g.start_time = time.perf_counter()
+    g.endpoint = request.url_rule.rule if request.url_rule else "unknown"
+    begin_request(g.endpoint)
+    if PROFILE_SLOW_MS > 0:
+        sampler.start()
+    if GC_ENABLED:
+        gc_daemon.ensure_started()
+
+
+@app.after_request
+def after_request(res: Any) -> Any:
+    elapsed = time.perf_counter() - g.start_time
+    observe("total", elapsed)
+    metrics_store.dump()
+    if SERVER_TIMING:
+        res.headers["Server-Timing"] = server_timing(request_timings())
+    return res
+
+
+@app.teardown_request
+def teardown_request(e: Optional[BaseException]) -> None:
+    if PROFILE_SLOW_MS <= 0 or "start_time" not in g:
+        return
+    stacks = sampler.stop()
+    elapsed = time.perf_counter() - g.start_time
+    if elapsed * 1000 > PROFILE_SLOW_MS and stacks:
+        write_profile(PROFILE_DIR, g.endpoint, stacks)
+
+
+@app.route("/metrics")
+def metrics() -> Any:
+    return Response(metrics_store.render(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/gc/metrics")
+def gc_metrics() -> Any:
+    return jsonify({"result": read_metrics(GC_METRICS_PATH)})
+
+
 @app.route("/")
 def hello() -> str:
     return "Hello, World!"
 
 
+@app.route("/crops/<task_id>/<id>")
+@app.route("/render/<task_id>/<id>")
+def render_image(task_id: str, id: str) -> Any:
+    if not is_uuid(id):
+        return error_res("invalid image id")
+    # 作った画像はファイルとして残し、次からはそのまま返す
+    path = stored_path(task_id, id)
+    if path is None and materialize_image(task_id, id) is not None:
+        path = stored_path(task_id, id)
+    if path is None:
+        return error_res("filename not exists")
+    fmt = os.path.splitext(path)[1][1:]
+    return send_file(path, mimetype=storage.MIME_TYPES[fmt])
+
+
 @app.route("/upload_image", methods=["POST"])
 def upload_image() -> Any:
     # <input type="file" name="uploadFile"
@@ -52,13 +362,34 @@ def upload_image() -> Any:
     task_id = str(uuid4())
     id = str(uuid4())
     save_path = image_path(task_id, id)
+    buf = upload_buffer(file.stream)
+    # 空のデータは imdecode が例外を投げるので、先に弾く
+    if buf.size == 0:
+        return error_res("invalid image")
+    sha256 = content_hash(buf)
+    if UPLOAD_PASSTHROUGH and is_jpeg(bytes(buf[:3])):
+        # JPEG はデコードせずにそのまま保存する
+        os.makedirs(os.path.dirname(save_path))
+        with stage("write"):
+            store_upload(task_id, save_path, sha256,
+                         lambda: save_stream(file.stream, save_path))
+        if DEDUP_ENABLED:
+            record_image_hash(task_id, id, sha256)
+        return upload_res(task_id, id)
+
+    with stage("decode"):
+        img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return error_res("invalid image")
     os.makedirs(os.path.dirname(save_path))
-    # file.save(save_path)
-    img = cv2.imdecode(np.fromstring(
-        file.read(), np.uint8), cv2.IMREAD_UNCHANGED)
-    # TODO 配列が空だったらエラーにする
-    cv2.imwrite(save_path, img)
+    with stage("write"):
+        store_upload(task_id, save_path, sha256,
+                     lambda: cv2.imwrite(save_path, img))
+    cache_image(task_id, id, img)
+    return upload_res(task_id, id)
+
 
+def upload_res(task_id: str, id: str) -> Any:
     return jsonify({
         "result": {
             "image": {
@@ -69,63 +400,269 @@ def upload_image() -> Any:
     })
 
 
-def filter_api(
-        action: Callable[
-            [dict[str, Any], np.ndarray],
-            Tuple[np.ndarray, Optional[dict[str, Any]]]
-        ]) -> Any:
-    data = request.json
+def is_uuid(value: str) -> bool:
+    try:
+        return str(UUID(value)) == value
+    except ValueError:
+        return False
+
+
+def part_path(task_id: str, id: str) -> str:
+    return os.path.join(TASK_DIR, task_id, f"{id}.part")
+
+
+@app.route("/upload_image/chunked", methods=["POST"])
+def start_chunked_upload() -> Any:
+    # 1MB を超えるファイルは分割して PUT してもらう
+    task_id = str(uuid4())
+    id = str(uuid4())
+    path = part_path(task_id, id)
+    os.makedirs(os.path.dirname(path))
+    open(path, "wb").close()
+    # 途中で放置されたアップロードも GC で消えるよう、索引に載せる
+    task_index.touch(task_id)
+    return jsonify({"result": {"task_id": task_id, "id": id, "offset": 0}})
+
+
+@app.route("/upload_image/chunked/<task_id>/<id>",
+           methods=["GET", "PUT"])
+def chunked_upload(task_id: str, id: str) -> Any:
+    if not (is_uuid(task_id) and is_uuid(id)):
+        return error_res("invalid upload id")
+    path = part_path(task_id, id)
+    if not os.path.exists(path):
+        return error_res("upload not exists")
+    offset = os.path.getsize(path)
+    if request.method == "PUT":
+        # 途中で切れた場合は GET で offset を確認して続きから送り直す
+        if request.args.get("offset", type=int) != offset:
+            return error_res(f"offset must be {offset}")
+        try:
+            written = append_stream(
+                request.stream, path, MAX_UPLOAD_BYTES) - offset
+            # 書きかけのファイルも容量に数える
+            task_index.reserve(task_id, written, 0, TASK_MAX_BYTES)
+        except (ValueError, QuotaExceeded) as e:
+            os.truncate(path, offset)
+            return error_res(str(e))
+        offset += written
+    return jsonify({"result": {"task_id": task_id, "id": id,
+                               "offset": offset}})
+
+
+@app.route("/upload_image/chunked/<task_id>/<id>/complete",
+           methods=["POST"])
+def complete_chunked_upload(task_id: str, id: str) -> Any:
+    if not (is_uuid(task_id) and is_uuid(id)):
+        return error_res("invalid upload id")
+    path = part_path(task_id, id)
+    if not os.path.exists(path):
+        return error_res("upload not exists")
+    part_bytes = os.path.getsize(path)
+    if part_bytes == 0:
+        os.remove(path)
+        return error_res("invalid image")
+    # PUT の度に数えた書きかけのファイルの分は、保存した画像の大きさに置き換える
+    task_index.touch(task_id, -part_bytes)
+    save_path = image_path(task_id, id)
+    sha256 = file_hash(path)
+    if UPLOAD_PASSTHROUGH and is_jpeg(read_head(path)):
+        store_upload(task_id, save_path, sha256,
+                     lambda: os.replace(path, save_path))
+        if os.path.exists(path):
+            os.remove(path)
+        return upload_res(task_id, id)
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    os.remove(path)
+    if img is None:
+        return error_res("invalid image")
+    store_upload(task_id, save_path, sha256,
+                 lambda: cv2.imwrite(save_path, img))
+    cache_image(task_id, id, img)
+    return upload_res(task_id, id)
+
+
+Action = Callable[
+    [dict[str, Any], np.ndarray],
+    Tuple[np.ndarray, Optional[dict[str, Any]]]
+]
+
+
+def image_info(
+        task_id: str,
+        id: str,
+        img: np.ndarray,
+        fmt: str = "jpg") -> dict[str, Any]:
+    info = {
+        "task_id": task_id,
+        "id": id,
+        "x": 0,
+        "y": 0,
+        "width": img.shape[1],
+        "height": img.shape[0],
+    }
+    # jpg 以外で保存した場合だけ形式を返す
+    if fmt != "jpg":
+        info["format"] = fmt
+    return info
+
+
+def run_filter(
+        data: dict[str, Any],
+        action: Action) -> Optional[dict[str, Any]]:
     # {task_id: XXX, id: XXX}
     task_id = data.get("task_id", "")
-    path = image_path(task_id, data.get("id", ""))
-    if not os.path.exists(path):
-        error_res("filename not exists")
+    id = data.get("id", "")
+    key = None
+    sha256 = source_hash(task_id, id) if DEDUP_ENABLED else None
+    if sha256 is not None:
+        # 同じ処理をしたことがあれば、前回の結果をそのまま返す
+        key = result_key(sha256, action.__name__, data)
+        result = task_index.get_result(task_id, key)
+        if result is not None and image_exists(
+                task_id, result["image"]["id"]):
+            task_index.touch(task_id)
+            return result
+
+    with stage("decode"):
+        img = load_image(task_id, id)
+    if img is None:
+        return None
+
+    with stage("compute"):
+        img, params = executor.run(
+            ACTION_NAMES[action.__name__], action, data, img)
+    fmt = storage.choose_format(data.get("format") or IMAGE_FORMAT, img)
+    if data.get("overlay", True) is False and action.__name__ in OVERLAYS:
+        # 検出結果だけを返し、描画は /render で取りに来た時に行う
+        new_id = str(uuid4())
+        write_spec(spec_path(task_id, new_id), {
+            "source": id, "overlay": action.__name__, "params": params,
+            "format": fmt})
+        info = {**image_info(task_id, new_id, img, fmt),
+                "url": f"/render/{task_id}/{new_id}"}
+    else:
+        with stage("encode"):
+            new_id = save_image(task_id, img, fmt)
+        info = image_info(task_id, new_id, img, fmt)
+
+    result = {
+        "image": info,
+        "params": params
+    }
+    if key is not None:
+        task_index.set_result(task_id, key, result)
+    return result
+
+
+def filter_api(action: Action) -> Any:
+    data = request.json
+    if not storage.is_format(data.get("format") or IMAGE_FORMAT):
+        return error_res(f"unknown format: {data.get('format')}")
+    error = check_params(ACTION_NAMES[action.__name__], data)
+    if error is not None:
+        return error_res(error)
+    if data.get("async"):
+        return submit_job(data, action)
 
-    img = cv2.imread(path)
-    img, params = action(data, img)
-    new_id = str(uuid4())
-    write_path = image_path(task_id, new_id)
-    cv2.imwrite(write_path, img)
+    result = run_filter(data, action)
+    if result is None:
+        return error_res("filename not exists")
+    with stage("serialize"):
+        return jsonify({"result": result})
+
+
+job_queue = JobQueue(TASK_DIR, JOB_CONCURRENCY)
+
+
+def submit_job(data: dict[str, Any], action: Action) -> Any:
+    # {task_id: XXX, id: XXX, async: true, callback_url: XXX}
+    task_id = data.get("task_id", "")
+    if not image_exists(task_id, data.get("id", "")):
+        return error_res("filename not exists")
+    callback_url = data.get("callback_url")
+    if callback_url and not is_callback_url(callback_url):
+        return error_res("callback_url is not allowed")
+
+    def run() -> dict[str, Any]:
+        result = run_filter(data, action)
+        if result is None:
+            raise ValueError("filename not exists")
+        return result
+
+    job = job_queue.submit(task_id, run, callback_url)
+    return jsonify({"result": {"job": job}}), 202
+
+
+@app.route("/jobs/<task_id>/<job_id>")
+def job_status(task_id: str, job_id: str) -> Any:
+    if not is_uuid(job_id):
+        return error_res("invalid job id")
+    job = job_queue.get(task_id, job_id)
+    if job is None:
+        return error_res("job not exists")
+    return jsonify({"result": {"job": job}})
+
+
+Drawer = Callable[[np.ndarray, dict[str, Any]], np.ndarray]
+
+
+def canvas(img: np.ndarray) -> np.ndarray:
+    # 色付きの枠を描けるよう、BGR のコピーを返す
+    bgr = as_bgr(img)
+    return bgr.copy() if bgr is img else bgr
 
-    return jsonify({
-        "result": {
-            "image": {
-                "task_id": task_id,
-                "id": new_id,
-                "x": 0,
-                "y": 0,
-                "width": img.shape[1],
-                "height": img.shape[0],
-            },
-            "params": params
-        }
-    })
+
+def gray_level(
+        data: dict[str, Any],
+        img: np.ndarray,
+        level: int) -> np.ndarray:
+    # グレースケールの画像ピラミッド。画像ごとにキャッシュし、
+    # 同じ画像への後の処理 (顔検出、輪郭) で使い回す。
+    # action の子プロセスではキャッシュしない
+    id = data.get("id")
+    key = (data.get("task_id", ""), id, "gray") \
+        if id and not in_action_worker() else None
+    return pyramid_level(image_cache, key, lambda: as_gray(img), level)
+
+
+def overlay(
+        data: dict[str, Any],
+        img: np.ndarray,
+        draw: Drawer,
+        params: dict[str, Any]) -> np.ndarray:
+    # overlay: false の場合は元画像に描かずに返す
+    if data.get("overlay", True) is False:
+        return img
+    return draw(img, params)
+
+
+def gray(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, None]:
+    return as_gray(img), None
 
 
 @app.route("/grayscale", methods=["POST"])
 def grayscale() -> Any:
-    def gray(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, None]:
-        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), None
-
     return filter_api(gray)
 
 
+def thre(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
+    t = data.get("threshold")
+    threshold = int(t if t else 0)
+    img = as_gray(img)
+    if threshold == 0:
+        threshold, img = cv2.threshold(img, 0, 255, cv2.THRESH_OTSU)
+    else:
+        _, img = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
+    return img, {"threshold": str(int(threshold))}
+
+
 @app.route("/threshold", methods=["POST"])
 def threshold() -> Any:
-    def thre(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
-        t = data.get("threshold")
-        threshold = int(t if t else 0)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        if threshold == 0:
-            threshold, img = cv2.threshold(img, 0, 255, cv2.THRESH_OTSU)
-        else:
-            _, img = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
-        return img, {"threshold": str(int(threshold))}
-
     return filter_api(thre)
 
 
@@ -133,255 +670,388 @@ face_cascade = cv2.CascadeClassifier(os.path.join(
     SRC_DIR, 'haarcascade_frontalface_default.xml'))
 
 
+def fd(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
+    task_id = data.get("task_id", "")
+    # max_size: 検出する画像の長辺の上限。min_size: 見つける顔の最小の大きさ
+    max_size = int(data.get("max_size") or 0)
+    min_size = int(data.get("min_size") or 0)
+    window = face_cascade.getOriginalWindowSize()[0]
+    level = choose_level(img.shape, max_size, min_size, window)
+    if level == 0:
+        faces = detect_faces(face_cascade, as_gray(img), min_size)
+    else:
+        # 縮小した画像で探し、見つけた位置の周りだけ元の解像度で探し直す
+        faces = detect_faces(
+            face_cascade, gray_level(data, img, level), min_size >> level)
+        faces = refine_faces(
+            face_cascade, gray_level(data, img, 0), faces, 1 << level)
+    new_ids = save_crops(data, img, [rect_crop(*f) for f in faces])
+    face_data = []
+    for (x, y, w, h), new_id in zip(faces, new_ids):
+        face_data.append({
+            "task_id": task_id,
+            "id": new_id,
+            "x": int(x),
+            "y": int(y),
+            "width": int(w),
+            "height": int(h),
+            **crop_url(data, new_id),
+        })
+    params = {"faces": face_data}
+    return overlay(data, img, draw_faces, params), params
+
+
+def draw_faces(img: np.ndarray, params: dict[str, Any]) -> np.ndarray:
+    img_with_rect = canvas(img)
+    for f in params["faces"]:
+        x, y, w, h = f["x"], f["y"], f["width"], f["height"]
+        cv2.rectangle(
+            img_with_rect, (x, y), (x+w, y+h), (255, 0, 0), 2)
+    return img_with_rect
+
+
 @app.route("/face_detection", methods=["POST"])
 def face_detection() -> Any:
-    def fd(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
-        task_id = data.get("task_id", "")
-        img_with_rect = img.copy()
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        face_data = []
-        for (x, y, w, h) in faces:
-            cv2.rectangle(
-                img_with_rect, (x, y), (x+w, y+h), (255, 0, 0), 2)
-
-            face_img = img[y:y+h, x:x+w]
-            new_id = str(uuid4())
-            write_path = image_path(task_id, new_id)
-            cv2.imwrite(write_path, face_img)
-
-            face_data.append({
+    return filter_api(fd)
+
+
+def load_ocr_reader() -> Any:
+    return easyocr.Reader(['ja', 'en'])
+
+
+text_reader = TextReader(
+    None if in_action_worker() else load_ocr_reader(),
+    loader=load_ocr_reader)
+
+
+def _ocr(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
+    task_id = data.get("task_id", "")
+    # regions: 文字を探す領域。"cards" の場合はカード検出の結果を使う
+    regions = data.get("regions")
+    areas = None
+    if regions == "cards":
+        areas = parse_regions(
+            card_detect(as_bgr(img), data.get("tiled")), img.shape)
+    elif regions:
+        areas = parse_regions(regions, img.shape)
+    max_size = int(data.get("max_size") or OCR_MAX_SIZE)
+    with stage("forward"):
+        result = text_reader.read(as_bgr(img), areas, max_size)
+    rects = []
+    for (points, text, score) in result:
+        x = int(points[0][0])
+        y = int(points[0][1])
+        w = int(points[2][0] - x)
+        h = int(points[2][1] - y)
+        rects.append((x, y, w, h))
+
+    new_ids = save_crops(data, img, [rect_crop(*r) for r in rects])
+    data_list = []
+    for (x, y, w, h), (_, text, score), new_id in zip(
+            rects, result, new_ids):
+        data_list.append({
+            "image": {
                 "task_id": task_id,
                 "id": new_id,
                 "x": int(x),
                 "y": int(y),
                 "width": int(w),
                 "height": int(h),
-            })
-        return img_with_rect, {"faces": face_data}
-
-    return filter_api(fd)
+                **crop_url(data, new_id),
+            },
+            "text": text,
+            "score": score,
+        })
+    params = {"texts": data_list}
+    return overlay(data, img, draw_texts, params), params
 
 
-ocr_reader = easyocr.Reader(['ja', 'en'])
+def draw_texts(img: np.ndarray, params: dict[str, Any]) -> np.ndarray:
+    img_with_rect = canvas(img)
+    for t in params["texts"]:
+        i = t["image"]
+        x, y, w, h = i["x"], i["y"], i["width"], i["height"]
+        cv2.rectangle(
+            img_with_rect, (x, y), (x+w, y+h), (255, 0, 0), 2)
+    return img_with_rect
 
 
 @app.route("/ocr", methods=["POST"])
 def ocr() -> Any:
-    def _ocr(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
-        task_id = data.get("task_id", "")
-        path = image_path(task_id, data.get("id", ""))
-        result = ocr_reader.readtext(path)
-        img_with_rect = img.copy()
-        data_list = []
-        for (points, text, score) in result:
-            x = int(points[0][0])
-            y = int(points[0][1])
-            w = int(points[2][0] - x)
-            h = int(points[2][1] - y)
-            cv2.rectangle(
-                img_with_rect, (x, y), (x+w, y+h), (255, 0, 0), 2)
-
-            _img = img[y:y+h, x:x+w]
-            new_id = str(uuid4())
-            write_path = image_path(task_id, new_id)
-            cv2.imwrite(write_path, _img)
-
-            data_list.append({
-                "image": {
-                    "task_id": task_id,
-                    "id": new_id,
-                    "x": int(x),
-                    "y": int(y),
-                    "width": int(w),
-                    "height": int(h),
-                },
-                "text": text,
-                "score": score,
-            })
-        return img_with_rect, {"texts": data_list}
-
     return filter_api(_ocr)
 
 
+def area_range(data: dict[str, Any]) -> Tuple[float, float]:
+    # 輪郭の面積が画像に占める割合の範囲。null や 0 の場合は既定値
+    try:
+        min_area = float(data.get("min_area") or MIN_AREA)
+        max_area = float(data.get("max_area") or MAX_AREA)
+    except (TypeError, ValueError):
+        raise ValueError("min_area and max_area must be numbers")
+    if not (0 <= min_area <= 1 and 0 <= max_area <= 1):
+        raise ValueError("min_area and max_area must be between 0 and 1")
+    return min_area, max_area
+
+
+def con(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
+    task_id = data.get("task_id", "")
+    min_area, max_area = area_range(data)
+    # max_size: 輪郭を探す画像の長辺の上限
+    level = choose_level(img.shape, int(data.get("max_size") or 0))
+    gray = as_gray(img) if level == 0 else gray_level(data, img, level)
+
+    threshold, contours = find_contours(gray)
+    height, width = gray.shape
+    contours = filter_contours(
+        contours, height * width, min_area, max_area)
+    if level > 0:
+        # 見つけた領域の周りだけ、元の解像度で輪郭を取り直す
+        contours = refine_contours(
+            gray_level(data, img, 0), contours, 1 << level, threshold,
+            min_area, max_area)
+    quads = find_quads(contours)
+
+    crops: List[Crop] = []
+    rects = []
+    for src, (w, h), M in zip(quads.corners, quads.sizes, quads.matrices):
+        crops.append(quad_crop(src, w, h, M))
+        rects.append((src[0][0], src[0][1], w, h))
+    points = quads.points.tolist()
+
+    # 変形とエンコードはまとめて並列に行う
+    new_ids = save_crops(data, img, crops)
+    data_list = []
+    for (x, y, w, h), p, new_id in zip(rects, points, new_ids):
+        data_list.append({
+            "task_id": task_id,
+            "id": new_id,
+            "x": int(x),
+            "y": int(y),
+            "width": int(w),
+            "height": int(h),
+            "points": p,
+            **crop_url(data, new_id),
+        })
+
+    params = {"extracted": data_list}
+    return overlay(data, img, draw_contours, params), params
+
+
+def draw_contours(img: np.ndarray, params: dict[str, Any]) -> np.ndarray:
+    contours = [np.array(e["points"], dtype=np.int32).reshape(-1, 1, 2)
+                for e in params["extracted"]]
+    return cv2.drawContours(
+        canvas(img), contours, -1, (0, 0, 255, 255), 2, cv2.LINE_AA)
+
+
 @app.route("/contours", methods=["POST"])
 def contours() -> Any:
-    def con(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
-        task_id = data.get("task_id", "")
-        img_with_rect = img.copy()
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        threshold, thre = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
-
-        contours, hierarchy = cv2.findContours(
-            thre, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        height, width = thre.shape
-        image_size = height * width
-
-        def is_valid_contour(contour: List[Tuple[int, int]]) -> bool:
-            # 小さな領域の場合は間引く
-            area = cv2.contourArea(contour)
-            if image_size * 0.01 > area:
-                return False
-            # 画像全体を占める領域は除外する
-            if image_size * 0.99 < area:
-                return False
-            return True
-
-        contours = [c for c in contours if is_valid_contour(c)]
-
-        def simplify(contour: List[Tuple[int, int]]) -> Any:
-            epsilon = 0.1 * cv2.arcLength(contour, True)
-            return cv2.approxPolyDP(contour, epsilon, True)
-
-        contours = [simplify(c) for c in contours]
-
-        # 四角以外は無視する
-        contours = [c for c in contours if len(c) == 4]
-
-        img_with_rect = cv2.drawContours(
-            img_with_rect, contours, -1, (0, 0, 255, 255), 2, cv2.LINE_AA)
-
-        data_list = []
-        for c in contours:
-            # 左上、左下、右下、右上
-            leftTop = c[0][0]
-            leftBottom = c[1][0]
-            rightBottom = c[2][0]
-            rightTop = c[3][0]
-
-            # 上から２点をとる
-            ysort = sorted([leftTop, leftBottom, rightBottom,
-                            rightTop], key=lambda x: int(x[1]))
-            # 右肩上がりの領域の場合、ポイントを入れ替える
-            if ysort[0][0] > ysort[1][0]:
-                rightTop = c[0][0]
-                leftTop = c[1][0]
-                leftBottom = c[2][0]
-                rightBottom = c[3][0]
-
-            src = np.float32([leftTop, rightTop, leftBottom, rightBottom])
-
-            # 左上、右上、左下、右下
-            o_width = int(math.sqrt(
-                (leftTop[0] - rightTop[0]) ** 2 +
-                (leftTop[1] - rightTop[1]) ** 2
-            ))
-            o_height = int(math.sqrt(
-                (leftTop[0] - leftBottom[0]) ** 2 +
-                (leftTop[1] - leftBottom[1]) ** 2
-            ))
-            dst = np.float32(
-                [[0, 0], [o_width, 0], [0, o_height], [o_width, o_height]])
-
-            M = cv2.getPerspectiveTransform(src, dst)
-            output = cv2.warpPerspective(img, M, (o_width, o_height))
-
-            new_id = str(uuid4())
-            write_path = image_path(task_id, new_id)
-            cv2.imwrite(write_path, output)
-
-            data_list.append({
-                "task_id": task_id,
-                "id": new_id,
-                "x": int(leftTop[0]),
-                "y": int(leftTop[1]),
-                "width": int(o_width),
-                "height": int(o_height),
-            })
+    return filter_api(con)
 
-        return img_with_rect, {"extracted": data_list}
 
-    return filter_api(con)
+def _not(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, None]:
+    gray = as_gray(img)
+    threshold, thre = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
+    return cv2.bitwise_not(thre), None
 
 
 @app.route("/bitwise_not", methods=["POST"])
 def bitwise_not() -> Any:
-    def _not(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, None]:
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        threshold, thre = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
-        return cv2.bitwise_not(thre), None
-
     return filter_api(_not)
 
 
+def _blur(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, None]:
+    return cv2.GaussianBlur(img, (5, 5), 0), None
+
+
 @app.route("/blur", methods=["POST"])
 def blur() -> Any:
-    def _blur(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, None]:
-        return cv2.GaussianBlur(img, (5, 5), 0), None
-
     return filter_api(_blur)
 
 
+def detect(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
+    task_id = data.get("task_id", "")
+
+    cards = card_detect(as_bgr(img), data.get("tiled"))
+
+    crops: List[Crop] = []
+    rects = []
+    points = []
+    for card in cards:
+        rotate_cnt = card["degree"] // 90
+        # 左上、左下、右下、右上
+        leftTop = card["points"][(rotate_cnt+0) % 4]
+        leftBottom = card["points"][(rotate_cnt+3) % 4]
+        rightBottom = card["points"][(rotate_cnt+2) % 4]
+        rightTop = card["points"][(rotate_cnt+1) % 4]
+        points.append([list(p) for p in card["points"]])
+
+        src = np.float32([leftTop, rightTop, leftBottom, rightBottom])
+
+        # 左上、右上、左下、右下
+        o_width = int(math.sqrt(
+            (leftTop[0] - rightTop[0]) ** 2 +
+            (leftTop[1] - rightTop[1]) ** 2
+        ))
+        o_height = int(math.sqrt(
+            (leftTop[0] - leftBottom[0]) ** 2 +
+            (leftTop[1] - leftBottom[1]) ** 2
+        ))
+        crops.append(quad_crop(src, o_width, o_height))
+        rects.append((leftTop[0], leftTop[1], o_width, o_height))
+
+    # 変形とエンコードはまとめて並列に行う
+    new_ids = save_crops(data, img, crops)
+    data_list = []
+    for (x, y, w, h), p, new_id in zip(rects, points, new_ids):
+        data_list.append({
+            "task_id": task_id,
+            "id": new_id,
+            "x": int(x),
+            "y": int(y),
+            "width": int(w),
+            "height": int(h),
+            "points": p,
+            **crop_url(data, new_id),
+        })
+
+    params = {"extracted": data_list}
+    return overlay(data, img, draw_cards, params), params
+
+
+def draw_cards(img: np.ndarray, params: dict[str, Any]) -> np.ndarray:
+    img_with_rect = canvas(img)
+    for card in params["extracted"]:
+        plot_one_box(list(itertools.chain.from_iterable(
+            card["points"])), img_with_rect, color=[0, 0, 255])
+    return img_with_rect
+
+
 @app.route("/card_detection", methods=["POST"])
 def card_detection() -> Any:
-    def detect(
-            data: dict[str, Any],
-            img: np.ndarray) -> Tuple[np.ndarray, dict[str, Any]]:
-        task_id = data.get("task_id", "")
-        org_id = data.get("id", "")
-
-        cards = card_detect(image_path(task_id, org_id))
-
-        img_with_rect = img.copy()
-
-        for card in cards:
-            plot_one_box(list(itertools.chain.from_iterable(
-                card["points"])), img_with_rect, color=[0, 0, 255])
-
-        data_list = []
-        for card in cards:
-            rotate_cnt = card["degree"] // 90
-            # 左上、左下、右下、右上
-            leftTop = card["points"][(rotate_cnt+0) % 4]
-            leftBottom = card["points"][(rotate_cnt+3) % 4]
-            rightBottom = card["points"][(rotate_cnt+2) % 4]
-            rightTop = card["points"][(rotate_cnt+1) % 4]
-
-            src = np.float32([leftTop, rightTop, leftBottom, rightBottom])
-
-            # 左上、右上、左下、右下
-            o_width = int(math.sqrt(
-                (leftTop[0] - rightTop[0]) ** 2 +
-                (leftTop[1] - rightTop[1]) ** 2
-            ))
-            o_height = int(math.sqrt(
-                (leftTop[0] - leftBottom[0]) ** 2 +
-                (leftTop[1] - leftBottom[1]) ** 2
-            ))
-            dst = np.float32(
-                [[0, 0], [o_width, 0], [0, o_height], [o_width, o_height]])
-
-            M = cv2.getPerspectiveTransform(src, dst)
-            output = cv2.warpPerspective(img, M, (o_width, o_height))
-
-            new_id = str(uuid4())
-            write_path = image_path(task_id, new_id)
-            cv2.imwrite(write_path, output)
-
-            data_list.append({
-                "task_id": task_id,
-                "id": new_id,
-                "x": int(leftTop[0]),
-                "y": int(leftTop[1]),
-                "width": int(o_width),
-                "height": int(o_height),
-            })
+    return filter_api(detect)
 
-        return img_with_rect, {"extracted": data_list}
 
-    return filter_api(detect)
+ACTIONS: dict[str, Action] = {
+    "grayscale": gray,
+    "threshold": thre,
+    "face_detection": fd,
+    "ocr": _ocr,
+    "contours": con,
+    "bitwise_not": _not,
+    "blur": _blur,
+    "card_detection": detect,
+}
+
+# action の関数名 -> 名前 (EXEC_ROUTES で指定する名前)
+ACTION_NAMES = {action.__name__: name for name, action in ACTIONS.items()}
+
+# 実行する前に確かめるパラメータ。不正なら ValueError を投げる。
+# action は別のスレッドやプロセスで動くので、400 はここで返す
+PARAM_CHECKS: dict[str, Callable[[dict[str, Any]], Any]] = {
+    "contours": area_range,
+}
+
+
+def check_params(name: str, data: dict[str, Any]) -> Optional[str]:
+    check = PARAM_CHECKS.get(name)
+    if check is None:
+        return None
+    try:
+        check(data)
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+# process で実行する子プロセスが、起動時に読み込むモデル。
+# ocr で regions に "cards" を指定した場合のカード検出のモデルは、使う時に読む
+ACTION_MODELS: dict[str, List[Callable[[], Any]]] = {
+    "ocr": [text_reader.load],
+    "card_detection": [ensure_model],
+}
+
+# action を inline / thread / process のどこで実行するか
+executor = ActionExecutor(parse_routes(EXEC_ROUTES))
+
+
+# 検出結果を後から描画する処理 (action の関数名 -> 描画)
+OVERLAYS: dict[str, Drawer] = {
+    fd.__name__: draw_faces,
+    _ocr.__name__: draw_texts,
+    con.__name__: draw_contours,
+    detect.__name__: draw_cards,
+}
+
+
+@app.route("/pipeline", methods=["POST"])
+def pipeline() -> Any:
+    data = request.json
+    # {task_id: XXX, id: XXX,
+    #  operations: [{name: XXX, params: {...}, save: true, format: XXX},
+    #               ...]}
+    task_id = data.get("task_id", "")
+    operations = data.get("operations") or []
+    if not isinstance(operations, list):
+        return error_res("operations must be a list")
+    if len(operations) == 0:
+        return error_res("operations must not empty.")
+    for op in operations:
+        if not isinstance(op, dict):
+            return error_res("each operation must be an object")
+        if not isinstance(op.get("params") or {}, dict):
+            return error_res("params must be an object")
+        if op.get("name") not in ACTIONS:
+            return error_res(f"unknown operation: {op.get('name')}")
+        if not storage.is_format(op.get("format") or IMAGE_FORMAT):
+            return error_res(f"unknown format: {op.get('format')}")
+        error = check_params(op["name"], op.get("params") or {})
+        if error is not None:
+            return error_res(error)
+
+    id: Optional[str] = data.get("id", "")
+    img = load_image(task_id, id or "")
+    if img is None:
+        return error_res("filename not exists")
+
+    steps: List[dict[str, Any]] = []
+    for i, op in enumerate(operations):
+        name = op["name"]
+        params = op.get("params") or {}
+        with stage("compute"):
+            img, result = executor.run(
+                name, ACTIONS[name],
+                {**params, "task_id": task_id, "id": id}, img)
+
+        # 最後の結果は常に保存する
+        id = None
+        fmt = storage.choose_format(op.get("format") or IMAGE_FORMAT, img)
+        if op.get("save") or i == len(operations) - 1:
+            id = save_image(task_id, img, fmt)
+        steps.append({
+            "name": name,
+            "image": image_info(task_id, id, img, fmt) if id else None,
+            "params": result,
+        })
+
+    return jsonify({
+        "result": {
+            "image": steps[-1]["image"],
+            "steps": steps,
+        }
+    })
 
 # グレースケール
 # -> フィルター系（パラメータなし。画像のみ）
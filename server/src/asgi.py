@@ -0,0 +1,7 @@
+from src.app import app as wsgi_app
+from src.async_server import ASGI_THREADS, AsyncWSGIAdapter
+
+# uvicorn で動かす場合の入り口
+# gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker src.asgi:app
+app = AsyncWSGIAdapter(
+    wsgi_app, ASGI_THREADS, wsgi_app.config["MAX_CONTENT_LENGTH"])
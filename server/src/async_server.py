@@ -0,0 +1,227 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Awaitable, Callable, Iterator, List, Optional, Tuple
+import asyncio
+import io
+import os
+import sys
+
+Scope = dict[str, Any]
+Message = dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+# アプリの処理を同時に実行するスレッド数 (プロセス単位)
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", os.cpu_count() or 1))
+# これより小さいレスポンスは、アプリのスレッドで本文まで読み切る
+BUFFER_BYTES = 1024 * 1024
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def read_body(receive: Receive, limit: int) -> io.BytesIO:
+    # 遅いクライアントからの受信はイベントループで待つので、スレッドを塞がない
+    body = io.BytesIO()
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body.write(message.get("body", b""))
+        if limit > 0 and body.tell() > limit:
+            raise BodyTooLarge()
+        more_body = message.get("more_body", False)
+    body.seek(0)
+    return body
+
+
+def build_environ(scope: Scope, body: io.BytesIO) -> dict[str, Any]:
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin1"),
+        "PATH_INFO": scope["path"].encode().decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        # ボディは受信済みなので、長さが分かっている
+        "CONTENT_LENGTH": str(len(body.getbuffer())),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin1").upper().replace("-", "_")
+        if key == "CONTENT_LENGTH":
+            # 受信したボディの長さを使う
+            continue
+        if key != "CONTENT_TYPE":
+            key = f"HTTP_{key}"
+        text = value.decode("latin1")
+        environ[key] = f"{environ[key]},{text}" if key in environ else text
+    return environ
+
+
+class WSGIResponse:
+    """
+    WSGI アプリをスレッドで呼び、start_response の内容と本文を受け取る。
+    """
+
+    def __init__(self) -> None:
+        self.status = 500
+        self.headers: List[Tuple[bytes, bytes]] = []
+        # write() で書かれた本文。iterable より先に送る
+        self.chunks: List[bytes] = []
+
+    def start_response(
+            self,
+            status: str,
+            headers: List[Tuple[str, str]],
+            exc_info: Any = None) -> Callable[[bytes], None]:
+        self.status = int(status.split(" ", 1)[0])
+        self.headers = [(k.lower().encode("latin1"), v.encode("latin1"))
+                        for k, v in headers]
+        return self._write
+
+    def content_length(self) -> Optional[int]:
+        for k, v in self.headers:
+            if k == b"content-length":
+                return int(v)
+        return None
+
+    def _write(self, data: bytes) -> None:
+        self.chunks.append(data)
+
+    def take_chunks(self) -> List[bytes]:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+class AsyncWSGIAdapter:
+    """
+    Flask (WSGI) のアプリを ASGI サーバー (uvicorn) で動かす。
+    接続の保持やボディの送受信はイベントループで行い、
+    cv2 や推論を含むアプリの処理だけを上限付きのスレッドで実行する。
+    """
+
+    def __init__(
+            self,
+            wsgi_app: Callable[..., Any],
+            max_workers: int = ASGI_THREADS,
+            max_body: int = 0) -> None:
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.max_body = max_body
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # preload した master から fork された場合は作り直す
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="asgi")
+                self._pid = os.getpid()
+            return self._executor
+
+    async def __call__(
+            self,
+            scope: Scope,
+            receive: Receive,
+            send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(f"unsupported scope: {scope['type']}")
+
+    async def lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            body = await read_body(receive, self.max_body)
+        except ClientDisconnected:
+            return
+        except BodyTooLarge:
+            await send({"type": "http.response.start", "status": 413,
+                        "headers": [(b"content-type", b"text/plain")]})
+            await send({"type": "http.response.body",
+                        "body": b"Request Entity Too Large"})
+            return
+
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        response = WSGIResponse()
+        environ = build_environ(scope, body)
+        content, iterable = await loop.run_in_executor(
+            executor, self.call_app, environ, response)
+        if content is not None:
+            await send({"type": "http.response.start",
+                        "status": response.status,
+                        "headers": response.headers})
+            await send({"type": "http.response.body", "body": content})
+            return
+
+        # 画像などの大きな本文は、少しずつ読みながら送る
+        chunks: Iterator[bytes] = iter(iterable)
+        try:
+            # start_response が最初の1片の時に呼ばれる場合もあるので先に読む
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+            await send({"type": "http.response.start",
+                        "status": response.status,
+                        "headers": response.headers})
+            while chunk is not None:
+                for body in response.take_chunks() + [chunk]:
+                    await send({"type": "http.response.body", "body": body,
+                                "more_body": True})
+                chunk = await loop.run_in_executor(
+                    executor, next, chunks, None)
+            for body in response.take_chunks():
+                await send({"type": "http.response.body", "body": body,
+                            "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                await loop.run_in_executor(executor, close)
+
+    def call_app(
+            self,
+            environ: dict[str, Any],
+            response: WSGIResponse) -> Tuple[Optional[bytes], Any]:
+        iterable = self.wsgi_app(environ, response.start_response)
+        length = response.content_length()
+        if length is None or length > BUFFER_BYTES:
+            return None, iterable
+        # JSON などの小さい本文は、このスレッドで読み切って1度に送る
+        try:
+            return b"".join(response.take_chunks() + list(iterable)), None
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
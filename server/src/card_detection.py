@@ -1,9 +1,16 @@
 import torch
 import cv2
+import fcntl
+import math
 import numpy as np
 import os
+import queue
+import threading
+import time
 
-from src.models import Darknet
+from src import models
+from src.metrics import observe, stage
+from src.models import Darknet, export_inference_model
 from src.utils import non_max_suppression
 
 IMAGE_SIZE = 608
@@ -13,6 +20,24 @@ CONFIG_PATH = os.path.join(ROOT_DIR, "data", "card_detection")
 
 YOLO_FILE = os.path.join(CONFIG_PATH, "yolov3.cfg")
 CHECKPINT_FILE = os.path.join(CONFIG_PATH, "latest.pt")
+# cfg の解析とモジュールの構築を省くため、モデル全体を保存したもの
+COMPILED_FILE = os.path.join(CONFIG_PATH, "latest.model.pt")
+# BN の畳み込み、trace、freeze まで済ませた TorchScript のモデル
+JIT_FILE = os.path.join(CONFIG_PATH, "latest.jit.pt")
+JIT_CHANNELS_LAST_FILE = os.path.join(CONFIG_PATH, "latest.cl.jit.pt")
+
+# 1 より大きい場合、同時に来た推論要求をまとめて forward する
+BATCH_SIZE = int(os.environ.get("CARD_DETECTION_BATCH_SIZE", 1))
+# バッチが埋まるまで待つ最大時間
+BATCH_WAIT = float(os.environ.get("CARD_DETECTION_BATCH_WAIT_MS", 10)) / 1000
+# BN を畳み込んだ TorchScript のモデルで推論する
+USE_JIT = os.environ.get("CARD_DETECTION_JIT", "1") == "1"
+CHANNELS_LAST = os.environ.get("CARD_DETECTION_CHANNELS_LAST", "0") == "1"
+# 大きな画像を重なりのあるタイルに分けて、細部を落とさずに推論する
+TILING = os.environ.get("CARD_DETECTION_TILING", "0") == "1"
+# タイルの1辺は IMAGE_SIZE のこの倍数 (元画像のピクセル数)
+TILE_SCALE = float(os.environ.get("CARD_DETECTION_TILE_SCALE", 2))
+TILE_OVERLAP = 0.2
 
 
 # resize a rectangular image to a padded square
@@ -30,86 +55,353 @@ def resize_square(img, height=416, color=(0, 0, 0)):
     return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color), ratio, dw // 2, dh // 2
 
 
+class _BatchRequest:
+    __slots__ = ("chip", "result", "error", "done")
+
+    def __init__(self, chip):
+        self.chip = chip
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchInference:
+    """
+    Collects single-image forward requests from concurrent threads and runs
+    them as one batched forward pass.
+    """
+
+    def __init__(self, max_batch_size, max_wait):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def _ensure_thread(self):
+        # gunicorn の preload で fork された場合、スレッドは引き継がれないので
+        # プロセスごとに起動し直す
+        with self.lock:
+            if self.pid != os.getpid():
+                self.requests = queue.Queue()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def __call__(self, chip):
+        self._ensure_thread()
+        request = _BatchRequest(chip)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                pred = _forward([r.chip for r in batch])
+                for r, p in zip(batch, pred):
+                    r.result = p
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+            finally:
+                for r in batch:
+                    r.done.set()
+
+
 model = None
 device = None
+batch_inference = None
+_init_lock = threading.Lock()
+
+
+def load_checkpoint(path):
+    # 重みをページキャッシュに mmap し、プロセス間で共有する
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # zip 形式でない古いチェックポイントは mmap できない
+        return torch.load(path, map_location='cpu')
+
+
+def build_model():
+    # 乱数での重みの初期化を省き、チェックポイントのテンソルをそのまま使う
+    with torch.device('meta'):
+        model = Darknet(YOLO_FILE, IMAGE_SIZE)
+    checkpoint = load_checkpoint(CHECKPINT_FILE)
+    model.load_state_dict(checkpoint['model'], assign=True)
+    return model
+
+
+def is_fresh(path):
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    # models.py が変わった場合も pickle が古くなるので作り直す
+    return mtime >= os.path.getmtime(CHECKPINT_FILE) and \
+        mtime >= os.path.getmtime(YOLO_FILE) and \
+        mtime >= os.path.getmtime(models.__file__)
+
+
+def compiled_model_is_fresh():
+    return is_fresh(COMPILED_FILE)
+
+
+def ensure_compiled(path, compile):
+    # 古くなったファイルは作り直す。同時に起動した worker は
+    # 1つが作り終えるのを待って、それを読む
+    if is_fresh(path):
+        return True
+    try:
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not is_fresh(path):
+                compile()
+        return True
+    except OSError:
+        # 書き込めない場合
+        return False
+
+
+def compile_model():
+    model = build_model()
+    tmp_path = f"{COMPILED_FILE}.{os.getpid()}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, COMPILED_FILE)
+
+
+def jit_file(channels_last):
+    return JIT_CHANNELS_LAST_FILE if channels_last else JIT_FILE
+
+
+def compile_jit_model(channels_last):
+    # fuse で model が書き換わるので、毎回組み立て直す
+    traced = export_inference_model(build_model(), channels_last)
+    path = jit_file(channels_last)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.jit.save(traced, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_model():
+    if not ensure_compiled(COMPILED_FILE, compile_model):
+        # その場で組み立てたものを使う
+        return build_model()
+    return torch.load(COMPILED_FILE, map_location='cpu',
+                      mmap=True, weights_only=False)
+
+
+def load_jit_model(device, channels_last=False):
+    # trace は数秒かかるので、起動のたびには行わず保存したものを読む
+    path = jit_file(channels_last)
+    if not ensure_compiled(path, lambda: compile_jit_model(channels_last)):
+        return export_inference_model(
+            load_model().to(device).eval(), channels_last)
+    return torch.jit.load(path, map_location=device)
 
 
 def init_model():
-    global model, device
+    global model, device, batch_inference
     torch.cuda.empty_cache()
-    model = Darknet(YOLO_FILE, IMAGE_SIZE)
-    checkpoint = torch.load(CHECKPINT_FILE, map_location='cpu')
-    model.load_state_dict(checkpoint['model'])
-    del checkpoint
-
     cuda = torch.cuda.is_available()
     device = torch.device('cuda:0' if cuda else 'cpu')
-    model.to(device).eval()
+    if USE_JIT:
+        model = load_jit_model(device, CHANNELS_LAST)
+    else:
+        model = load_model()
+        model.to(device).eval()
+
+    if BATCH_SIZE > 1 and batch_inference is None:
+        batch_inference = BatchInference(BATCH_SIZE, BATCH_WAIT)
+
+
+def ensure_model():
+    # 起動時に読み込んでいなければ、最初に使う時に読み込む
+    if model is not None:
+        return
+    with _init_lock:
+        if model is None:
+            init_model()
 
 
-def detect(image_path: str):
-    global model, device
-    # load_images
-    img = cv2.imread(image_path)
+def preprocess(img, out=None):
     img, _, _, _ = resize_square(
         img, height=IMAGE_SIZE, color=(127.5, 127.5, 127.5))
     img = img[:, :, ::-1].transpose(2, 0, 1)
-    img = np.ascontiguousarray(img, dtype=np.float32)
-    img /= 255.0
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    # BGR -> RGB と float32 への変換を、確保済みの配列に直接書き込む
+    np.copyto(out, img, casting="unsafe")
+    out /= 255.0
+    return torch.from_numpy(out)
 
+
+_buffers = threading.local()
+
+
+def chip_buffer(n):
+    # リクエストごとに入力テンソルを確保しないよう、1枚分をスレッドごとに使い回す。
+    # BatchInference に渡した場合も、結果が返るまでこのスレッドは待っている。
+    # タイルに分けた分は呼び出しごとに確保し、スレッドに大きな配列を残さない
+    if n > 1:
+        return np.empty((n, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+    buf = getattr(_buffers, "chip", None)
+    if buf is None:
+        buf = np.empty((1, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+        _buffers.chip = buf
+    return buf
+
+
+def _forward(chips):
+    # chips: list of [3, IMAGE_SIZE, IMAGE_SIZE] or a stacked tensor
+    # -> [len(chips), nBoxes, 13]
+    memory_format = torch.channels_last if USE_JIT and CHANNELS_LAST \
+        else torch.contiguous_format
     with torch.no_grad():
-        chip = torch.from_numpy(img).unsqueeze(0).to(device)
-        pred = model(chip)
-        pred = pred[pred[:, :, 8] > 0.1]
+        batch = chips if torch.is_tensor(chips) else torch.stack(chips)
+        batch = batch.to(device, memory_format=memory_format)
+        return model(batch).cpu()
 
-        detections = []
-        if len(pred) > 0:
-            detections = non_max_suppression(pred.unsqueeze(0), 0.1, 0.2)
 
-        if len(detections) == 0:
-            return []
+def forward(chip):
+    if batch_inference is not None:
+        return batch_inference(chip)
+    return _forward([chip])[0]
 
-        img = cv2.imread(image_path)
 
-        # The amount of padding that was added
-        pad_x = max(img.shape[0] - img.shape[1], 0) * \
-            (IMAGE_SIZE / max(img.shape))
-        pad_y = max(img.shape[1] - img.shape[0], 0) * \
-            (IMAGE_SIZE / max(img.shape))
-        # Image height and width after padding is removed
-        unpad_h = IMAGE_SIZE - pad_y
-        unpad_w = IMAGE_SIZE - pad_x
+def tile_windows(height: int, width: int, tile: int, overlap: float):
+    # 重なりを持たせて画像全体を覆うタイル (x, y, w, h) の一覧
+    def starts(length):
+        if length <= tile:
+            return [0]
+        n = math.ceil((length - overlap * tile) / (tile - overlap * tile))
+        step = (length - tile) / (n - 1)
+        return [round(i * step) for i in range(n)]
 
-        cards = []
+    return [(x, y, min(tile, width), min(tile, height))
+            for y in starts(height) for x in starts(width)]
 
-        for P1_x, P1_y, P2_x, P2_y, P3_x, P3_y, P4_x, P4_y, conf, cls_conf, cls_pred in detections[0]:
-            P1_y = max((((P1_y - pad_y // 2) / unpad_h)
-                        * img.shape[0]).round().item(), 0)
-            P1_x = max((((P1_x - pad_x // 2) / unpad_w)
-                        * img.shape[1]).round().item(), 0)
-            P2_y = max((((P2_y - pad_y // 2) / unpad_h)
-                        * img.shape[0]).round().item(), 0)
-            P2_x = max((((P2_x - pad_x // 2) / unpad_w)
-                        * img.shape[1]).round().item(), 0)
-            P3_y = max((((P3_y - pad_y // 2) / unpad_h)
-                        * img.shape[0]).round().item(), 0)
-            P3_x = max((((P3_x - pad_x // 2) / unpad_w)
-                        * img.shape[1]).round().item(), 0)
-            P4_y = max((((P4_y - pad_y // 2) / unpad_h)
-                        * img.shape[0]).round().item(), 0)
-            P4_x = max((((P4_x - pad_x // 2) / unpad_w)
-                        * img.shape[1]).round().item(), 0)
 
+def to_global(pred, shape, offset=(0, 0)):
+    # letterbox した chip 上の座標を、元画像上の座標に戻す
+    h, w = shape
+    pad_x = max(h - w, 0) * (IMAGE_SIZE / max(shape))
+    pad_y = max(w - h, 0) * (IMAGE_SIZE / max(shape))
+    unpad_h = IMAGE_SIZE - pad_y
+    unpad_w = IMAGE_SIZE - pad_x
+    pred = pred.clone()
+    pred[:, 0:8:2] = (pred[:, 0:8:2] - pad_x // 2) / unpad_w * w + offset[0]
+    pred[:, 1:8:2] = (pred[:, 1:8:2] - pad_y // 2) / unpad_h * h + offset[1]
+    return pred
+
+
+def away_from_seams(pred, window, shape, margin):
+    # タイルの境目で切れたカードは、全体を見た結果に任せて捨てる
+    x, y, w, h = window
+    xs, ys = pred[:, 0:8:2], pred[:, 1:8:2]
+    keep = torch.ones(len(pred), dtype=torch.bool)
+    if x > 0:
+        keep &= xs.min(1).values > x + margin
+    if y > 0:
+        keep &= ys.min(1).values > y + margin
+    if x + w < shape[1]:
+        keep &= xs.max(1).values < x + w - margin
+    if y + h < shape[0]:
+        keep &= ys.max(1).values < y + h - margin
+    return keep
+
+
+def detect(img, tiled=None):
+    # img: デコード済みの BGR 画像 (パスを渡した場合は読み込む)
+    tiled = TILING if tiled is None else tiled
+    ensure_model()
+    with stage("preprocess"):
+        if isinstance(img, str):
+            img = cv2.imread(img)
+        shape = img.shape[:2]
+        tile = round(IMAGE_SIZE * TILE_SCALE)
+        windows = []
+        # 小さい画像は1回の forward で済ませる
+        if tiled and max(shape) > tile:
+            windows = tile_windows(*shape, tile, TILE_OVERLAP)
+        crops = [img] + [img[y:y+h, x:x+w] for x, y, w, h in windows]
+        buf = chip_buffer(len(crops))
+        for c, out in zip(crops, buf):
+            preprocess(c, out)
+        chips = torch.from_numpy(buf)
+    with stage("forward"):
+        if len(chips) == 1:
+            preds = [forward(chips[0])]
+        else:
+            # 全体とタイルをまとめて1バッチで推論する
+            preds = _forward(chips)
+
+    with torch.no_grad():
+        with stage("nms"):
+            parts = []
+            for pred, crop, window in zip(preds, crops, [None] + windows):
+                pred = pred[pred[:, 8] > 0.1]
+                offset = window[:2] if window else (0, 0)
+                pred = to_global(pred, crop.shape[:2], offset)
+                if window:
+                    pred = pred[away_from_seams(
+                        pred, window, shape, TILE_OVERLAP * tile / 4)]
+                parts.append(pred)
+            pred = torch.cat(parts)
+
+            detections = []
+            if len(pred) > 0:
+                detections = non_max_suppression(
+                    pred.unsqueeze(0), 0.1, 0.2)
+
+        if len(detections) == 0 or detections[0] is None:
+            return []
+
+        start = time.perf_counter()
+        det = detections[0]
+        points = det[:, :8].round().clamp(min=0)
+        if windows:
+            # タイルをまたいでつないだ領域は、画像の中に収める
+            points[:, 0:8:2] = points[:, 0:8:2].clamp(max=shape[1] - 1)
+            points[:, 1:8:2] = points[:, 1:8:2].clamp(max=shape[0] - 1)
+
+        cards = []
+        for p, (conf, cls_conf, cls_pred) in zip(
+                points.tolist(), det[:, 8:11].tolist()):
             cards.append({
                 "points": [
-                    (P1_x, P1_y),
-                    (P2_x, P2_y),
-                    (P3_x, P3_y),
-                    (P4_x, P4_y)
+                    (p[0], p[1]),
+                    (p[2], p[3]),
+                    (p[4], p[5]),
+                    (p[6], p[7]),
                 ],
-                "points_score": conf.item(),
-                "class_score": cls_conf.item(),
+                "points_score": conf,
+                "class_score": cls_conf,
                 "degree": [0, 90, 180, 270][int(cls_pred)],
             })
 
+        observe("rescale", time.perf_counter() - start)
         return cards
+
+
+if __name__ == "__main__":
+    compile_model()
+    compile_jit_model(channels_last=False)
+    compile_jit_model(channels_last=True)
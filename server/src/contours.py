@@ -0,0 +1,139 @@
+from typing import List, NamedTuple, Sequence, Tuple
+import cv2
+import numpy as np
+from src.pyramid import expand, scale_rect
+
+# 輪郭の面積が画像に占める割合の範囲 (既定値)
+# 小さな領域 (文字など) と、画像全体を占める領域は除外する
+MIN_AREA = 0.01
+MAX_AREA = 0.99
+
+
+class Quads(NamedTuple):
+    # 近似した四角形の頂点 (輪郭の順)
+    points: np.ndarray
+    # 左上、右上、左下、右下
+    corners: np.ndarray
+    # 切り出す幅と高さ
+    sizes: np.ndarray
+    # corners を (0, 0) - sizes に写す透視変換行列
+    matrices: np.ndarray
+
+
+def contour_areas(contours: Sequence[np.ndarray]) -> np.ndarray:
+    # Python の関数を挟まずに、全ての輪郭の面積を1つの配列にする
+    return np.fromiter(
+        map(cv2.contourArea, contours), np.float64, len(contours))
+
+
+def filter_contours(
+        contours: Sequence[np.ndarray],
+        image_size: int,
+        min_area: float = MIN_AREA,
+        max_area: float = MAX_AREA) -> List[np.ndarray]:
+    # 面積で絞ってから、残ったものだけ多角形に近似する
+    areas = contour_areas(contours)
+    keep = (areas >= image_size * min_area) & (areas <= image_size * max_area)
+    return [contours[i] for i in np.flatnonzero(keep)]
+
+
+def find_contours(
+        gray: np.ndarray,
+        threshold: float = 0,
+        offset: Tuple[int, int] = (0, 0)) -> Tuple[float, List[np.ndarray]]:
+    # threshold が 0 なら大津の方法で決める
+    if threshold == 0:
+        threshold, thre = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
+    else:
+        _, thre = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(
+        thre, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    return threshold, list(contours)
+
+
+def refine_contours(
+        gray: np.ndarray,
+        contours: Sequence[np.ndarray],
+        scale: int,
+        threshold: float,
+        min_area: float = MIN_AREA,
+        max_area: float = MAX_AREA) -> List[np.ndarray]:
+    # 縮小した画像で見つけた領域の周りだけ、元の解像度で輪郭を取り直す
+    image_size = gray.shape[0] * gray.shape[1]
+    result = []
+    for c in contours:
+        x, y, w, h = expand(
+            scale_rect(cv2.boundingRect(c), scale), 2 * scale, gray.shape)
+        _, found = find_contours(
+            gray[y:y+h, x:x+w], threshold, offset=(x, y))
+        found = filter_contours(found, image_size, min_area, max_area)
+        # 取り直せなければ、縮小した画像での輪郭を拡大して使う
+        result.append(max(found, key=cv2.contourArea, default=c * scale))
+    return result
+
+
+def approx_quads(contours: Sequence[np.ndarray]) -> np.ndarray:
+    quads = []
+    for c in contours:
+        epsilon = 0.1 * cv2.arcLength(c, True)
+        approx = cv2.approxPolyDP(c, epsilon, True)
+        # 四角以外は無視する
+        if len(approx) == 4:
+            quads.append(approx.reshape(4, 2))
+    return np.array(quads, np.int32).reshape(-1, 4, 2)
+
+
+def order_corners(quads: np.ndarray) -> np.ndarray:
+    # 頂点は 左上、左下、右下、右上 の順。
+    # 右肩上がりの領域 (上の2点が右、左の順) では 右上、左上、左下、右下 の順
+    n = np.arange(len(quads))
+    top = np.argsort(quads[:, :, 1], axis=1, kind="stable")
+    swap = quads[n, top[:, 0], 0] > quads[n, top[:, 1], 0]
+    index = np.where(swap[:, None], [1, 0, 2, 3], [0, 3, 1, 2])
+    return np.take_along_axis(quads, index[:, :, None], axis=1)
+
+
+def corner_sizes(corners: np.ndarray) -> np.ndarray:
+    # 上の辺の長さを幅、左の辺の長さを高さにする
+    d = corners.astype(np.float64)
+    width = np.sqrt(((d[:, 0] - d[:, 1]) ** 2).sum(axis=1))
+    height = np.sqrt(((d[:, 0] - d[:, 2]) ** 2).sum(axis=1))
+    return np.stack([width, height], axis=1).astype(np.int64)
+
+
+def warp_matrices(corners: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    # cv2.getPerspectiveTransform と同じ連立方程式を、全ての四角形でまとめて解く
+    n = len(corners)
+    src = corners.astype(np.float64)
+    dst = np.zeros((n, 4, 2))
+    dst[:, [1, 3], 0] = sizes[:, :1]
+    dst[:, [2, 3], 1] = sizes[:, 1:]
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    a = np.zeros((n, 8, 8))
+    a[:, :4, 0] = x
+    a[:, :4, 1] = y
+    a[:, :4, 2] = 1
+    a[:, :4, 6] = -x * u
+    a[:, :4, 7] = -y * u
+    a[:, 4:, 3] = x
+    a[:, 4:, 4] = y
+    a[:, 4:, 5] = 1
+    a[:, 4:, 6] = -x * v
+    a[:, 4:, 7] = -y * v
+    b = np.concatenate([u, v], axis=1)[..., None]
+    try:
+        m = np.linalg.solve(a, b)[..., 0]
+    except np.linalg.LinAlgError:
+        # 潰れた四角形がある場合は、1つずつ求める
+        return np.array([
+            cv2.getPerspectiveTransform(np.float32(s), np.float32(d))
+            for s, d in zip(src, dst)]).reshape(n, 3, 3)
+    return np.concatenate([m, np.ones((n, 1))], axis=1).reshape(n, 3, 3)
+
+
+def find_quads(contours: Sequence[np.ndarray]) -> Quads:
+    points = approx_quads(contours)
+    corners = order_corners(points)
+    sizes = corner_sizes(corners)
+    return Quads(points, corners, sizes, warp_matrices(corners, sizes))
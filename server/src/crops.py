@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, List, Optional, Sequence, TypeVar
+import json
+import os
+import cv2
+import numpy as np
+
+# 切り出し画像の変形とエンコードを並列に行う数 (プロセス単位)
+CROP_WORKERS = int(os.environ.get("CROP_WORKERS", 4))
+
+# {"rect": [x, y, width, height]}
+# または {"quad": [左上, 右上, 左下, 右下], "size": [width, height]}
+# (quad には、求めてある場合は透視変換行列 "matrix" が付く)
+Crop = dict[str, Any]
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def rect_crop(x: int, y: int, width: int, height: int) -> Crop:
+    return {"rect": [int(x), int(y), int(width), int(height)]}
+
+
+def quad_crop(
+        src: Any,
+        width: int,
+        height: int,
+        matrix: Optional[np.ndarray] = None) -> Crop:
+    crop: Crop = {
+        "quad": [[float(v) for v in p] for p in src],
+        "size": [int(width), int(height)],
+    }
+    if matrix is not None:
+        crop["matrix"] = matrix.tolist()
+    return crop
+
+
+def apply_crop(img: np.ndarray, crop: Crop) -> np.ndarray:
+    if "rect" in crop:
+        x, y, w, h = crop["rect"]
+        return img[y:y+h, x:x+w]
+    w, h = crop["size"]
+    if "matrix" in crop:
+        M = np.float64(crop["matrix"])
+    else:
+        src = np.float32(crop["quad"])
+        dst = np.float32([[0, 0], [w, 0], [0, h], [w, h]])
+        M = cv2.getPerspectiveTransform(src, dst)
+    return cv2.warpPerspective(img, M, (w, h))
+
+
+class CropPool:
+    """
+    切り出し画像の変形と JPEG エンコードをスレッドに分けて行う。
+    OpenCV の処理中は GIL が外れるので、複数のコアを使える。
+    """
+
+    def __init__(self, workers: int = CROP_WORKERS) -> None:
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # fork 後の worker ではスレッドが引き継がれないので作り直す
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="crop")
+                self._pid = os.getpid()
+            return self._executor
+
+    def map(self, fn: Callable[[T], R], items: Sequence[T]) -> List[R]:
+        if self.workers <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        return list(self._get_executor().map(fn, items))
+
+
+def write_spec(path: str, spec: dict[str, Any]) -> None:
+    # 遅延生成する画像の、元画像と作り方
+    with open(path, "w") as f:
+        json.dump(spec, f)
+
+
+def read_spec(path: str) -> Optional[dict[str, Any]]:
+    try:
+        with open(path) as f:
+            spec: dict[str, Any] = json.load(f)
+            return spec
+    except FileNotFoundError:
+        return None
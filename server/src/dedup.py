@@ -0,0 +1,31 @@
+from typing import Any
+import hashlib
+import json
+
+CHUNK_SIZE = 1024 * 1024
+
+# 処理結果に影響しないリクエストのパラメータ
+IGNORED_PARAMS = {"task_id", "id", "async", "callback_url"}
+
+
+def content_hash(buf: Any) -> str:
+    return hashlib.sha256(buf).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def canonical_params(data: dict[str, Any]) -> str:
+    params = {k: v for k, v in data.items() if k not in IGNORED_PARAMS}
+    return json.dumps(params, sort_keys=True, separators=(",", ":"))
+
+
+def result_key(source_hash: str, name: str, data: dict[str, Any]) -> str:
+    # 同じ画像に同じ処理を同じパラメータでかけた結果は同じ
+    return content_hash("\0".join(
+        [source_hash, name, canonical_params(data)]).encode())
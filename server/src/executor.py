@@ -0,0 +1,250 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import copy_context
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+import importlib
+import os
+import numpy as np
+from src.metrics import begin_request, current_endpoint, observe, \
+    request_timings
+
+# action を実行する場所
+# inline: リクエストのスレッド、thread: スレッドプール、
+# process: モデルを読み込み済みのプロセスプール
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+BACKENDS = (INLINE, THREAD, PROCESS)
+# action ごとの実行場所 (例: "contours=process,ocr=thread")。指定がなければ inline
+EXEC_ROUTES = os.environ.get("EXEC_ROUTES", "")
+# thread / process で同時に実行する数 (worker プロセス単位)。
+# process の場合は、それぞれがモデルを読み込むので少なめにしておく
+EXEC_WORKERS = int(os.environ.get("EXEC_WORKERS", 2))
+
+Action = Callable[
+    [dict[str, Any], np.ndarray],
+    Tuple[np.ndarray, Optional[dict[str, Any]]]
+]
+
+
+def parse_routes(text: str) -> dict[str, str]:
+    routes = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        name, _, backend = item.partition("=")
+        if backend.strip() not in BACKENDS:
+            raise ValueError(f"unknown backend: {item}")
+        routes[name.strip()] = backend.strip()
+    return routes
+
+
+class SharedImage(NamedTuple):
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+def share(img: np.ndarray, size: int = 0) -> Tuple[SharedMemory, SharedImage]:
+    # 画像を pickle せず、共有メモリに置いて名前だけを渡す
+    shm = SharedMemory(create=True, size=max(1, size, img.nbytes))
+    view: np.ndarray = np.ndarray(img.shape, img.dtype, buffer=shm.buf)
+    view[...] = img
+    del view
+    return shm, SharedImage(shm.name, img.shape, img.dtype.str)
+
+
+def release(shm: SharedMemory) -> None:
+    shm.close()
+    shm.unlink()
+
+
+# プロセスプールの中で実行する action
+_actions: dict[str, Action] = {}
+_in_action_worker = False
+
+
+def in_action_worker() -> bool:
+    # プロセスプールの子プロセスで import されているかどうか。
+    # 子プロセスでは、モデルは起動時に全部ではなく使うものだけを読み込む
+    return _in_action_worker
+
+
+def _init_worker(
+        module: str,
+        registry: str,
+        threads: int,
+        names: List[str]) -> None:
+    global _in_action_worker
+    import torch
+
+    # 推論のスレッド数はプロセス同士で分け合う
+    torch.set_num_threads(threads)
+    _in_action_worker = True
+    mod = importlib.import_module(module)
+    _actions.update(getattr(mod, registry))
+    # この子プロセスで実行する action のモデルだけを、
+    # 最初のリクエストの前に読み込んでおく
+    loaders = getattr(mod, "ACTION_MODELS", {})
+    for name in names:
+        for load in loaders.get(name, []):
+            load()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _run_shared(
+        name: str,
+        data: dict[str, Any],
+        src: SharedImage,
+        out_name: str,
+        endpoint: str) -> Tuple[Any, Optional[dict[str, Any]], Any]:
+    # 処理時間は呼び出し元のプロセスに返して記録する
+    begin_request(endpoint)
+    shm = SharedMemory(name=src.name)
+    out_shm = SharedMemory(name=out_name)
+    try:
+        img: np.ndarray = np.ndarray(src.shape, src.dtype, buffer=shm.buf)
+        img.flags.writeable = False
+        result, params = _actions[name](data, img)
+        if result.nbytes <= out_shm.size:
+            out: np.ndarray = np.ndarray(
+                result.shape, result.dtype, buffer=out_shm.buf)
+            out[...] = result
+            del out
+            image: Any = SharedImage(out_name, result.shape, result.dtype.str)
+        else:
+            # 共有メモリに入らない大きさの結果は pickle で返す
+            image = np.array(result)
+        # 共有メモリを閉じる前に、参照している配列を消す
+        del img, result
+        return image, params, request_timings()
+    finally:
+        shm.close()
+        out_shm.close()
+
+
+class ActionExecutor:
+    """
+    filter の action を EXEC_ROUTES で指定した場所で実行する。
+    process の場合は、モデルを読み込み済みのプロセスで実行するので、
+    GIL を持つ Python の処理 (輪郭のループや NMS) も複数のコアで動く。
+    画像は共有メモリで受け渡す。
+    """
+
+    def __init__(
+            self,
+            routes: dict[str, str],
+            workers: int = EXEC_WORKERS,
+            module: str = "src.app",
+            registry: str = "ACTIONS") -> None:
+        self.routes = routes
+        self.workers = workers
+        self.module = module
+        self.registry = registry
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = Lock()
+
+    def backend(self, name: str) -> str:
+        return self.routes.get(name, INLINE)
+
+    def _check_pid(self) -> None:
+        # fork 後の worker ではスレッドもプロセスも引き継がれないので作り直す
+        if self._pid != os.getpid():
+            self._threads = None
+            self._processes = None
+            self._pid = os.getpid()
+
+    def _get_threads(self) -> ThreadPoolExecutor:
+        with self._lock:
+            self._check_pid()
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="action")
+            return self._threads
+
+    def _get_processes(self) -> ProcessPoolExecutor:
+        with self._lock:
+            self._check_pid()
+            if self._processes is None:
+                # torch などのスレッドを引き継がないよう、fork ではなく spawn する
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                names = [name for name, backend in self.routes.items()
+                         if backend == PROCESS]
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.module, self.registry, threads, names))
+            return self._processes
+
+    def warm(self) -> None:
+        # process で動かす action があれば、プロセスを起動して待つ
+        if PROCESS not in self.routes.values():
+            return
+        pool = self._get_processes()
+        wait([pool.submit(_ping) for _ in range(self.workers)])
+
+    def run(
+            self,
+            name: str,
+            action: Action,
+            data: dict[str, Any],
+            img: np.ndarray) -> Tuple[np.ndarray, Optional[dict[str, Any]]]:
+        backend = self.backend(name)
+        if backend == THREAD:
+            # 処理時間をリクエストに記録できるよう、context を引き継ぐ
+            ctx = copy_context()
+            return self._get_threads().submit(
+                ctx.run, action, data, img).result()
+        if backend == PROCESS:
+            return self._run_process(name, data, img)
+        return action(data, img)
+
+    def _run_process(
+            self,
+            name: str,
+            data: dict[str, Any],
+            img: np.ndarray) -> Tuple[np.ndarray, Optional[dict[str, Any]]]:
+        pool = self._get_processes()
+        shm, src = share(img)
+        # 描画した BGR の画像もそのまま入る大きさにしておく
+        out_shm = SharedMemory(
+            create=True, size=max(img.nbytes, img.shape[0] * img.shape[1] * 3))
+        try:
+            image, params, timings = pool.submit(
+                _run_shared, name, data, src, out_shm.name,
+                current_endpoint.get()).result()
+            if isinstance(image, SharedImage):
+                result: np.ndarray = np.ndarray(
+                    image.shape, image.dtype, buffer=out_shm.buf).copy()
+            else:
+                result = image
+        except BrokenProcessPool:
+            # 子プロセスが落ちた場合は、次の呼び出しでプールを作り直す
+            with self._lock:
+                if self._processes is pool:
+                    self._processes = None
+            raise
+        finally:
+            release(shm)
+            release(out_shm)
+        for stage_name, seconds in timings:
+            observe(stage_name, seconds)
+        return result, params
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pools: List[Any] = [self._threads, self._processes]
+            self._threads = None
+            self._processes = None
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown(wait=True)
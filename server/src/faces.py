@@ -0,0 +1,45 @@
+from typing import Any, List
+import numpy as np
+from src.pyramid import Rect, expand, scale_rect
+
+
+def detect_faces(
+        cascade: Any,
+        gray: np.ndarray,
+        min_size: int = 0) -> List[Rect]:
+    faces = cascade.detectMultiScale(
+        gray, 1.3, 5, minSize=(min_size, min_size))
+    return [(int(x), int(y), int(w), int(h)) for x, y, w, h in faces]
+
+
+def overlap(a: Rect, b: Rect) -> float:
+    w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / (a[2] * a[3] + b[2] * b[3] - inter)
+
+
+def refine_faces(
+        cascade: Any,
+        gray: np.ndarray,
+        faces: List[Rect],
+        scale: int) -> List[Rect]:
+    # 縮小した画像で見つけた顔の周りだけを、元の解像度で探し直す
+    result = []
+    for face in faces:
+        coarse = scale_rect(face, scale)
+        size = coarse[2]
+        x, y, w, h = expand(coarse, size // 4 + scale, gray.shape)
+        found = cascade.detectMultiScale(
+            gray[y:y+h, x:x+w], 1.1, 3,
+            minSize=(size * 2 // 3, size * 2 // 3),
+            maxSize=(size * 3 // 2, size * 3 // 2))
+        candidates: List[Rect] = [
+            (int(fx) + x, int(fy) + y, int(fw), int(fh))
+            for fx, fy, fw, fh in found]
+        # 見つからなければ、縮小した画像での位置をそのまま使う
+        result.append(max(
+            candidates, key=lambda r: overlap(r, coarse), default=coarse))
+    return result
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable, Optional
+import cv2
+import numpy as np
+
+
+def as_bgr(img: np.ndarray) -> np.ndarray:
+    # cv2.imread で読んだ時と同じ形 (BGR 3ch) に揃える
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
+
+def as_gray(img: np.ndarray) -> np.ndarray:
+    # 1ch の画像はそのまま返す
+    if img.ndim == 2:
+        return img
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+class ImageCache:
+    """
+    デコード済み画像の LRU キャッシュ。
+    保持している画像の合計バイト数が max_bytes を超えたら古いものから捨てる。
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._items: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            img = self._items.get(key)
+            if img is not None:
+                self._items.move_to_end(key)
+            return img
+
+    def put(self, key: Hashable, img: np.ndarray) -> None:
+        # 1枚で上限を超えるものはキャッシュしない
+        if img.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.nbytes
+            self._items[key] = img
+            self.current_bytes += img.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
@@ -0,0 +1,272 @@
+from threading import Lock, Thread
+from typing import Any, Collection, List, Optional, Tuple
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from src.job.image_gabege_collect import (INTERVAL, TASK_PATH,
+                                          TASK_TOTAL_MAX_BYTES)
+from src.metrics import read_dumps
+from src.task_index import TASK_INDEX_PATH, TaskIndex
+
+logger = logging.getLogger(__name__)
+
+DATA_PATH = os.path.dirname(TASK_INDEX_PATH)
+GC_METRICS_PATH = os.path.join(DATA_PATH, "gc_metrics.json")
+GC_LOCK_PATH = os.path.join(DATA_PATH, "gc.lock")
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(DATA_PATH, "metrics"))
+
+# 1回のスイープで索引から取り出すタスク数
+GC_BATCH_SIZE = int(os.environ.get("GC_BATCH_SIZE", 100))
+# 1秒あたりに消すファイル数の上限
+GC_UNLINK_RATE = float(os.environ.get("GC_UNLINK_RATE", 200))
+# スイープの間隔 (秒)
+GC_INTERVAL = float(os.environ.get("GC_INTERVAL", 60))
+# リクエストの処理時間 (EWMA) がこれを超えたら削除を待つ
+GC_LATENCY_THRESHOLD = float(os.environ.get(
+    "GC_LATENCY_THRESHOLD_MS", 200)) / 1000
+GC_MAX_BACKOFF = 30.0
+
+
+class LatencyMonitor:
+    """
+    リクエストの処理時間の指数移動平均。
+    しばらくリクエストが無ければ暇だとみなして 0 を返す。
+    """
+
+    def __init__(self, alpha: float = 0.1, stale: float = 10.0) -> None:
+        self.alpha = alpha
+        self.stale = stale
+        self.ewma = 0.0
+        self.updated_at = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.ewma += self.alpha * (seconds - self.ewma)
+        self.updated_at = time.monotonic()
+
+    def value(self) -> float:
+        if time.monotonic() - self.updated_at > self.stale:
+            return 0.0
+        return self.ewma
+
+
+class SharedLatencyMonitor(LatencyMonitor):
+    """
+    全 worker が metrics_dir に書き出したヒストグラムから、
+    前回読んでから増えたリクエストの平均処理時間を移動平均に加える。
+    ロックを持たない worker や、別プロセスの GC からも遅さが分かる。
+    """
+
+    def __init__(
+            self,
+            metrics_dir: str,
+            interval: float = 1.0,
+            alpha: float = 0.1,
+            stale: float = 10.0) -> None:
+        super().__init__(alpha, stale)
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self._read_at = -interval
+        self._totals: Optional[Tuple[float, float]] = None
+
+    def read_totals(self) -> Tuple[float, float]:
+        # 全 endpoint の total の件数と合計
+        count = seconds = 0.0
+        for (_, stage), v in read_dumps(self.metrics_dir):
+            if stage == "total":
+                count += v[-2]
+                seconds += v[-1]
+        return count, seconds
+
+    def value(self) -> float:
+        now = time.monotonic()
+        if now - self._read_at >= self.interval:
+            self._read_at = now
+            count, seconds = self.read_totals()
+            # worker が入れ替わって減った場合は、数え直しから始める
+            if self._totals is not None and count > self._totals[0]:
+                self.observe(
+                    (seconds - self._totals[1]) / (count - self._totals[0]))
+            self._totals = (count, seconds)
+        return super().value()
+
+
+class GarbageCollector:
+    """
+    期限切れのタスクを少しずつ消していく常駐版の GC。
+    ファイルの削除は unlink_rate 件/秒 に抑え、
+    リクエストが遅くなっている間は削除を止めて待つ。
+    """
+
+    def __init__(
+            self,
+            index: TaskIndex,
+            task_dir: str,
+            metrics_path: str,
+            monitor: Optional[LatencyMonitor] = None,
+            batch_size: int = GC_BATCH_SIZE,
+            unlink_rate: float = GC_UNLINK_RATE,
+            latency_threshold: float = GC_LATENCY_THRESHOLD) -> None:
+        self.index = index
+        self.task_dir = task_dir
+        self.metrics_path = metrics_path
+        self.monitor = monitor
+        self.batch_size = batch_size
+        self.unlink_rate = unlink_rate
+        self.latency_threshold = latency_threshold
+        self.metrics: dict[str, Any] = {
+            "sweeps": 0,
+            "tasks_expired": 0,
+            "files_removed": 0,
+            "bytes_freed": 0,
+            "backoff_seconds": 0.0,
+            "last_sweep_seconds": 0.0,
+            "last_sweep_at": None,
+        }
+
+    def _wait_for_idle(self) -> None:
+        if self.monitor is None:
+            return
+        backoff = 0.5
+        while self.monitor.value() > self.latency_threshold:
+            time.sleep(backoff)
+            self.metrics["backoff_seconds"] += backoff
+            backoff = min(backoff * 2, GC_MAX_BACKOFF)
+
+    def _remove_task(self, task_id: str, since: float) -> bool:
+        # rmtree で一気に消さず、1ファイルずつ間隔を空けて消す。
+        # 残ったディレクトリだけ最後にまとめて消す。
+        # 消している間に (since 以降に) 使われたタスクは、そこで止めて残す
+        interval = 1 / self.unlink_rate if self.unlink_rate > 0 else 0
+        path = os.path.join(self.task_dir, task_id)
+        for root, _, files in os.walk(path):
+            for name in files:
+                if self.index.touched_since(task_id, since):
+                    logger.info("%s was touched while removing", task_id)
+                    return False
+                file_path = os.path.join(root, name)
+                try:
+                    size = os.path.getsize(file_path)
+                    os.unlink(file_path)
+                except FileNotFoundError:
+                    continue
+                self.metrics["files_removed"] += 1
+                self.metrics["bytes_freed"] += size
+                time.sleep(interval)
+        if self.index.touched_since(task_id, since):
+            return False
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # 削除中に書き込まれたタスクは次のスイープに回す
+            logger.warning("failed to remove %s", path, exc_info=True)
+            return False
+        if not self.index.remove_untouched(task_id, since):
+            return False
+        self.metrics["tasks_expired"] += 1
+        return True
+
+    def _next_batch(self, failed: Collection[str]) -> List[str]:
+        # 消せなかったタスクは索引に残るので、その分多く取って飛ばす
+        task_ids = [
+            t for t in self.index.expired(
+                time.time() - INTERVAL,
+                limit=self.batch_size + len(failed))
+            if t not in failed]
+        if len(task_ids) == 0:
+            task_ids = self.index.over_quota(
+                TASK_TOTAL_MAX_BYTES, skip=failed)[:self.batch_size]
+        return task_ids[:self.batch_size]
+
+    def sweep(self) -> None:
+        start = time.monotonic()
+        failed: set[str] = set()
+        while True:
+            # 取り出した後に使われたタスクは消さない
+            since = time.time()
+            task_ids = self._next_batch(failed)
+            if len(task_ids) == 0:
+                break
+            for task_id in task_ids:
+                self._wait_for_idle()
+                if not self._remove_task(task_id, since):
+                    failed.add(task_id)
+        self.metrics["sweeps"] += 1
+        self.metrics["last_sweep_seconds"] = time.monotonic() - start
+        self.metrics["last_sweep_at"] = time.time()
+        self.write_metrics()
+
+    def write_metrics(self) -> None:
+        # どの worker からでも読めるようにファイルに書き出す
+        tmp = f"{self.metrics_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.metrics, f)
+        os.replace(tmp, self.metrics_path)
+
+    def run_forever(self, interval: float = GC_INTERVAL) -> None:
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("gc sweep failed")
+            time.sleep(interval)
+
+
+def read_metrics(metrics_path: str) -> Optional[dict[str, Any]]:
+    try:
+        with open(metrics_path) as f:
+            metrics: dict[str, Any] = json.load(f)
+            return metrics
+    except FileNotFoundError:
+        return None
+
+
+class GCDaemon:
+    """
+    アプリの中で GC を動かす。
+    全 worker がスレッドを立てるが、ロックファイルを取れた1つだけが削除する。
+    """
+
+    def __init__(self, collector: GarbageCollector, lock_path: str) -> None:
+        self.collector = collector
+        self.lock_path = lock_path
+        self._pid: Optional[int] = None
+        self._lock = Lock()
+
+    def ensure_started(self) -> None:
+        # fork 後の worker ではスレッドが引き継がれないので立て直す
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            Thread(target=self.run, name="gc", daemon=True).start()
+
+    def run(self) -> None:
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, "w") as lock:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    # 他の worker が GC 中。その worker が落ちたら引き継ぐ
+                    time.sleep(GC_INTERVAL)
+            self.collector.run_forever()
+
+
+if __name__ == "__main__":
+    # アプリとは別のプロセスとして動かす場合
+    # リクエストの処理時間は、worker が書き出したヒストグラムから読む
+    index = TaskIndex(TASK_INDEX_PATH)
+    GCDaemon(
+        GarbageCollector(
+            index, TASK_PATH, GC_METRICS_PATH,
+            SharedLatencyMonitor(METRICS_DIR)),
+        GC_LOCK_PATH).run()
@@ -1,7 +1,9 @@
-import glob
+import argparse
 import os
 import time
 import shutil
+from typing import List
+from src.task_index import TASK_INDEX_PATH, TaskIndex
 
 ROOT_PATH = os.path.dirname(
     os.path.dirname(
@@ -14,25 +16,31 @@ TASK_PATH = os.path.join(
 
 INTERVAL = 60 * 60  # 1時間
 
+# static/task 全体の上限 (0 なら無制限)
+TASK_TOTAL_MAX_BYTES = int(os.environ.get("TASK_TOTAL_MAX_BYTES", 0))
 
-def image_gabege_collect() -> None:
-    # 画像の一覧をとる
-    dirs = glob.glob(os.path.join(TASK_PATH, "*"))
 
-    for d in dirs:
-        # 更新時刻をとる
-        files = glob.glob(os.path.join(d, "*"))
+def remove_tasks(index: TaskIndex, task_ids: List[str]) -> None:
+    for task_id in task_ids:
+        shutil.rmtree(os.path.join(TASK_PATH, task_id), ignore_errors=True)
+    index.remove(task_ids)
 
-        if len(files) == 0:
-            shutil.rmtree(d)
-            continue
 
-        mtime = max([os.stat(f).st_mtime for f in files])
-
-        # 更新時刻が一定以上過去なら消す
-        if time.time() - mtime > INTERVAL:
-            shutil.rmtree(d)
+def image_gabege_collect(index: TaskIndex) -> None:
+    # 更新時刻が一定以上過去のタスクを索引から探す
+    remove_tasks(index, index.expired(time.time() - INTERVAL, limit=-1))
+    # それでも容量を超えている場合は新しいタスクも古い順に消す
+    remove_tasks(index, index.over_quota(TASK_TOTAL_MAX_BYTES))
 
 
 if __name__ == "__main__":
-    image_gabege_collect()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="static/task を走査して索引を作り直す")
+    args = parser.parse_args()
+
+    index = TaskIndex(TASK_INDEX_PATH)
+    if args.rebuild:
+        index.rebuild(TASK_PATH)
+    image_gabege_collect(index)
@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, List, Optional, Tuple
+from urllib.parse import urlparse
+from uuid import uuid4
+import glob
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import socket
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# 非同期ジョブを同時に処理する数 (プロセス単位)
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", 1))
+CALLBACK_TIMEOUT = 10
+# コールバックを送ってよいホスト (カンマ区切り)。
+# 空なら、グローバルなアドレスに名前解決されるホストにだけ送る
+CALLBACK_HOSTS = frozenset(
+    h.strip().lower()
+    for h in os.environ.get("CALLBACK_HOSTS", "").split(",") if h.strip())
+
+Job = dict[str, Any]
+
+
+def resolve_global(host: str, port: int) -> List[Tuple[Any, ...]]:
+    # ループバック、リンクローカル、プライベートのアドレスには送らない
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for info in infos:
+        address = ipaddress.ip_address(str(info[4][0]).split("%")[0])
+        if not address.is_global:
+            raise OSError(f"callback to non-global address: {address}")
+    return infos
+
+
+def _connect_global(
+        address: Tuple[str, int],
+        timeout: Any = socket._GLOBAL_DEFAULT_TIMEOUT,  # type: ignore
+        source_address: Any = None) -> socket.socket:
+    # 確認したアドレスに接続する。
+    # 確認の後で名前解決の結果が変わっても、内部のアドレスには繋がない
+    host, port = address
+    error: Optional[OSError] = None
+    for info in resolve_global(host, port):
+        try:
+            return socket.create_connection(
+                (info[4][0], port), timeout, source_address)
+        except OSError as e:
+            error = e
+    raise error or OSError(f"cannot resolve {host}")
+
+
+class _GlobalHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_global
+
+
+class _GlobalHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_global
+
+
+class _GlobalHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req: Any) -> Any:
+        return self.do_open(_GlobalHTTPConnection, req)
+
+
+class _GlobalHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req: Any) -> Any:
+        return self.do_open(_GlobalHTTPSConnection, req)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # リダイレクトで許可していないホストに送らない
+    def redirect_request(self, *args: Any, **kwargs: Any) -> None:
+        return None
+
+
+def callback_opener() -> urllib.request.OpenerDirector:
+    if CALLBACK_HOSTS:
+        return urllib.request.build_opener(_NoRedirect)
+    return urllib.request.build_opener(
+        _NoRedirect, _GlobalHTTPHandler, _GlobalHTTPSHandler)
+
+
+def is_callback_url(url: str) -> bool:
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    if CALLBACK_HOSTS:
+        return parsed.hostname in CALLBACK_HOSTS
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        resolve_global(parsed.hostname, port)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    重い処理 (OCR, カード検出) をリクエストと切り離して実行する。
+    状態はタスクのディレクトリに JSON で書き出すので、
+    どの worker プロセスからでも参照できる。
+    """
+
+    def __init__(self, root_dir: str, max_workers: int) -> None:
+        self.root_dir = root_dir
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # fork 後の worker ではスレッドが引き継がれないので作り直す
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="job")
+                self._pid = os.getpid()
+            return self._executor
+
+    def path(self, task_id: str, job_id: str) -> str:
+        return os.path.join(self.root_dir, task_id, "jobs", f"{job_id}.json")
+
+    def _read(self, path: str) -> Optional[Job]:
+        try:
+            with open(path) as f:
+                job: Job = json.load(f)
+                return job
+        except FileNotFoundError:
+            return None
+
+    def get(self, task_id: str, job_id: str) -> Optional[Job]:
+        job = self._read(self.path(task_id, job_id))
+        if job is not None:
+            # 実行している worker の pid は内部の情報なので返さない
+            job.pop("pid", None)
+        return job
+
+    def fail_orphans(self) -> int:
+        # キューはメモリにしかないので、終了した worker の
+        # queued / running のジョブは二度と進まない。起動時に failed にする
+        count = 0
+        pattern = os.path.join(self.root_dir, "*", "jobs", "*.json")
+        for path in glob.glob(pattern):
+            job = self._read(path)
+            if job is None or job["status"] not in ("queued", "running"):
+                continue
+            if is_alive(job.get("pid", 0)):
+                continue
+            job["status"] = "failed"
+            job["error"] = "worker exited before the job finished"
+            self._write(job)
+            count += 1
+        return count
+
+    def _write(self, job: Job) -> None:
+        path = self.path(job["task_id"], job["id"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書きかけの JSON を読まれないように置き換える
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp, path)
+
+    def submit(
+            self,
+            task_id: str,
+            fn: Callable[[], Any],
+            callback_url: Optional[str] = None) -> Job:
+        job: Job = {
+            "task_id": task_id,
+            "id": str(uuid4()),
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "pid": os.getpid(),
+        }
+        self._write(job)
+        self._get_executor().submit(self._run, dict(job), fn, callback_url)
+        job.pop("pid")
+        return job
+
+    def _run(
+            self,
+            job: Job,
+            fn: Callable[[], Any],
+            callback_url: Optional[str]) -> None:
+        job["status"] = "running"
+        self._write(job)
+        try:
+            job["result"] = fn()
+            job["status"] = "done"
+        except Exception as e:
+            logger.exception("job %s failed", job["id"])
+            job["status"] = "failed"
+            job["error"] = str(e)
+        self._write(job)
+        if callback_url:
+            self._callback(callback_url, job)
+
+    def _callback(self, url: str, job: Job) -> None:
+        job = {k: v for k, v in job.items() if k != "pid"}
+        req = urllib.request.Request(
+            url,
+            data=json.dumps({"result": {"job": job}}).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST")
+        # 受け付けた後に名前解決の結果が変わっても、接続する時に確かめ直す
+        try:
+            with callback_opener().open(req, timeout=CALLBACK_TIMEOUT):
+                pass
+        except OSError:
+            logger.warning("callback to %s failed", url, exc_info=True)
@@ -0,0 +1,218 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock, Thread, get_ident
+from typing import Any, Iterator, List, Optional, Tuple
+import glob
+import json
+import os
+import sys
+import time
+
+# 処理時間のヒストグラムのバケット (秒)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[str, str]
+
+
+class Histogram:
+    """
+    (endpoint, stage) ごとの処理時間の累積ヒストグラム。
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self._lock = Lock()
+        # labels -> [各バケットの件数..., 件数, 合計]
+        self.values: dict[Labels, List[float]] = {}
+
+    def observe(self, labels: Labels, seconds: float) -> None:
+        with self._lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, b in enumerate(self.buckets):
+                if seconds <= b:
+                    v[i] += 1
+            v[-2] += 1
+            v[-1] += seconds
+
+    def merge(self, values: dict[Labels, List[float]]) -> None:
+        with self._lock:
+            for labels, src in values.items():
+                v = self.values.setdefault(labels, [0] * len(src))
+                for i, x in enumerate(src):
+                    v[i] += x
+
+    def dump(self) -> List[Any]:
+        with self._lock:
+            return [[list(k), list(v)] for k, v in self.values.items()]
+
+    def render(self, name: str) -> List[str]:
+        lines = [f"# TYPE {name} histogram"]
+        with self._lock:
+            items = sorted(self.values.items())
+        for (endpoint, stage), v in items:
+            labels = f'endpoint="{endpoint}",stage="{stage}"'
+            for b, count in zip(self.buckets, v):
+                lines.append(f'{name}_bucket{{{labels},le="{b}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {v[-2]}')
+            lines.append(f"{name}_count{{{labels}}} {v[-2]}")
+            lines.append(f"{name}_sum{{{labels}}} {v[-1]}")
+        return lines
+
+
+stage_seconds = Histogram()
+
+# リクエスト中の endpoint と、段階ごとの処理時間
+current_endpoint: ContextVar[str] = ContextVar(
+    "current_endpoint", default="background")
+current_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar(
+    "current_timings", default=None)
+
+
+def begin_request(endpoint: str) -> None:
+    current_endpoint.set(endpoint)
+    current_timings.set([])
+
+
+def request_timings() -> List[Tuple[str, float]]:
+    return current_timings.get() or []
+
+
+def observe(name: str, seconds: float) -> None:
+    stage_seconds.observe((current_endpoint.get(), name), seconds)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def server_timing(timings: List[Tuple[str, float]]) -> str:
+    # 同じ段階が複数回ある (切り出し画像の保存など) 場合は合計する
+    total: dict[str, float] = {}
+    for name, seconds in timings:
+        total[name] = total.get(name, 0) + seconds
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in total.items())
+
+
+class MetricsStore:
+    """
+    worker プロセスごとのヒストグラムをファイルに書き出し、
+    /metrics ではどの worker が受けても全プロセス分を合算して返す。
+    """
+
+    def __init__(self, metrics_dir: str, interval: float = 5.0) -> None:
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self._dumped_at = 0.0
+
+    def path(self) -> str:
+        return os.path.join(self.metrics_dir, f"{os.getpid()}.json")
+
+    def dump(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._dumped_at < self.interval:
+            return
+        self._dumped_at = now
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        tmp = f"{self.path()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(stage_seconds.dump(), f)
+        os.replace(tmp, self.path())
+
+    def render(self) -> str:
+        self.dump(force=True)
+        merged = Histogram()
+        for labels, v in read_dumps(self.metrics_dir):
+            merged.merge({labels: v})
+        lines = merged.render("stage_duration_seconds")
+        return "\n".join(lines) + "\n"
+
+
+def read_dumps(metrics_dir: str) -> Iterator[Tuple[Labels, List[float]]]:
+    # 各 worker が書き出したヒストグラム
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        try:
+            with open(path) as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for k, v in values:
+            yield (k[0], k[1]), v
+
+
+class Sampler:
+    """
+    遅いリクエストを調べるためのサンプリングプロファイラ。
+    登録されたスレッドのスタックを interval 秒ごとに集め、
+    flamegraph.pl や speedscope で読める folded 形式で返す。
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self._stacks: dict[int, Counter[str]] = {}
+        self._lock = Lock()
+        self._pid: Optional[int] = None
+
+    def _ensure_thread(self) -> None:
+        # fork 後の worker ではスレッドが引き継がれないので立て直す
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        Thread(target=self._run, name="sampler", daemon=True).start()
+
+    def start(self) -> None:
+        with self._lock:
+            self._ensure_thread()
+            self._stacks[get_ident()] = Counter()
+
+    def stop(self) -> Counter[str]:
+        with self._lock:
+            return self._stacks.pop(get_ident(), Counter())
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[folded_stack(frame)] += 1
+
+
+def folded_stack(frame: Any) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}"
+            f":{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def write_profile(
+        profile_dir: str,
+        endpoint: str,
+        stacks: Counter[str]) -> str:
+    os.makedirs(profile_dir, exist_ok=True)
+    name = endpoint.strip("/").replace("/", "_") or "root"
+    path = os.path.join(
+        profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}"
+        f"-{os.getpid()}.folded")
+    with open(path, "w") as f:
+        for stack, count in stacks.items():
+            f.write(f"{stack} {count}\n")
+    return path
@@ -69,6 +69,33 @@ def create_modules(module_defs):
     return hyperparams, module_list
 
 
+def routed_layers(module_defs):
+    """Returns the indices of layers whose output is read by a route or shortcut layer"""
+    routs = set()
+    for i, module_def in enumerate(module_defs):
+        if module_def['type'] == 'route':
+            layers = [int(x) for x in module_def['layers'].split(',')]
+        elif module_def['type'] == 'shortcut':
+            layers = [int(module_def['from'])]
+        else:
+            continue
+        routs.update(layer if layer >= 0 else i + layer for layer in layers)
+    return routs
+
+
+def fuse_conv_and_bn(conv, bn):
+    """Returns a conv equivalent to conv followed by bn in eval mode"""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels,
+                      kernel_size=conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, bias=True)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
 class EmptyLayer(nn.Module):
     """Placeholder for 'route' and 'shortcut' layers"""
 
@@ -99,9 +126,10 @@ class YOLOLayer(nn.Module):
 
         # Build anchor grids
         nG = int(self.img_dim / stride)  # number grid points
-        self.grid_x = torch.arange(nG).repeat(
+        # not parameters: keep them on the cpu even when built on the meta device
+        self.grid_x = torch.arange(nG, device='cpu').repeat(
             nG, 1).view([1, 1, nG, nG]).float()
-        self.grid_y = torch.arange(nG).repeat(
+        self.grid_y = torch.arange(nG, device='cpu').repeat(
             nG, 1).t().view([1, 1, nG, nG]).float()
         self.scaled_anchors = torch.FloatTensor(
             [(a_w / stride, a_h / stride) for a_w, a_h in anchors])
@@ -135,7 +163,6 @@ class YOLOLayer(nn.Module):
         P4_x = p[..., 6]  # Point4 x
         P4_y = p[..., 7]  # Point4 y
 
-        pred_boxes = FT(bs, self.nA, nG, nG, 8)
         pred_conf = p[..., 8]  # Conf
         pred_cls = p[..., 9:]  # Class
 
@@ -146,6 +173,8 @@ class YOLOLayer(nn.Module):
             CrossEntropyLoss = nn.CrossEntropyLoss()
             SmoothL1Loss = nn.SmoothL1Loss()
 
+            pred_boxes = FT(bs, self.nA, nG, nG, 8)
+
             if requestPrecision:
                 gx = self.grid_x[:, :, :nG, :nG]
                 gy = self.grid_y[:, :, :nG, :nG]
@@ -206,14 +235,9 @@ class YOLOLayer(nn.Module):
             return loss, loss.item(), lconf.item(), lcls.item(), nT, TP, FP, FPe, FN, TC
 
         else:
-            pred_boxes[..., 0] = P1_x + self.grid_x
-            pred_boxes[..., 1] = P1_y + self.grid_y
-            pred_boxes[..., 2] = P2_x + self.grid_x
-            pred_boxes[..., 3] = P2_y + self.grid_y
-            pred_boxes[..., 4] = P3_x + self.grid_x
-            pred_boxes[..., 5] = P3_y + self.grid_y
-            pred_boxes[..., 6] = P4_x + self.grid_x
-            pred_boxes[..., 7] = P4_y + self.grid_y
+            # (x, y) grid offsets repeated for the 4 points: [1, 1, nG, nG, 8]
+            grid = torch.stack((self.grid_x, self.grid_y), 4).repeat(1, 1, 1, 1, 4)
+            pred_boxes = p[..., :8] + grid
 
             output = torch.cat((pred_boxes.view(bs, -1, 8) * stride,
                                 torch.sigmoid(pred_conf.view(bs, -1, 1)), pred_cls.view(bs, -1, self.nC)), -1)
@@ -232,6 +256,19 @@ class Darknet(nn.Module):
         self.img_size = img_size
         self.loss_names = ['loss', 'conf', 'cls',
                            'nT', 'TP', 'FP', 'FPe', 'FN', 'TC']
+        self.routs = routed_layers(self.module_defs)
+
+    def fuse(self):
+        """Folds every BatchNorm2d into the preceding conv (inference only)"""
+        for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
+            if module_def['type'] == 'convolutional' and int(module_def['batch_normalize']):
+                fused = nn.Sequential()
+                fused.add_module('conv_%d' % i, fuse_conv_and_bn(module[0], module[1]))
+                for name, layer in list(module.named_children())[2:]:
+                    fused.add_module(name, layer)
+                module_def['batch_normalize'] = 0
+                self.module_list[i] = fused
+        return self
 
     def forward(self, x, targets=None, requestPrecision=False):
         is_training = targets is not None
@@ -247,7 +284,7 @@ class Darknet(nn.Module):
                 x = torch.cat([layer_outputs[i] for i in layer_i], 1)
             elif module_def['type'] == 'shortcut':
                 layer_i = int(module_def['from'])
-                x = layer_outputs[-1] + layer_outputs[layer_i]
+                x = x + layer_outputs[layer_i]
             elif module_def['type'] == 'yolo':
                 # Train phase: get loss
                 if is_training:
@@ -259,7 +296,8 @@ class Darknet(nn.Module):
                 else:
                     x = module(x)
                 output.append(x)
-            layer_outputs.append(x)
+            # keep only the outputs a later route/shortcut reads, free the rest
+            layer_outputs.append(x if i in self.routs else None)
 
         if is_training:
             self.losses['nT'] /= 3
@@ -283,6 +321,23 @@ class Darknet(nn.Module):
         return sum(output) if is_training else torch.cat(output, 1)
 
 
+def export_inference_model(model, channels_last=False):
+    """
+    Returns a frozen TorchScript module of model for inference: batch norm is
+    folded into the convs and the graph is traced with a dynamic batch size.
+    The input must use channels_last memory format when channels_last is set.
+    """
+    model = model.fuse().eval()
+    device = next(model.parameters()).device
+    example = torch.zeros(1, 3, model.img_size, model.img_size, device=device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        example = example.contiguous(memory_format=torch.channels_last)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    return torch.jit.freeze(traced)
+
+
 def load_weights(self, weights_path, cutoff=-1):
     # Parses and loads the weights stored in 'weights_path'
     # @:param cutoff  - save layers between 0 and cutoff (cutoff = -1 -> all are saved)
@@ -290,17 +345,16 @@ def load_weights(self, weights_path, cutoff=-1):
     if weights_path.endswith('darknet53.conv.74'):
         cutoff = 75
 
-    # Open the weights file
-    fp = open(weights_path, 'rb')
+    # Memory-map the weights file instead of reading it into memory
     # First five are header values
-    header = np.fromfile(fp, dtype=np.int32, count=5)
+    header = np.fromfile(weights_path, dtype=np.int32, count=5)
 
     # Needed to write header when saving weights
     self.header_info = header
 
     self.seen = header[3]
-    weights = np.fromfile(fp, dtype=np.float32)  # The rest are weights
-    fp.close()
+    weights = np.memmap(weights_path, dtype=np.float32,
+                        mode='c', offset=header.nbytes)  # The rest are weights
 
     ptr = 0
     for i, (module_def, module) in enumerate(zip(self.module_defs[:cutoff], self.module_list[:cutoff])):
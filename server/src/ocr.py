@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, List, Optional, Tuple
+import os
+import cv2
+import numpy as np
+
+# 文字の検出を行う画像の長辺の上限 (EasyOCR の canvas_size の既定値)
+OCR_MAX_SIZE = int(os.environ.get("OCR_MAX_SIZE", 2560))
+# 切り出した文字の認識を並列に行う数 (プロセス単位)
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", 1))
+
+# x, y, width, height
+Region = Tuple[int, int, int, int]
+
+
+def parse_regions(
+        regions: List[dict[str, Any]],
+        shape: Tuple[int, ...]) -> List[Region]:
+    # /contours や /card_detection の結果をそのまま受け取る。
+    # points があれば四角形を囲む矩形にする
+    height, width = shape[:2]
+    rects = []
+    for r in regions:
+        if "points" in r:
+            points = np.array(r["points"], dtype=np.float32)
+            x0, y0 = points.min(0)
+            x1, y1 = points.max(0)
+        else:
+            x0, y0 = r["x"], r["y"]
+            x1, y1 = x0 + r["width"], y0 + r["height"]
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(np.ceil(x1)), width), min(int(np.ceil(y1)), height)
+        if x1 > x0 and y1 > y0:
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+    return rects
+
+
+def split(items: List[Any], n: int) -> List[List[Any]]:
+    # 順番を保ったまま n 個に分ける
+    size = -(-len(items) // n) if n > 0 else len(items)
+    return [items[i:i+size] for i in range(0, len(items), max(size, 1))]
+
+
+class TextReader:
+    """
+    EasyOCR の検出と認識を分けて呼ぶ。
+    検出は指定された領域だけを縮小して行い、
+    見つかった文字の認識はスレッドに分けて並列に行う。
+    """
+
+    def __init__(
+            self,
+            reader: Any,
+            workers: int = OCR_WORKERS,
+            loader: Optional[Callable[[], Any]] = None) -> None:
+        # reader が None なら、最初に使う時に loader で作る
+        self.reader = reader
+        self.workers = workers
+        self.loader = loader
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = Lock()
+
+    def load(self) -> Any:
+        with self._lock:
+            if self.reader is None and self.loader is not None:
+                self.reader = self.loader()
+            return self.reader
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # fork 後の worker ではスレッドが引き継がれないので作り直す
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="ocr")
+                self._pid = os.getpid()
+            return self._executor
+
+    def detect(
+            self,
+            rgb: np.ndarray,
+            regions: List[Region],
+            max_size: int) -> Tuple[List[Any], List[Any]]:
+        reader = self.load()
+        horizontal_list: List[Any] = []
+        free_list: List[Any] = []
+        for x, y, w, h in regions:
+            horizontal, free = reader.detect(
+                rgb[y:y+h, x:x+w], canvas_size=max_size, reformat=False)
+            # 領域内の座標を画像全体の座標に戻す
+            horizontal_list += [
+                [b[0] + x, b[1] + x, b[2] + y, b[3] + y]
+                for b in horizontal[0]]
+            free_list += [
+                [[p[0] + x, p[1] + y] for p in b] for b in free[0]]
+        return horizontal_list, free_list
+
+    def recognize(
+            self,
+            gray: np.ndarray,
+            horizontal_list: List[Any],
+            free_list: List[Any]) -> List[Any]:
+        reader = self.load()
+        # 横書きの枠、自由な枠の順に結果が並ぶのは、1回で呼んだ時と同じ
+        jobs = [(h, []) for h in split(horizontal_list, self.workers)] + \
+            [([], f) for f in split(free_list, self.workers)]
+        if len(jobs) <= 1 or self.workers <= 1:
+            if len(horizontal_list) + len(free_list) == 0:
+                return []
+            result: List[Any] = reader.recognize(
+                gray, horizontal_list, free_list, reformat=False)
+            return result
+        executor = self._get_executor()
+        futures = [executor.submit(
+            reader.recognize, gray, h, f, reformat=False)
+            for h, f in jobs]
+        return [r for future in futures for r in future.result()]
+
+    def read(
+            self,
+            img: np.ndarray,
+            regions: Optional[List[Region]] = None,
+            max_size: int = OCR_MAX_SIZE) -> List[Any]:
+        # ファイルから読んだ時と同じく、検出は RGB、認識はグレースケールで行う
+        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if regions is None:
+            regions = [(0, 0, img.shape[1], img.shape[0])]
+        horizontal_list, free_list = self.detect(rgb, regions, max_size)
+        return self.recognize(gray, horizontal_list, free_list)
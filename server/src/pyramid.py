@@ -0,0 +1,67 @@
+from typing import Callable, Hashable, Optional, Tuple
+import cv2
+import numpy as np
+from src.image_cache import ImageCache
+
+# x, y, width, height
+Rect = Tuple[int, int, int, int]
+
+
+def choose_level(
+        shape: Tuple[int, ...],
+        max_size: int,
+        min_size: int = 0,
+        window: int = 1) -> int:
+    # 長辺が max_size に収まるまで半分にする段数。
+    # ただし min_size の物体が検出器の window より小さくなるほどは縮めない
+    level = 0
+    size = max(shape[:2])
+    while max_size > 0 and size > max_size:
+        if min_size > 0 and min_size >> (level + 1) < window:
+            break
+        size = (size + 1) // 2
+        level += 1
+    return level
+
+
+def pyramid_level(
+        cache: ImageCache,
+        key: Optional[Hashable],
+        base: Callable[[], np.ndarray],
+        level: int) -> np.ndarray:
+    # 段数 0 が base で、1段ごとに縦横を半分にする。
+    # 各段は (key, 段数) でキャッシュし、同じ画像への後の処理で使い回す
+    if key is None:
+        img = base()
+        for _ in range(level):
+            img = cv2.pyrDown(img)
+        return img
+    found = level
+    cached = cache.get((key, found))
+    while cached is None and found > 0:
+        found -= 1
+        cached = cache.get((key, found))
+    if cached is None:
+        cached = base()
+        cache.put((key, 0), cached)
+    img = cached
+    while found < level:
+        img = cv2.pyrDown(img)
+        found += 1
+        cache.put((key, found), img)
+    return img
+
+
+def scale_rect(rect: Rect, scale: int) -> Rect:
+    x, y, w, h = rect
+    return (int(x) * scale, int(y) * scale, int(w) * scale, int(h) * scale)
+
+
+def expand(rect: Rect, margin: int, shape: Tuple[int, ...]) -> Rect:
+    # 縮小した画像での誤差を見込んで広げ、画像の中に収める
+    x, y, w, h = rect
+    x0 = max(0, x - margin)
+    y0 = max(0, y - margin)
+    x1 = min(shape[1], x + w + margin)
+    y1 = min(shape[0], y + h + margin)
+    return (x0, y0, x1 - x0, y1 - y0)
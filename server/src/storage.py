@@ -0,0 +1,68 @@
+from typing import Any, List, Optional
+import io
+import os
+import cv2
+import numpy as np
+
+# 保存する形式。jpg/webp は配布用、png は2値画像を劣化させずに小さく持つ、
+# npy は途中結果をデコードなしで mmap して読むためのもの
+FORMATS = ("jpg", "png", "webp", "npy")
+# 2値画像は png、それ以外は jpg にする
+AUTO = "auto"
+# 処理結果を保存する形式の既定値
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "jpg")
+# ファイルを返す時の Content-Type
+MIME_TYPES = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+    "npy": "application/octet-stream",
+}
+
+
+def is_format(fmt: Any) -> bool:
+    return fmt in FORMATS or fmt == AUTO
+
+
+def is_binary(img: np.ndarray) -> bool:
+    if img.ndim != 2 or img.dtype != np.uint8:
+        return False
+    return not np.any((img != 0) & (img != 255))
+
+
+def choose_format(fmt: str, img: np.ndarray) -> str:
+    if fmt == AUTO:
+        return "png" if is_binary(img) else "jpg"
+    return fmt
+
+
+def encode(img: np.ndarray, fmt: str) -> np.ndarray:
+    if fmt == "npy":
+        buf = io.BytesIO()
+        np.save(buf, np.ascontiguousarray(img), allow_pickle=False)
+        return np.frombuffer(buf.getbuffer(), np.uint8)
+    params: List[int] = []
+    if fmt == "png" and is_binary(img):
+        # 1画素1ビットで保存する
+        params = [cv2.IMWRITE_PNG_BILEVEL, 1]
+    _, buf = cv2.imencode(f".{fmt}", img, params)
+    return buf
+
+
+def read(path: str) -> Optional[np.ndarray]:
+    # 保存した時のチャンネル数と型のまま読む
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r", allow_pickle=False)
+    if path.endswith(".png"):
+        return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    # IMREAD_UNCHANGED では EXIF の向きが反映されないので使わない
+    return cv2.imread(path, cv2.IMREAD_ANYCOLOR)
+
+
+def find(base: str) -> Optional[str]:
+    # 拡張子を除いたパスから、保存されているファイルを探す
+    for fmt in FORMATS:
+        path = f"{base}.{fmt}"
+        if os.path.exists(path):
+            return path
+    return None
@@ -0,0 +1,281 @@
+from threading import local
+from typing import Any, Collection, Iterable, List, Optional
+import json
+import os
+import sqlite3
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(__file__))
+
+# タスクの作成・更新時刻とサイズの索引
+TASK_INDEX_PATH = os.environ.get(
+    "TASK_INDEX_PATH",
+    os.path.join(ROOT_PATH, "data", "task_index.sqlite3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    touched_at REAL NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    files INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_touched_at ON tasks (touched_at);
+CREATE TABLE IF NOT EXISTS images (
+    task_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (task_id, id)
+);
+CREATE TABLE IF NOT EXISTS results (
+    task_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (task_id, key)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_task_id ON blobs (task_id);
+"""
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TaskIndex:
+    """
+    static/task 以下のタスクごとの情報を SQLite に持つ。
+    GC はディレクトリを走査せずに touched_at の範囲検索で古いタスクを探す。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # 接続はスレッドごと、fork した場合はプロセスごとに作り直す
+        conn: Optional[sqlite3.Connection] = getattr(
+            self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def touch(
+            self,
+            task_id: str,
+            bytes: int = 0,
+            files: int = 0,
+            now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        self._conn().execute(
+            """
+            INSERT INTO tasks (task_id, created_at, touched_at, bytes, files)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (task_id) DO UPDATE SET
+                touched_at = excluded.touched_at,
+                bytes = bytes + excluded.bytes,
+                files = files + excluded.files
+            """,
+            (task_id, now, now, bytes, files))
+
+    def get(self, task_id: str) -> Optional[dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT task_id, created_at, touched_at, bytes, files"
+            " FROM tasks WHERE task_id = ?",
+            (task_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ("task_id", "created_at", "touched_at", "bytes", "files"), row))
+
+    def reserve(
+            self,
+            task_id: str,
+            bytes: int,
+            files: int,
+            max_bytes: int,
+            now: Optional[float] = None) -> None:
+        # 上限の確認と加算を 1 つの UPDATE で行い、
+        # 同じタスクへの同時の書き込みでも上限を超えないようにする
+        now = time.time() if now is None else now
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                """
+                INSERT INTO tasks
+                    (task_id, created_at, touched_at, bytes, files)
+                VALUES (?, ?, ?, 0, 0)
+                ON CONFLICT (task_id) DO NOTHING
+                """,
+                (task_id, now, now))
+            cur = conn.execute(
+                """
+                UPDATE tasks SET
+                    touched_at = ?,
+                    bytes = bytes + ?,
+                    files = files + ?
+                WHERE task_id = ? AND (? <= 0 OR bytes + ? <= ?)
+                """,
+                (now, bytes, files, task_id, max_bytes, bytes, max_bytes))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if cur.rowcount == 0:
+            conn.execute("ROLLBACK")
+            raise QuotaExceeded(f"task {task_id} exceeds {max_bytes} bytes")
+        conn.execute("COMMIT")
+
+    def expired(self, before: float, limit: int = 1000) -> List[str]:
+        # touched_at の索引を使った範囲検索
+        rows = self._conn().execute(
+            "SELECT task_id FROM tasks WHERE touched_at < ?"
+            " ORDER BY touched_at LIMIT ?",
+            (before, limit)).fetchall()
+        return [r[0] for r in rows]
+
+    def total_bytes(self) -> int:
+        row = self._conn().execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM tasks").fetchone()
+        return int(row[0])
+
+    def over_quota(
+            self,
+            max_bytes: int,
+            skip: Collection[str] = ()) -> List[str]:
+        # 全体の容量を超えている分だけ、古いものから返す。
+        # skip (消せなかったタスク) の分は、次に古いもので補う
+        excess = self.total_bytes() - max_bytes
+        task_ids: List[str] = []
+        if max_bytes <= 0 or excess <= 0:
+            return task_ids
+        rows = self._conn().execute(
+            "SELECT task_id, bytes FROM tasks ORDER BY touched_at")
+        for task_id, bytes in rows:
+            if excess <= 0:
+                break
+            if task_id in skip:
+                continue
+            task_ids.append(task_id)
+            excess -= bytes
+        return task_ids
+
+    def touched_since(self, task_id: str, since: float) -> bool:
+        row = self._conn().execute(
+            "SELECT touched_at FROM tasks WHERE task_id = ?",
+            (task_id,)).fetchone()
+        return row is not None and row[0] >= since
+
+    def remove_untouched(self, task_id: str, since: float) -> bool:
+        # since 以降に使われていなければ消す。消した場合は True
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.execute(
+            "DELETE FROM tasks WHERE task_id = ? AND touched_at < ?",
+            (task_id, since))
+        if cur.rowcount == 0:
+            conn.execute("ROLLBACK")
+            return False
+        for table in ("images", "results", "blobs"):
+            conn.execute(
+                f"DELETE FROM {table} WHERE task_id = ?", (task_id,))
+        conn.execute("COMMIT")
+        return True
+
+    def remove(self, task_ids: Iterable[str]) -> None:
+        conn = self._conn()
+        params = [(t,) for t in task_ids]
+        conn.execute("BEGIN")
+        for table in ("tasks", "images", "results", "blobs"):
+            conn.executemany(
+                f"DELETE FROM {table} WHERE task_id = ?", params)
+        conn.execute("COMMIT")
+
+    def image_hash(
+            self,
+            task_id: str,
+            id: str,
+            size: int,
+            mtime_ns: int) -> Optional[str]:
+        # ファイルが書き換わっていたら使わない
+        row = self._conn().execute(
+            "SELECT sha256 FROM images WHERE task_id = ? AND id = ?"
+            " AND size = ? AND mtime_ns = ?",
+            (task_id, id, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def set_image_hash(
+            self,
+            task_id: str,
+            id: str,
+            sha256: str,
+            size: int,
+            mtime_ns: int) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+            (task_id, id, sha256, size, mtime_ns))
+
+    def get_result(self, task_id: str, key: str) -> Optional[dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT result FROM results WHERE task_id = ? AND key = ?",
+            (task_id, key)).fetchone()
+        if row is None:
+            return None
+        result: dict[str, Any] = json.loads(row[0])
+        return result
+
+    def set_result(
+            self,
+            task_id: str,
+            key: str,
+            result: dict[str, Any]) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+            (task_id, key, json.dumps(result)))
+
+    def find_blob(self, sha256: str) -> Optional[str]:
+        row = self._conn().execute(
+            "SELECT path FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def set_blob(self, sha256: str, task_id: str, path: str) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+            (sha256, task_id, path))
+
+    def rebuild(self, task_dir: str) -> int:
+        # 索引を作る前からあるタスクを一度だけ走査して登録する
+        conn = self._conn()
+        if not os.path.exists(task_dir):
+            return 0
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM tasks")
+        count = 0
+        for entry in os.scandir(task_dir):
+            if not entry.is_dir():
+                continue
+            stats = [f.stat() for f in os.scandir(entry.path)
+                     if f.is_file()]
+            mtime = max([s.st_mtime for s in stats],
+                        default=entry.stat().st_mtime)
+            ctime = min([s.st_mtime for s in stats], default=mtime)
+            conn.execute(
+                "INSERT INTO tasks VALUES (?, ?, ?, ?, ?)",
+                (entry.name, ctime, mtime,
+                 sum(s.st_size for s in stats), len(stats)))
+            count += 1
+        conn.execute("COMMIT")
+        return count
@@ -0,0 +1,53 @@
+from typing import Any, IO
+import io
+import mmap
+import shutil
+import numpy as np
+
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+CHUNK_SIZE = 64 * 1024
+
+
+def upload_buffer(stream: IO[bytes]) -> Any:
+    # アップロードされたデータをコピーせずに参照する np.ndarray を返す
+    if isinstance(stream, io.BytesIO):
+        return np.frombuffer(stream.getbuffer(), np.uint8)
+    try:
+        # 大きいファイルは一時ファイルになっているので mmap する
+        fileno = stream.fileno()
+        return np.frombuffer(
+            mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), np.uint8)
+    except (AttributeError, OSError, ValueError):
+        stream.seek(0)
+        return np.frombuffer(stream.read(), np.uint8)
+
+
+def is_jpeg(head: bytes) -> bool:
+    # 拡張子ではなく、先頭のマーカーで判定する
+    return head[:len(JPEG_SIGNATURE)] == JPEG_SIGNATURE
+
+
+def read_head(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(len(JPEG_SIGNATURE))
+
+
+def append_stream(stream: IO[bytes], path: str, limit: int) -> int:
+    # メモリに全部載せずに、少しずつファイルの末尾に書き足す
+    with open(path, "ab") as f:
+        if f.tell() > limit:
+            raise ValueError("upload too large")
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if f.tell() + len(chunk) > limit:
+                raise ValueError("upload too large")
+            f.write(chunk)
+        return f.tell()
+
+
+def save_stream(stream: IO[bytes], path: str) -> None:
+    stream.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, CHUNK_SIZE)
@@ -71,6 +71,11 @@ def bbox_iou(box1, box2):
 	return iou.to(device)
 
 def reorganize_targets(t, nTb):
+	"""
+	Orders the corners of each target as top-left, top-right, bottom-right,
+	bottom-left: the two upper corners sorted by x ascending, the two lower
+	ones by x descending.
+	"""
 	t = t.float()
 	tc = t[:, 0]
 	t = t[:, 1:9].view(nTb, 4, 2)
@@ -78,181 +83,226 @@ def reorganize_targets(t, nTb):
 	x = t[..., 0]
 	y = t[..., 1]
 	y_sorted, y_indices = torch.sort(y)
-	
-	x_sorted = torch.zeros(nTb, 4)
-	for i in range(0, nTb):
-		x_sorted[i] = x[i, y_indices[i]]
+	x_sorted = torch.gather(x, 1, y_indices)
 
+	x_top, x_top_indices = torch.sort(x_sorted[:, :2])
+	x_bottom, x_bottom_indices = torch.sort(x_sorted[:, 2:4], descending=True)
+	y_top = torch.gather(y_sorted[:, :2], 1, x_top_indices)
+	y_bottom = torch.gather(y_sorted[:, 2:4], 1, x_bottom_indices)
 
-	x_sorted[:, :2], x_top_indices = torch.sort(x_sorted[:, :2])
-	x_sorted[:, 2:4], x_bottom_indices = torch.sort(x_sorted[:, 2:4], descending=True)
-	for i in range(0, nTb):
-		y_sorted[i, :2] = y_sorted[i, :2][x_top_indices[i]]
-		y_sorted[i, 2:4] = y_sorted[i, 2:4][x_bottom_indices[i]]
-
-	t = torch.cat((x_sorted[:,0].unsqueeze(1), y_sorted[:,0].unsqueeze(1), x_sorted[:,1].unsqueeze(1), y_sorted[:,1].unsqueeze(1), 
-					 x_sorted[:,2].unsqueeze(1), y_sorted[:,2].unsqueeze(1), x_sorted[:,3].unsqueeze(1), y_sorted[:,3].unsqueeze(1)), 1)
+	x = torch.cat((x_top, x_bottom), 1)
+	y = torch.cat((y_top, y_bottom), 1)
+	t = torch.stack((x, y), 2).view(nTb, 8)
 
 	return torch.cat((tc.unsqueeze(1), t), 1)
 
 
 def build_targets(pred_boxes, pred_conf, pred_cls, target, anchor_wh, nA, nC, nG, requestPrecision):
 	"""
-	returns nT, nCorrect, tx, ty, tw, th, tconf, tcls
+	returns t1_x, t1_y, ..., t4_x, t4_y, tconf, tcls, TP, FP, FN, TC
+
+	Targets of all images are assigned at once: anchor IoU is computed for every
+	target x anchor pair with polygon_iou and the target tensors are written with
+	a single index assignment.
 	"""
 	nB = len(target)  # number of images in batch
-	nT = [len(x) for x in target]  # torch.argmin(target[:, :, 4], 1)  # targets per batch
-	t1_x = torch.zeros(nB, nA, nG, nG)  # batch size (4), number of anchors (3), number of grid points (13)
-	t1_y = torch.zeros(nB, nA, nG, nG)
-	t2_x = torch.zeros(nB, nA, nG, nG)
-	t2_y = torch.zeros(nB, nA, nG, nG)
-	t3_x = torch.zeros(nB, nA, nG, nG)
-	t3_y = torch.zeros(nB, nA, nG, nG)
-	t4_x = torch.zeros(nB, nA, nG, nG)
-	t4_y = torch.zeros(nB, nA, nG, nG)	
-	tconf = torch.BoolTensor(nB, nA, nG, nG).fill_(0)
-	tcls = torch.ByteTensor(nB, nA, nG, nG, nC).fill_(0)  # nC = number of classes
-	TP = torch.ByteTensor(nB, max(nT)).fill_(0)
-	FP = torch.ByteTensor(nB, max(nT)).fill_(0)
-	FN = torch.ByteTensor(nB, max(nT)).fill_(0)
-	TC = torch.ShortTensor(nB, max(nT)).fill_(-1)  # target category
-	cuda = torch.cuda.is_available()
-	device = torch.device('cuda:0' if cuda else 'cpu')
+	nT = [len(x) for x in target]  # targets per batch
+	tbox = torch.zeros(nB, nA, nG, nG, 8)  # batch size (4), number of anchors (3), number of grid points (13)
+	tconf = torch.zeros(nB, nA, nG, nG, dtype=torch.bool)
+	tcls = torch.zeros(nB, nA, nG, nG, nC, dtype=torch.uint8)  # nC = number of classes
+	TP = torch.zeros(nB, max(nT), dtype=torch.uint8)
+	FP = torch.zeros(nB, max(nT), dtype=torch.uint8)
+	FN = torch.zeros(nB, max(nT), dtype=torch.uint8)
+	TC = torch.full((nB, max(nT)), -1, dtype=torch.int16)  # target category
+	outputs = tuple(tbox[..., k] for k in range(8)) + (tconf, tcls, TP, FP, FN, TC)
+
+	images = [b for b in range(nB) if nT[b] > 0]
+	if len(images) == 0:
+		return outputs
+
+	# image index and index within the image of every target
+	b_index = torch.cat([torch.full((nT[b],), b, dtype=torch.long) for b in images])
+	t_index = torch.cat([torch.arange(nT[b]) for b in images])
+	t = reorganize_targets(torch.cat([target[b].cpu().float() for b in images]), len(b_index))
+
+	FN[b_index, t_index] = 1
+	TC[b_index, t_index] = t[:, 0].short()
+
+	# Convert to position relative to box
+	gp = t[:, 1:9] * nG
+	# Get grid box indices and prevent overflows (i.e. 13.01 on 13 anchors)
+	gp_ij = torch.clamp(torch.round(gp).long(), min=0, max=nG - 1)
+
+	# Set target center in a certain cell
+	gp_x = gp[:, 0::2]
+	gp_y = gp[:, 1::2]
+	gp_x_center = torch.round((gp_x.min(1)[0] + gp_x.max(1)[0]) / 2)
+	gp_y_center = torch.round((gp_y.min(1)[0] + gp_y.max(1)[0]) / 2)
+
+	# Anchor boxes around each target center: [nTargets, nA, 8]
+	anchor_wh = anchor_wh.cpu()
+	x_min = torch.clamp(gp_x_center.unsqueeze(1) - anchor_wh[:, 0] / 2, min=0, max=nG - 1)
+	x_max = torch.clamp(gp_x_center.unsqueeze(1) + anchor_wh[:, 0] / 2, min=0, max=nG - 1)
+	y_min = torch.clamp(gp_y_center.unsqueeze(1) - anchor_wh[:, 1] / 2, min=0, max=nG - 1)
+	y_max = torch.clamp(gp_y_center.unsqueeze(1) + anchor_wh[:, 1] / 2, min=0, max=nG - 1)
+	anchor_boxes = torch.stack((x_min, y_min, x_max, y_min, x_max, y_max, x_min, y_max), 2)
+
+	iou_anch = polygon_iou(gp.unsqueeze(1), anchor_boxes)
+	# Select best iou_pred and anchor
+	iou_anch_best, a = iou_anch.max(1)  # best anchor [0-2] for each target
+
+	# Select best unique target-anchor combinations: within an image, each
+	# (corner cells, anchor) combination responds to the target with best iou
+	order = np.lexsort((-iou_anch_best.numpy(), b_index.numpy()))
+	u = torch.cat((b_index.unsqueeze(1), gp_ij, a.unsqueeze(1)), 1).numpy()
+	_, first_unique = np.unique(u[order], axis=0, return_index=True)
+	i = torch.from_numpy(order[first_unique])
+
+	# best anchor must share significant commonality (iou) with target
+	single = torch.tensor(nT)[b_index[i]] == 1
+	i = i[torch.where(single, iou_anch_best[i] >= 0.1, iou_anch_best[i] > 0.1)]
+	if len(i) == 0:
+		return outputs
+
+	b, a, tc, ti = b_index[i], a[i], t[i, 0].long(), t_index[i]
+	gx, gy = gp_x_center[i].long(), gp_y_center[i].long()
+
+	# Coordinates
+	center = torch.stack((gx, gy), 1).repeat(1, 4).float()
+	tbox[b, a, gy, gx] = gp[i] - center
+
+	# One-hot encoding of label
+	tcls[b, a, gy, gx, tc] = 1
+	tconf[b, a, gy, gx] = 1
+
+	if requestPrecision:
+		# predicted classes and confidence
+		pcls = torch.argmax(pred_cls[b, a, gy, gx], 1).cpu()
+		pconf = torch.sigmoid(pred_conf[b, a, gy, gx]).cpu()
+		iou_pred = polygon_iou(gp[i], pred_boxes[b, a, gy, gx].cpu())
+		tp = (pconf > 0.5) & (iou_pred > 0.5) & (pcls == tc)
+		TP[b, ti] = tp.byte()
+		FP[b, ti] = ((pconf > 0.5) & ~tp).byte()  # coordinates or class are wrong
+		FN[b, ti] = (pconf <= 0.5).byte()  # confidence score is too low (set to zero)
+	return outputs
+
+
+def quad_convex_hull(boxes):
+	"""
+	Returns the convex hull of each quadrilateral (..., 8) as 4 counter-clockwise
+	points (..., 4, 2). A corner lying inside the triangle of the other three is
+	replaced by its predecessor, leaving a zero-length edge.
+	"""
+	p = boxes.reshape(*boxes.shape[:-1], 4, 2).double()
+	c = p.mean(-2, keepdim=True)
+	angle = torch.atan2(p[..., 1] - c[..., 1], p[..., 0] - c[..., 0])
+	p = torch.gather(p, -2, angle.argsort(-1).unsqueeze(-1).expand_as(p))
 
-	for b in range(nB):
-		nTb = nT[b]  # number of targets per image
-		if nTb == 0:
-			continue
-		t = target[b]
-		FN[b, :nTb] = 1
-		t = reorganize_targets(t, nTb)
-		# Convert to position relative to box
-		TC[b, :nTb] = t[:, 0].long()
-		gp1_x, gp1_y = t[:, 1] * nG, t[:, 2] * nG
-		gp2_x, gp2_y = t[:, 3] * nG, t[:, 4] * nG
-		gp3_x, gp3_y = t[:, 5] * nG, t[:, 6] * nG
-		gp4_x, gp4_y = t[:, 7] * nG, t[:, 8] * nG
-		# Get grid box indices and prevent overflows (i.e. 13.01 on 13 anchors)
-		gp1_i, gp1_j = torch.clamp(torch.round(gp1_x).long(), min=0, max=nG - 1), torch.clamp(torch.round(gp1_y).long(), min=0, max=nG - 1)
-		gp2_i, gp2_j = torch.clamp(torch.round(gp2_x).long(), min=0, max=nG - 1), torch.clamp(torch.round(gp2_y).long(), min=0, max=nG - 1)
-		gp3_i, gp3_j = torch.clamp(torch.round(gp3_x).long(), min=0, max=nG - 1), torch.clamp(torch.round(gp3_y).long(), min=0, max=nG - 1)
-		gp4_i, gp4_j = torch.clamp(torch.round(gp4_x).long(), min=0, max=nG - 1), torch.clamp(torch.round(gp4_y).long(), min=0, max=nG - 1)
-
-		box1 = t[:, 1:9] * nG
-
-		# Get each target center
-		gp_x = torch.cat((gp1_x.unsqueeze(1), gp2_x.unsqueeze(1), gp3_x.unsqueeze(1), gp4_x.unsqueeze(1)), 1).view(-1, 4)
-		gp_y = torch.cat((gp1_y.unsqueeze(1), gp2_y.unsqueeze(1), gp3_y.unsqueeze(1), gp4_y.unsqueeze(1)), 1).view(-1, 4)
-
-		gp_x_min = torch.min(gp_x, 1)[0]
-		gp_x_max = torch.max(gp_x, 1)[0]
-		gp_y_min = torch.min(gp_y, 1)[0]
-		gp_y_max = torch.max(gp_y, 1)[0]
-
-		gp_x_center = torch.mean(torch.cat((gp_x_min.unsqueeze(1), gp_x_max.unsqueeze(1)), 1), 1)
-		gp_y_center = torch.mean(torch.cat((gp_y_min.unsqueeze(1), gp_y_max.unsqueeze(1)), 1), 1)
-		# Set target center in a certain cell
-		gp_x_center = torch.round(gp_x_center)
-		gp_y_center = torch.round(gp_y_center)
-
-		x_min = torch.clamp((gp_x_center.unsqueeze(1).repeat(1, nA).view(-1, nA, 1) - anchor_wh[:, 0].view(-1, nA, 1) / 2), min=0, max=nG-1)
-		x_max = torch.clamp((gp_x_center.unsqueeze(1).repeat(1, nA).view(-1, nA, 1) + anchor_wh[:, 0].view(-1, nA, 1) / 2), min=0, max=nG-1)
-		y_min = torch.clamp((gp_y_center.unsqueeze(1).repeat(1, nA).view(-1, nA, 1) - anchor_wh[:, 1].view(-1, nA, 1) / 2), min=0, max=nG-1)
-		y_max = torch.clamp((gp_y_center.unsqueeze(1).repeat(1, nA).view(-1, nA, 1) + anchor_wh[:, 1].view(-1, nA, 1) / 2), min=0, max=nG-1)
-
-		top_left = torch.cat((x_min.view(-1, 1), y_min.view(-1, 1)), 1)
-		top_right = torch.cat((x_max.view(-1, 1), y_min.view(-1, 1)), 1)
-		bottom_right = torch.cat((x_max.view(-1, 1), y_max.view(-1, 1)), 1)
-		bottom_left = torch.cat((x_min.view(-1, 1), y_max.view(-1, 1)), 1)
-		# Get bounding boxes
-		box2 = torch.cat((top_left, top_right, bottom_right, bottom_left), 1).view(-1, nA, 8)
-
-		iou_anch = torch.zeros(nA, nTb, 1)
-		for i in range(0, nTb):
-			for j in range(0, nA):
-				polygon1 = Polygon(box1[i,:].view(4,2)).convex_hull
-				polygon2 = Polygon(box2[i,j,:].view(4,2)).convex_hull
-				if polygon1.intersects(polygon2):
-					try:
-						inter_area = polygon1.intersection(polygon2).area
-						union_area = polygon1.union(polygon2).area
-						iou_anch[j, i] =  inter_area / union_area
-					except shapely.geos.TopologicalError:
-						print('shapely.geos.TopologicalError occured, iou set to 0')
-
-		iou_anch = iou_anch.squeeze(2)
-		# Select best iou_pred and anchor
-		iou_anch_best, a = iou_anch.max(0)  # best anchor [0-2] for each target
-		
-		# Select best unique target-anchor combinations
-		if nTb > 1:
-			iou_order = np.argsort(-iou_anch_best)  # best to worst
-
-			# Unique anchor selection (slower but retains original order)
-			u = torch.cat((gp1_i, gp1_j, gp2_i, gp2_j, gp3_i, gp3_j, gp4_i, gp4_j, a), 0).view(-1, nTb).cpu().numpy()
-			_, first_unique = np.unique(u[:, iou_order], axis=1, return_index=True)  # first unique indices; each cell response to on target
-			i = iou_order[first_unique]
-
-			# best anchor must share significant commonality (iou) with target
-			i = i[iou_anch_best[i] > 0.1]
-			if len(i) == 0:
-				continue
-
-			a, gp1_i, gp1_j, gp2_i, gp2_j, gp3_i, gp3_j, gp4_i, gp4_j, t = \
-			a[i], gp1_i[i], gp1_j[i], gp2_i[i], gp2_j[i], gp3_i[i], gp3_j[i], gp4_i[i], gp4_j[i], t[i]
-			if len(t.shape) == 1:
-				t = t.view(1, 5)
-		else:
-			if iou_anch_best < 0.1:
-				continue
-			i = 0
-
-		tc = t[:, 0].long()
-		gp1_x, gp1_y = t[:, 1] * nG, t[:, 2] * nG
-		gp2_x, gp2_y = t[:, 3] * nG, t[:, 4] * nG
-		gp3_x, gp3_y = t[:, 5] * nG, t[:, 6] * nG
-		gp4_x, gp4_y = t[:, 7] * nG, t[:, 8] * nG
-
-		# Get target center
-		gp_x = torch.cat((gp1_x.unsqueeze(1), gp2_x.unsqueeze(1), gp3_x.unsqueeze(1), gp4_x.unsqueeze(1)), 1).view(-1, 4)
-		gp_y = torch.cat((gp1_y.unsqueeze(1), gp2_y.unsqueeze(1), gp3_y.unsqueeze(1), gp4_y.unsqueeze(1)), 1).view(-1, 4)
-		gp_x_min = torch.min(gp_x, 1)[0]
-		gp_x_max = torch.max(gp_x, 1)[0]
-		gp_y_min = torch.min(gp_y, 1)[0]
-		gp_y_max = torch.max(gp_y, 1)[0]
-		gp_x_center = torch.mean(torch.cat((gp_x_min.unsqueeze(1), gp_x_max.unsqueeze(1)), 1), 1)
-		gp_y_center = torch.mean(torch.cat((gp_y_min.unsqueeze(1), gp_y_max.unsqueeze(1)), 1), 1)
-		# Set target center in a certain cell
-		gp_x_center = torch.round(gp_x_center).long()
-		gp_y_center = torch.round(gp_y_center).long()
-
-		# Coordinates
-		t1_x[b, a, gp_y_center, gp_x_center] = gp1_x.cpu() - gp_x_center.float().cpu()
-		t1_y[b, a, gp_y_center, gp_x_center] = gp1_y.cpu() - gp_y_center.float().cpu()
-		t2_x[b, a, gp_y_center, gp_x_center] = gp2_x.cpu() - gp_x_center.float().cpu()
-		t2_y[b, a, gp_y_center, gp_x_center] = gp2_y.cpu() - gp_y_center.float().cpu()
-		t3_x[b, a, gp_y_center, gp_x_center] = gp3_x.cpu() - gp_x_center.float().cpu()
-		t3_y[b, a, gp_y_center, gp_x_center] = gp3_y.cpu() - gp_y_center.float().cpu()
-		t4_x[b, a, gp_y_center, gp_x_center] = gp4_x.cpu() - gp_x_center.float().cpu()
-		t4_y[b, a, gp_y_center, gp_x_center] = gp4_y.cpu() - gp_y_center.float().cpu()
-
-		# One-hot encoding of label
-		tcls[b, a, gp_y_center, gp_x_center, tc] = 1
-		tconf[b, a, gp_y_center, gp_x_center] = 1
-
-		if requestPrecision:
-			# predicted classes and confidence
-			tb = torch.cat((gp1_x, gp1_y, gp2_x, gp2_y, gp3_x, gp3_y, gp4_x, gp4_y)).view(8, -1).t()
-			pcls = torch.argmax(pred_cls[b, a, gp_y_center, gp_x_center], 1).cpu()
-			pconf = torch.sigmoid(pred_conf[b, a, gp_y_center, gp_x_center].cpu()).cpu()
-			iou_pred = bbox_iou(tb, pred_boxes[b, a, gp_y_center, gp_x_center].cpu()).cpu()
-			TP[b, i] = ((pconf > 0.5) & (iou_pred > 0.5) & (pcls == tc.cpu())).byte()
-			FP[b, i] = ((pconf > 0.5) & (TP[b, i] == 0)).byte()  # coordinates or class are wrong
-			FN[b, i] = (pconf <= 0.5).byte()  # confidence score is too low (set to zero)
-	return t1_x, t1_y, t2_x, t2_y, t3_x, t3_y, t4_x, t4_y, tconf, tcls, TP, FP, FN, TC
+	prev = p.roll(1, -2)
+	nxt = p.roll(-1, -2)
+	turn = (p[..., 0] - prev[..., 0]) * (nxt[..., 1] - p[..., 1]) - \
+		(p[..., 1] - prev[..., 1]) * (nxt[..., 0] - p[..., 0])
+	return torch.where((turn < 0).unsqueeze(-1), prev, p)
+
+
+def polygon_area(p):
+	"""
+	Shoelace area of polygons (..., N, 2) given in counter-clockwise order
+	"""
+	q = p.roll(-1, -2)
+	return 0.5 * (p[..., 0] * q[..., 1] - q[..., 0] * p[..., 1]).sum(-1)
+
+
+def _clip_polygon(p, valid, a, b, max_points):
+	# Sutherland-Hodgman: keep the part of polygon p on the left of edge a->b.
+	# Unused slots of p hold a copy of the first vertex so that roll(-1) of the
+	# last valid vertex closes the polygon.
+	ab = (b - a).unsqueeze(-2)
+	ap = p - a.unsqueeze(-2)
+	d = ab[..., 0] * ap[..., 1] - ab[..., 1] * ap[..., 0]
+	p_next = p.roll(-1, -2)
+	d_next = d.roll(-1, -1)
+
+	inside = d >= 0
+	crossing = valid & (inside != (d_next >= 0))
+	t = torch.where(crossing, d / torch.where(crossing, d - d_next, torch.ones_like(d)), torch.zeros_like(d))
+	intersection = p + t.unsqueeze(-1) * (p_next - p)
+
+	# [p0, i0, p1, i1, ...] の順に並べ、有効な点を前に詰める
+	points = torch.stack((p, intersection), -2).flatten(-3, -2)
+	mask = torch.stack((valid & inside, crossing), -1).flatten(-2)
+	_, order = torch.sort((~mask).to(torch.uint8), dim=-1, stable=True)
+	order = order[..., :max_points]
+	points = torch.gather(points, -2, order.unsqueeze(-1).expand(*order.shape, 2))
+	mask = torch.gather(mask, -1, order)
+	points = torch.where(mask.unsqueeze(-1), points, points[..., :1, :])
+	return points, mask
+
+
+def hull_intersection_area(hull1, hull2, max_points=16):
+	"""
+	Intersection area of convex quadrilaterals hull1, hull2 (..., 4, 2), both
+	counter-clockwise (see quad_convex_hull). Shapes are broadcast.
+	"""
+	hull1, hull2 = torch.broadcast_tensors(hull1, hull2)
+	p = torch.cat((hull1, hull1[..., :1, :].expand(*hull1.shape[:-2], max_points - 4, 2)), -2)
+	valid = torch.zeros(p.shape[:-1], dtype=torch.bool)
+	valid[..., :4] = True
+	for k in range(4):
+		p, valid = _clip_polygon(p, valid, hull2[..., k, :], hull2[..., (k + 1) % 4, :], max_points)
+	return polygon_area(p).clamp(min=0)
+
+
+def polygon_iou(box1, box2):
+	"""
+	Returns the IoU of the convex hulls of quadrilaterals box1, box2 (..., 8).
+	Vectorized equivalent of the Shapely based bbox_iou; shapes are broadcast.
+	"""
+	hull1, hull2 = quad_convex_hull(box1.cpu()), quad_convex_hull(box2.cpu())
+	area1, area2 = polygon_area(hull1), polygon_area(hull2)
+	return _hull_iou(hull1, area1, hull2, area2)
+
+
+def _hull_iou(hull1, area1, hull2, area2):
+	inter = hull_intersection_area(hull1, hull2)
+	union = area1 + area2 - inter
+	ok = (area1 > 0) & (area2 > 0) & (union > 0)
+	return torch.where(ok, inter / torch.where(ok, union, torch.ones_like(union)), torch.zeros_like(union)).float()
 
 
 def bbox_iou_nms(box1, box2):
+	return polygon_iou(box1.unsqueeze(0), box2)
+
+
+def nms_quads(boxes, nms_thres):
+	"""
+	Greedy NMS over quadrilaterals (n, 8) already sorted by confidence.
+	Returns the indices of the kept boxes.
+	"""
+	hulls = quad_convex_hull(boxes.cpu())
+	areas = polygon_area(hulls)
+	lo = hulls.min(1)[0]
+	hi = hulls.max(1)[0]
+
+	keep = []
+	remaining = torch.arange(len(boxes))
+	while len(remaining):
+		best, remaining = remaining[0], remaining[1:]
+		keep.append(best)
+		# 外接矩形が重なるものだけ IoU を計算する
+		candidates = ((lo[remaining] < hi[best]) & (lo[best] < hi[remaining])).all(-1).nonzero(as_tuple=True)[0]
+		if len(candidates) == 0:
+			continue
+		c = remaining[candidates]
+		suppressed = candidates[_hull_iou(hulls[best], areas[best], hulls[c], areas[c]) >= nms_thres]
+		if len(suppressed):
+			mask = torch.ones(len(remaining), dtype=torch.bool)
+			mask[suppressed] = False
+			remaining = remaining[mask]
+	return torch.stack(keep)
+
+
+def bbox_iou_nms_shapely(box1, box2):
 	cuda = torch.cuda.is_available()
 	device = torch.device('cuda:0' if cuda else 'cpu')
 
@@ -274,7 +324,11 @@ def bbox_iou_nms(box1, box2):
 	return iou.to(device)
 
 
-def non_max_suppression(prediction, cls_thres=0.5, nms_thres=0.4):
+def non_max_suppression(prediction, cls_thres=0.5, nms_thres=0.4, use_shapely=False):
+	"""
+	Rotated-quadrilateral NMS. use_shapely=True runs the original per-box Shapely
+	IoU instead of the vectorized one (for verification).
+	"""
 	prediction = prediction.cpu()
 
 	output = [None for _ in range(len(prediction))]
@@ -308,17 +362,21 @@ def non_max_suppression(prediction, cls_thres=0.5, nms_thres=0.4):
 
 			max_detections = []
 
-			while detections_class.shape[0]:
-				# Get detection with highest confidence and save as max detection
-				max_detections.append(detections_class[0].unsqueeze(0))
-				# Stop if we're at the last detection
-				if len(detections_class) == 1:
-					break
-				# Get the IOUs for all boxes with lower confidence
-				ious = bbox_iou_nms(max_detections[-1].squeeze(0)[0:8], detections_class[1:][:, 0:8])
-
-				# Remove detections with IoU >= NMS threshold
-				detections_class = detections_class[1:][ious < nms_thres]
+			if use_shapely:
+				while detections_class.shape[0]:
+					# Get detection with highest confidence and save as max detection
+					max_detections.append(detections_class[0].unsqueeze(0))
+					# Stop if we're at the last detection
+					if len(detections_class) == 1:
+						break
+					# Get the IOUs for all boxes with lower confidence
+					ious = bbox_iou_nms_shapely(max_detections[-1].squeeze(0)[0:8], detections_class[1:][:, 0:8])
+
+					# Remove detections with IoU >= NMS threshold
+					detections_class = detections_class[1:][ious < nms_thres]
+			else:
+				keep = nms_quads(detections_class[:, 0:8], nms_thres)
+				max_detections = [detections_class[keep]]
 
 			if len(max_detections) > 0:
 				max_detections = torch.cat(max_detections).data
@@ -0,0 +1,52 @@
+import pytest
+from typing import Any
+
+# テスト用の小さな YOLO の設定 (入力 64px、出力 2x2 のグリッド)
+TINY_CFG = """
+[net]
+height=64
+width=64
+channels=3
+"""
+for filters, stride in [(8, 2), (16, 2), (16, 2), (32, 2), (32, 2)]:
+    TINY_CFG += f"""
+[convolutional]
+batch_normalize=1
+filters={filters}
+size=3
+stride={stride}
+pad=1
+activation=leaky
+"""
+TINY_CFG += """
+[convolutional]
+batch_normalize=1
+filters=32
+size=1
+stride=1
+pad=1
+activation=leaky
+
+[shortcut]
+from=-2
+activation=linear
+
+[convolutional]
+size=1
+stride=1
+pad=1
+filters=39
+activation=linear
+
+[yolo]
+mask = 6,7,8
+anchors = 10,13,16,30,33,23,30,61,62,45,59,119,116,90,156,198,373,326
+classes=4
+"""
+
+
+@pytest.fixture
+def tiny_cfg(tmp_path: Any) -> str:
+    path = tmp_path / "tiny.cfg"
+    path.write_text(TINY_CFG)
+    return str(path)
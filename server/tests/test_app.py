@@ -1,8 +1,15 @@
+import cv2
+import io
+import numpy as np
 import os
 import pytest
 import shutil
+import time
 from typing import Any
-from src.app import app, image_path
+from src import executor
+from src.app import (TASK_DIR, app, gray_level, image_path, image_cache,
+                     task_index)
+from src.job.gc_daemon import GarbageCollector
 
 client = app.test_client()
 task_id = "test"
@@ -25,12 +32,104 @@ def test_upload_image() -> None:
     assert res.status_code == 400
     assert res.get_json() == {'error': 'required upload file'}
 
-    # TODO
-    # filename not exists test
-    # success test
+    cur = os.path.dirname(__file__)
+    res = client.post("/upload_image", data={
+        "uploadFile": (io.BytesIO(b"not an image"), "a.jpg")})
+    assert res.status_code == 400
+    assert res.get_json() == {'error': 'invalid image'}
+    res = client.post("/upload_image", data={
+        "uploadFile": (io.BytesIO(b""), "a.jpg")})
+    assert res.status_code == 400
+    assert res.get_json() == {'error': 'invalid image'}
+
+    # JPEG はそのまま保存される
+    with open(f"{cur}/img/lena.jpg", "rb") as f:
+        body = f.read()
+    res = client.post("/upload_image", data={
+        "uploadFile": (io.BytesIO(body), "lena.jpg")})
+    assert res.status_code == 200
+    image = res.get_json()["result"]["image"]
+    path = image_path(image["task_id"], image["id"])
+    with open(path, "rb") as f:
+        assert f.read() == body
+    shutil.rmtree(os.path.dirname(path))
+
+
+def test_upload_dedup() -> None:
+    cur = os.path.dirname(__file__)
+    with open(f"{cur}/img/lena.jpg", "rb") as f:
+        body = f.read()
+    images = []
+    for _ in range(2):
+        res = client.post("/upload_image", data={
+            "uploadFile": (io.BytesIO(body), "lena.jpg")})
+        images.append(res.get_json()["result"]["image"])
+    # 2 回目はハードリンクなので、容量に数えない
+    first = task_index.get(images[0]["task_id"])
+    second = task_index.get(images[1]["task_id"])
+    assert first is not None and first["bytes"] == len(body)
+    assert second is not None and second["bytes"] == 0
+    assert second["files"] == 1
+    for image in images:
+        shutil.rmtree(os.path.dirname(
+            image_path(image["task_id"], image["id"])))
+
+
+def test_chunked_upload() -> None:
+    cur = os.path.dirname(__file__)
+    with open(f"{cur}/img/lena.jpg", "rb") as f:
+        body = f.read()
+    res = client.post("/upload_image/chunked")
+    upload = res.get_json()["result"]
+    assert upload["offset"] == 0
+    url = f"/upload_image/chunked/{upload['task_id']}/{upload['id']}"
+
+    half = len(body) // 2
+    res = client.put(f"{url}?offset=0", data=body[:half])
+    assert res.get_json()["result"]["offset"] == half
+    # offset がずれていたらエラー
+    res = client.put(f"{url}?offset=0", data=body[half:])
+    assert res.status_code == 400
+    res = client.put(f"{url}?offset={half}", data=body[half:])
+    assert res.get_json()["result"]["offset"] == len(body)
+
+    res = client.post(f"{url}/complete")
+    image = res.get_json()["result"]["image"]
+    path = image_path(image["task_id"], image["id"])
+    with open(path, "rb") as f:
+        assert f.read() == body
+    shutil.rmtree(os.path.dirname(path))
+
+    # 何も送らずに完了した場合
+    upload = client.post("/upload_image/chunked").get_json()["result"]
+    url = f"/upload_image/chunked/{upload['task_id']}/{upload['id']}"
+    res = client.post(f"{url}/complete")
+    assert res.status_code == 400
+    assert res.get_json() == {'error': 'invalid image'}
+
+
+def test_abandoned_chunked_upload(tmp_path: Any) -> None:
+    res = client.post("/upload_image/chunked")
+    upload = res.get_json()["result"]
+    url = f"/upload_image/chunked/{upload['task_id']}/{upload['id']}"
+    res = client.put(f"{url}?offset=0", data=b"x" * 100)
+    assert res.get_json()["result"]["offset"] == 100
+    # 書きかけのファイルも容量に数える
+    task = task_index.get(upload["task_id"])
+    assert task is not None and task["bytes"] == 100
+
+    # complete されずに放置されたアップロードは GC で消える
+    task_index.touch(upload["task_id"], now=0)
+    collector = GarbageCollector(
+        task_index, TASK_DIR, str(tmp_path / "gc.json"), unlink_rate=0)
+    collector.sweep()
+    assert not os.path.exists(os.path.join(TASK_DIR, upload["task_id"]))
+    assert task_index.get(upload["task_id"]) is None
 
 
 def clear_image() -> None:
+    # 同じ id に別の画像をコピーするので、キャッシュも消しておく
+    image_cache.clear()
     path = image_path(task_id, id)
     if os.path.exists(os.path.dirname(path)):
         shutil.rmtree(os.path.dirname(path))
@@ -68,6 +167,40 @@ def test_grayscale() -> None:
     }
 
 
+def test_dedup() -> None:
+    image = copy_image()
+    first = client.post("/grayscale", json=image).get_json()
+    second = client.post("/grayscale", json=image).get_json()
+    assert first == second
+
+    res = client.post("/threshold", json={**image, "threshold": 100})
+    other = client.post("/threshold", json={**image, "threshold": 101})
+    assert res.get_json() != other.get_json()
+
+
+def test_async_job() -> None:
+    res = client.post("/grayscale", json={**copy_image(), "async": True})
+    assert res.status_code == 202
+    job = res.get_json()["result"]["job"]
+    assert job["status"] == "queued"
+
+    for _ in range(100):
+        res = client.get(f"/jobs/{task_id}/{job['id']}")
+        job = res.get_json()["result"]["job"]
+        if job["status"] == "done":
+            break
+        time.sleep(0.05)
+    assert job["status"] == "done"
+    assert job["result"]["image"]["width"] == 512
+
+    res = client.post("/ocr", json={
+        **copy_image(), "async": True, "callback_url": "ftp://example.com"})
+    assert res.status_code == 400
+    res = client.post("/ocr", json={
+        **copy_image(), "async": True, "callback_url": "http://127.0.0.1/"})
+    assert res.status_code == 400
+
+
 def test_threshold() -> None:
     res = client.post("/threshold", json=copy_image())
     assert res.status_code == 200
@@ -91,6 +224,30 @@ def test_threshold() -> None:
     # TODO threshold指定パターン
 
 
+def test_format() -> None:
+    # 2値画像は png で、1ch のまま保存する
+    res = client.post("/threshold", json={**copy_image(), "format": "auto"})
+    assert res.status_code == 200
+    image = res.get_json()["result"]["image"]
+    assert image["format"] == "png"
+    image_cache.clear()
+    res = client.post("/bitwise_not", json={
+        "task_id": task_id, "id": image["id"], "format": "npy"})
+    assert res.status_code == 200
+    image = res.get_json()["result"]["image"]
+    assert image["format"] == "npy"
+    assert os.path.exists(image_path(task_id, image["id"], "npy"))
+
+    res = client.post("/grayscale", json={
+        "task_id": task_id, "id": image["id"]})
+    assert res.status_code == 200
+    assert "format" not in res.get_json()["result"]["image"]
+
+    res = client.post("/grayscale", json={**copy_image(), "format": "gif"})
+    assert res.status_code == 400
+    assert res.get_json() == {"error": "unknown format: gif"}
+
+
 def test_face_detection() -> None:
     res = client.post("/face_detection", json=copy_image())
 
@@ -123,6 +280,76 @@ def test_face_detection() -> None:
     }
 
 
+def test_gray_level_in_action_worker(monkeypatch: Any) -> None:
+    img = np.zeros((64, 64, 3), np.uint8)
+    gray_level({"task_id": task_id, "id": id}, img, 1)
+    assert len(image_cache) == 2
+    # action の子プロセスで作った段は呼び出し元に戻らないので、キャッシュしない
+    image_cache.clear()
+    monkeypatch.setattr(executor, "_in_action_worker", True)
+    assert gray_level({"task_id": task_id, "id": id}, img, 1).shape == (32, 32)
+    assert len(image_cache) == 0
+
+
+def test_lazy_crops() -> None:
+    res = client.post("/face_detection", json={
+        **copy_image(), "lazy_crops": True})
+
+    assert res.status_code == 200
+    face = res.get_json()["result"]["params"]["faces"][0]
+    assert face["url"] == f"/crops/{task_id}/{face['id']}"
+    # 取りに来るまで切り出さない
+    assert not os.path.exists(image_path(task_id, face["id"]))
+
+    res = client.get(face["url"])
+    assert res.status_code == 200
+    assert res.mimetype == "image/jpeg"
+    img = cv2.imdecode(np.frombuffer(res.data, np.uint8), cv2.IMREAD_COLOR)
+    assert img.shape == (171, 171, 3)
+    assert os.path.exists(image_path(task_id, face["id"]))
+
+    # 切り出した画像もそのまま他の処理に使える
+    image_cache.clear()
+    res = client.post("/grayscale", json={
+        "task_id": task_id, "id": face["id"]})
+    assert res.status_code == 200
+
+    assert client.get(f"/crops/{task_id}/nothing").status_code == 400
+
+
+def test_overlay() -> None:
+    res = client.post("/face_detection", json=copy_image())
+    overlay = res.get_json()["result"]["image"]
+
+    # 検出結果だけを返し、描画は取りに来た時に行う
+    res = client.post("/face_detection", json={
+        **copy_image(), "overlay": False})
+    assert res.status_code == 200
+    result = res.get_json()["result"]
+    assert len(result["params"]["faces"]) == 1
+    image = result["image"]
+    assert image["url"] == f"/render/{task_id}/{image['id']}"
+    assert not os.path.exists(image_path(task_id, image["id"]))
+
+    res = client.get(image["url"])
+    assert res.status_code == 200
+    assert os.path.exists(image_path(task_id, image["id"]))
+    img = cv2.imdecode(np.frombuffer(res.data, np.uint8), cv2.IMREAD_COLOR)
+    expected = cv2.imread(image_path(task_id, overlay["id"]))
+    assert np.array_equal(img, expected)
+
+    # 指定した形式で描画して返す
+    res = client.post("/face_detection", json={
+        **copy_image(), "overlay": False, "format": "png"})
+    image = res.get_json()["result"]["image"]
+    assert image["format"] == "png"
+    res = client.get(image["url"])
+    assert res.status_code == 200
+    assert res.mimetype == "image/png"
+    assert os.path.exists(image_path(task_id, image["id"], "png"))
+    assert not os.path.exists(image_path(task_id, image["id"]))
+
+
 def test_ocr() -> None:
     res = client.post("/ocr", json=copy_image("japanese.jpg"))
 
@@ -195,8 +422,97 @@ def test_ocr() -> None:
     }
 
 
+def test_ocr_regions() -> None:
+    # 指定した領域の中だけを読む
+    res = client.post("/ocr", json={
+        **copy_image("japanese.jpg"),
+        "regions": [{"x": 60, "y": 40, "width": 440, "height": 130}],
+        "max_size": 640,
+    })
+
+    assert res.status_code == 200
+    texts = res.get_json()["result"]["params"]["texts"]
+    assert len(texts) > 0
+    for text in texts:
+        image = text["image"]
+        assert 60 <= image["x"] and image["x"] + image["width"] <= 500
+        assert 40 <= image["y"] and image["y"] + image["height"] <= 170
+
+
+def test_contours_params() -> None:
+    # null は既定値を使う
+    res = client.post("/contours", json={**copy_image(), "min_area": None})
+    assert res.status_code == 200
+
+    for params, error in [
+            ({"min_area": "abc"}, "min_area and max_area must be numbers"),
+            ({"max_area": [1]}, "min_area and max_area must be numbers"),
+            ({"min_area": -0.1},
+             "min_area and max_area must be between 0 and 1"),
+            ({"max_area": 2}, "min_area and max_area must be between 0 and 1"),
+    ]:
+        res = client.post("/contours", json={**copy_image(), **params})
+        assert res.status_code == 400
+        assert res.get_json() == {"error": error}
+
+    res = client.post("/pipeline", json={
+        **copy_image(),
+        "operations": [{"name": "contours", "params": {"max_area": 2}}]
+    })
+    assert res.status_code == 400
+
+
 def test_card_detection():
     res = client.post("/card_detection", json=copy_image("29.jpg"))
     assert res.status_code == 200
     data = res.get_json()
     print(data)
+
+
+def test_pipeline() -> None:
+    res = client.post("/pipeline", json={
+        **copy_image(),
+        "operations": [
+            {"name": "grayscale"},
+            {"name": "threshold", "save": True},
+            {"name": "bitwise_not"},
+        ]
+    })
+    assert res.status_code == 200
+    data = res.get_json()
+    steps = data["result"]["steps"]
+    assert [s["name"] for s in steps] == [
+        "grayscale", "threshold", "bitwise_not"]
+    assert steps[0]["image"] is None
+    assert steps[1]["image"]["id"]
+    assert steps[1]["params"] == {"threshold": "117"}
+    assert steps[2]["image"] == data["result"]["image"]
+    assert os.path.exists(image_path(task_id, steps[2]["image"]["id"]))
+
+    # OCR は途中結果をファイルに書き出さずに、そのまま受け取る
+    res = client.post("/pipeline", json={
+        **copy_image("japanese.jpg"),
+        "operations": [{"name": "blur"}, {"name": "ocr"}]
+    })
+    assert res.status_code == 200
+    steps = res.get_json()["result"]["steps"]
+    assert steps[0]["image"] is None
+    assert len(steps[1]["params"]["texts"]) > 0
+
+    res = client.post("/pipeline", json={
+        **copy_image(),
+        "operations": [{"name": "unknown"}]
+    })
+    assert res.status_code == 400
+    assert res.get_json() == {'error': 'unknown operation: unknown'}
+
+    # 形の違う operations は 400
+    for operations, error in [
+            ("grayscale", "operations must be a list"),
+            (["grayscale"], "each operation must be an object"),
+            ([{"name": "blur", "params": [3]}], "params must be an object"),
+    ]:
+        res = client.post("/pipeline", json={
+            **copy_image(), "operations": operations})
+        assert res.status_code == 400
+        assert res.get_json() == {"error": error}
@@ -0,0 +1,106 @@
+import asyncio
+from flask import Flask, Response, jsonify, request
+from typing import Any, Iterator, List
+from src.async_server import AsyncWSGIAdapter
+
+app = Flask(__name__)
+
+
+@app.route("/echo", methods=["POST"])
+def echo() -> Any:
+    return jsonify({"size": len(request.get_data()),
+                    "type": request.content_type,
+                    "q": request.args.get("q")})
+
+
+@app.route("/stream")
+def stream() -> Any:
+    def generate() -> Iterator[bytes]:
+        yield b"a"
+        yield b"b"
+    return Response(generate())
+
+
+def call(adapter: AsyncWSGIAdapter, scope: dict[str, Any],
+         messages: List[dict[str, Any]]) -> List[dict[str, Any]]:
+    sent: List[dict[str, Any]] = []
+
+    async def receive() -> dict[str, Any]:
+        return messages.pop(0)
+
+    async def send(message: dict[str, Any]) -> None:
+        sent.append(message)
+
+    asyncio.run(adapter(scope, receive, send))
+    return sent
+
+
+def http_scope(method: str, path: str, query: bytes = b"") -> dict[str, Any]:
+    return {"type": "http", "method": method, "path": path,
+            "query_string": query, "headers": [
+                (b"content-type", b"application/octet-stream"),
+                (b"content-length", b"999")]}
+
+
+def test_json_response() -> None:
+    adapter = AsyncWSGIAdapter(app, max_workers=2, max_body=100)
+    sent = call(adapter, http_scope("POST", "/echo", b"q=1"), [
+        {"type": "http.request", "body": b"12345", "more_body": True},
+        {"type": "http.request", "body": b"678"},
+    ])
+    assert sent[0]["status"] == 200
+    assert (b"content-type", b"application/json") in sent[0]["headers"]
+    # 小さいレスポンスは1度に送る
+    assert len(sent) == 2
+    assert b'"size":8' in sent[1]["body"].replace(b" ", b"")
+    assert b'"q":"1"' in sent[1]["body"].replace(b" ", b"")
+
+
+def test_body_too_large() -> None:
+    adapter = AsyncWSGIAdapter(app, max_workers=2, max_body=4)
+    sent = call(adapter, http_scope("POST", "/echo"), [
+        {"type": "http.request", "body": b"12345"},
+    ])
+    assert sent[0]["status"] == 413
+
+
+def test_stream() -> None:
+    adapter = AsyncWSGIAdapter(app, max_workers=2)
+    sent = call(adapter, http_scope("GET", "/stream"), [
+        {"type": "http.request", "body": b""},
+    ])
+    assert sent[0]["status"] == 200
+    assert b"".join(m["body"] for m in sent[1:]) == b"ab"
+    assert not sent[-1].get("more_body", False)
+
+
+def write_app(environ: dict[str, Any], start_response: Any) -> Any:
+    # write() で本文の一部を書く WSGI アプリ
+    headers = [("Content-Type", "text/plain")]
+    if environ["PATH_INFO"] == "/buffered":
+        headers.append(("Content-Length", "4"))
+    write = start_response("200 OK", headers)
+    write(b"ab")
+    return [b"cd"]
+
+
+def test_write() -> None:
+    adapter = AsyncWSGIAdapter(write_app, max_workers=2)
+    for path in ("/buffered", "/stream"):
+        sent = call(adapter, http_scope("GET", path), [
+            {"type": "http.request", "body": b""},
+        ])
+        assert sent[0]["status"] == 200
+        # write() の分が iterable より先に送られる
+        assert b"".join(m["body"] for m in sent[1:]) == b"abcd"
+        assert not sent[-1].get("more_body", False)
+
+
+def test_lifespan() -> None:
+    adapter = AsyncWSGIAdapter(app, max_workers=2)
+    sent = call(adapter, {"type": "lifespan"}, [
+        {"type": "lifespan.startup"},
+        {"type": "lifespan.shutdown"},
+    ])
+    assert [m["type"] for m in sent] == [
+        "lifespan.startup.complete", "lifespan.shutdown.complete"]
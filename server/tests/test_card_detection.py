@@ -0,0 +1,262 @@
+import numpy as np
+import os
+import pytest
+import threading
+import time
+import torch
+from typing import Any, List
+from src import card_detection
+from src.card_detection import (IMAGE_SIZE, away_from_seams, chip_buffer,
+                                detect, preprocess, resize_square,
+                                tile_windows, to_global)
+from src.models import Darknet
+
+
+def test_tile_windows() -> None:
+    assert tile_windows(480, 640, 1216, 0.2) == [(0, 0, 640, 480)]
+    windows = tile_windows(3024, 4032, 1216, 0.2)
+    assert len(windows) == 12
+    # 画像全体を覆い、隣同士は重なる
+    assert windows[0][:2] == (0, 0)
+    x, y, w, h = windows[-1]
+    assert (x + w, y + h) == (4032, 3024)
+    assert windows[1][0] < windows[0][0] + windows[0][2]
+
+
+def test_to_global() -> None:
+    # 横長の画像は上下に padding が入る
+    pred = torch.zeros(1, 13)
+    pred[0, :8] = torch.tensor([0, 76, 608, 76, 608, 532, 0, 532.])
+    p = to_global(pred, (300, 400), (10, 20))
+    assert p[0, :8].tolist() == [10, 20, 410, 20, 410, 320, 10, 320]
+
+
+def test_away_from_seams() -> None:
+    pred = torch.zeros(2, 13)
+    pred[0, :8] = torch.tensor([10, 10, 50, 10, 50, 50, 10, 50.])
+    pred[1, :8] = pred[0, :8] + 90
+    # 右と下が他のタイルと接している
+    keep = away_from_seams(pred, (0, 0, 100, 100), (200, 200), 5)
+    assert keep.tolist() == [True, False]
+
+
+def fake_model(batch: torch.Tensor) -> torch.Tensor:
+    # chip ごとに、中央に正方形を1つ検出したことにする
+    c, r = IMAGE_SIZE / 2, IMAGE_SIZE / 8
+    box = torch.tensor([c - r, c - r, c + r, c - r, c + r, c + r, c - r, c + r,
+                        1, 1, 0, 0, 0])
+    return box.repeat(len(batch), 1, 1)
+
+
+def test_detect_tiled(monkeypatch: Any) -> None:
+    img = np.zeros((1000, 3000, 3), np.uint8)
+    monkeypatch.setattr(card_detection, "model", fake_model)
+    monkeypatch.setattr(card_detection, "device", torch.device("cpu"))
+    monkeypatch.setattr(card_detection, "batch_inference", None)
+
+    def center(card: Any) -> Any:
+        return np.array(card["points"]).mean(0)
+
+    cards = detect(img, False)
+    assert len(cards) == 1
+    assert np.abs(center(cards[0]) - (1500, 500)).max() < 5
+
+    # 全体の結果に加えて、各タイルの中央の検出が元画像の座標で返る
+    cards = detect(img, True)
+    windows = tile_windows(1000, 3000, 1216, 0.2)
+    assert len(cards) == 1 + len(windows)
+    centers = np.array([center(c) for c in cards])
+    for x, y, w, h in windows:
+        assert np.abs(centers - (x + w / 2, y + h / 2)).max(1).min() < 5
+
+
+def test_detect_clamp(monkeypatch: Any) -> None:
+    def outside_model(batch: torch.Tensor) -> torch.Tensor:
+        # chip からはみ出した正方形を1つ検出したことにする
+        a, b = -20, IMAGE_SIZE + 20
+        box = torch.tensor([a, a, b, a, b, b, a, b, 1, 1, 0, 0, 0.])
+        return box.repeat(len(batch), 1, 1)
+
+    img = np.zeros((1000, 3000, 3), np.uint8)
+    monkeypatch.setattr(card_detection, "model", outside_model)
+    monkeypatch.setattr(card_detection, "device", torch.device("cpu"))
+    monkeypatch.setattr(card_detection, "batch_inference", None)
+
+    # タイルに分けない場合は、これまで通り負の座標だけ 0 にする
+    points = np.array(detect(img, False)[0]["points"])
+    assert points.min() == 0
+    assert points[:, 0].max() > 3000 and points[:, 1].max() > 1000
+
+    # タイルに分けた場合は、画像の中に収める
+    for card in detect(img, True):
+        points = np.array(card["points"])
+        assert points.min() >= 0
+        assert points[:, 0].max() <= 2999 and points[:, 1].max() <= 999
+
+
+def test_preprocess() -> None:
+    img = np.random.randint(0, 256, (300, 500, 3), np.uint8)
+    square, _, _, _ = resize_square(
+        img, height=IMAGE_SIZE, color=(127.5, 127.5, 127.5))
+    expected = square[:, :, ::-1].transpose(2, 0, 1) / np.float32(255)
+
+    out = chip_buffer(1)[0]
+    chip = preprocess(img, out)
+    assert np.array_equal(chip.numpy(), expected)
+    # 確保済みの配列に書き込まれ、次の呼び出しでも使い回される
+    assert np.shares_memory(chip.numpy(), out)
+    assert np.shares_memory(chip_buffer(1), out)
+    # 複数枚 (タイル) の分は使い回さない
+    tiles = chip_buffer(3)
+    assert tiles.shape == (3, 3, IMAGE_SIZE, IMAGE_SIZE)
+    assert not np.shares_memory(tiles, out)
+    assert not np.shares_memory(chip_buffer(3), tiles)
+    assert np.shares_memory(chip_buffer(1), out)
+
+
+def run_batched(
+        batcher: card_detection.BatchInference,
+        chips: List[torch.Tensor]) -> List[Any]:
+    # 同時に要求を出し、それぞれの結果 (または例外) を返す
+    results: List[Any] = [None] * len(chips)
+
+    def call(i: int) -> None:
+        try:
+            results[i] = batcher(chips[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,))
+               for i in range(len(chips))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_batch_inference(monkeypatch: Any) -> None:
+    batches: List[int] = []
+
+    def model(batch: torch.Tensor) -> torch.Tensor:
+        batches.append(len(batch))
+        # chip の値をそのまま結果にする
+        return batch.flatten(1)[:, :1].unsqueeze(1)
+
+    monkeypatch.setattr(card_detection, "model", model)
+    monkeypatch.setattr(card_detection, "device", torch.device("cpu"))
+
+    # 待ち時間の間に来た要求は、batch の大きさまでまとめられる
+    batcher = card_detection.BatchInference(4, 1.0)
+    chips = [torch.full((3, 2, 2), float(i)) for i in range(4)]
+    results = run_batched(batcher, chips)
+    assert batches == [4]
+    # それぞれの呼び出し元には、自分の行だけが返る
+    assert [r.item() for r in results] == [0, 1, 2, 3]
+
+    # 1つだけなら、待ち時間が過ぎたところで実行する
+    batches.clear()
+    batcher = card_detection.BatchInference(8, 0.05)
+    start = time.monotonic()
+    assert batcher(chips[1]).item() == 1
+    assert time.monotonic() - start < 1
+    assert batches == [1]
+
+
+def test_batch_inference_error(monkeypatch: Any) -> None:
+    def model(batch: torch.Tensor) -> torch.Tensor:
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(card_detection, "model", model)
+    monkeypatch.setattr(card_detection, "device", torch.device("cpu"))
+    batcher = card_detection.BatchInference(3, 1.0)
+    results = run_batched(batcher, [torch.zeros(3, 2, 2)] * 3)
+    # まとめて実行した全ての呼び出し元に例外が届く
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_batch_inference_after_fork(monkeypatch: Any) -> None:
+    monkeypatch.setattr(
+        card_detection, "model", lambda b: b.flatten(1)[:, :1].unsqueeze(1))
+    monkeypatch.setattr(card_detection, "device", torch.device("cpu"))
+    batcher = card_detection.BatchInference(2, 0.01)
+    assert batcher(torch.ones(3, 2, 2)).item() == 1
+    thread = batcher.thread
+
+    # fork された子プロセスでは pid が変わり、スレッドもないので起動し直す
+    batcher.pid = -1
+    assert batcher(torch.ones(3, 2, 2)).item() == 1
+    assert batcher.thread is not thread
+    assert batcher.thread is not None and batcher.thread.is_alive()
+    assert batcher.pid == os.getpid()
+
+
+def random_darknet(cfg: str) -> Any:
+    torch.manual_seed(0)
+    model = Darknet(cfg, 64)
+    # BN の統計も乱数にして、畳み込みの結果に効くようにする
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.normal_()
+            m.running_var.uniform_(0.5, 2)
+    return model.eval()
+
+
+@pytest.fixture
+def tiny_model(tiny_cfg: str, tmp_path: Any, monkeypatch: Any) -> Any:
+    # 小さなモデルの乱数のチェックポイントを読ませる
+    expected = random_darknet(tiny_cfg)
+    checkpoint = str(tmp_path / "latest.pt")
+    torch.save({"model": expected.state_dict()}, checkpoint)
+    monkeypatch.setattr(card_detection, "YOLO_FILE", tiny_cfg)
+    monkeypatch.setattr(card_detection, "CHECKPINT_FILE", checkpoint)
+    monkeypatch.setattr(card_detection, "COMPILED_FILE",
+                        str(tmp_path / "latest.model.pt"))
+    monkeypatch.setattr(card_detection, "JIT_FILE",
+                        str(tmp_path / "latest.jit.pt"))
+    monkeypatch.setattr(card_detection, "JIT_CHANNELS_LAST_FILE",
+                        str(tmp_path / "latest.cl.jit.pt"))
+    monkeypatch.setattr(card_detection, "IMAGE_SIZE", 64)
+    return expected
+
+
+def outputs(model: Any) -> Any:
+    torch.manual_seed(1)
+    x = torch.rand(2, 3, 64, 64)
+    with torch.no_grad():
+        return model(x)
+
+
+def test_load_model(tiny_model: Any) -> None:
+    # meta device で組み立て、mmap したチェックポイントのテンソルを使う
+    built = card_detection.build_model()
+    assert torch.equal(outputs(built.eval()), outputs(tiny_model))
+
+    # コンパイル済みのファイルがなければ作り、mmap して読む
+    assert not card_detection.compiled_model_is_fresh()
+    loaded = card_detection.load_model()
+    assert card_detection.compiled_model_is_fresh()
+    assert torch.equal(outputs(loaded.eval()), outputs(tiny_model))
+
+    # チェックポイントの方が新しくなったら作り直す
+    compiled = card_detection.COMPILED_FILE
+    mtime = os.path.getmtime(card_detection.CHECKPINT_FILE) - 10
+    os.utime(compiled, (mtime, mtime))
+    assert not card_detection.compiled_model_is_fresh()
+    card_detection.load_model()
+    assert os.path.getmtime(compiled) > mtime
+    assert card_detection.compiled_model_is_fresh()
+
+
+def test_load_jit_model(tiny_model: Any) -> None:
+    # 初回に trace して保存し、次からはそれを読む
+    cpu = torch.device("cpu")
+    traced = card_detection.load_jit_model(cpu)
+    path = card_detection.JIT_FILE
+    assert card_detection.is_fresh(path)
+    mtime = os.path.getmtime(path)
+    loaded = card_detection.load_jit_model(cpu)
+    assert os.path.getmtime(path) == mtime
+    assert isinstance(loaded, torch.jit.ScriptModule)
+    assert torch.allclose(outputs(loaded), outputs(tiny_model), atol=1e-4)
+    assert torch.equal(outputs(loaded), outputs(traced))
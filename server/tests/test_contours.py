@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+from src.contours import (filter_contours, find_contours, find_quads,
+                          order_corners, refine_contours, warp_matrices)
+
+
+def test_filter_contours() -> None:
+    img = np.zeros((100, 100), np.uint8)
+    cv2.rectangle(img, (10, 10), (60, 60), 255, -1)
+    cv2.rectangle(img, (80, 80), (82, 82), 255, -1)
+    contours, _ = cv2.findContours(
+        img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    assert len(filter_contours(contours, img.size)) == 1
+    assert len(filter_contours(contours, img.size, min_area=0)) == 2
+    assert len(filter_contours(contours, img.size, max_area=0.2)) == 0
+
+
+def test_order_corners() -> None:
+    # 左上、左下、右下、右上
+    quads = np.array([
+        [[10, 10], [10, 50], [40, 50], [40, 10]],
+        # 右肩上がり: 右上、左上、左下、右下
+        [[40, 0], [0, 10], [10, 50], [50, 40]],
+    ])
+    assert order_corners(quads).tolist() == [
+        [[10, 10], [40, 10], [10, 50], [40, 50]],
+        [[0, 10], [40, 0], [10, 50], [50, 40]],
+    ]
+
+
+def test_warp_matrices() -> None:
+    corners = np.array([
+        [[10, 10], [40, 10], [10, 50], [40, 50]],
+        [[0, 10], [40, 0], [10, 50], [50, 40]],
+    ])
+    sizes = np.array([[30, 40], [41, 41]])
+    matrices = warp_matrices(corners, sizes)
+    for src, (w, h), M in zip(corners, sizes, matrices):
+        dst = np.float32([[0, 0], [w, 0], [0, h], [w, h]])
+        expected = cv2.getPerspectiveTransform(np.float32(src), dst)
+        assert np.allclose(M, expected)
+
+
+def test_find_quads() -> None:
+    img = np.zeros((200, 300), np.uint8)
+    cv2.rectangle(img, (50, 40), (150, 120), 255, -1)
+    contours, _ = cv2.findContours(
+        img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    quads = find_quads(filter_contours(contours, img.size))
+    assert quads.corners.tolist() == [
+        [[50, 40], [150, 40], [50, 120], [150, 120]]]
+    assert quads.sizes.tolist() == [[100, 80]]
+    assert quads.matrices.shape == (1, 3, 3)
+
+    empty = find_quads([])
+    assert empty.corners.shape == (0, 4, 2)
+    assert empty.matrices.shape == (0, 3, 3)
+
+
+def test_refine_contours() -> None:
+    img = np.zeros((400, 600), np.uint8)
+    cv2.rectangle(img, (101, 83), (402, 297), 255, -1)
+    small = cv2.pyrDown(cv2.pyrDown(img))
+    threshold, contours = find_contours(small)
+    contours = filter_contours(contours, small.size)
+    # 縮小した画像で見つけた輪郭を、元の解像度で取り直す
+    refined = refine_contours(img, contours, 4, threshold)
+    quads = find_quads(refined)
+    assert quads.corners.tolist() == [
+        [[101, 83], [402, 83], [101, 297], [402, 297]]]
@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+from typing import Any
+from src.crops import (CropPool, apply_crop, quad_crop, read_spec, rect_crop,
+                       write_spec)
+
+
+def test_apply_crop() -> None:
+    img = np.arange(100 * 200 * 3, dtype=np.uint32).reshape(100, 200, 3)
+    img = (img % 256).astype(np.uint8)
+    crop = rect_crop(np.int32(10), 20, 30, 40)
+    assert crop == {"rect": [10, 20, 30, 40]}
+    assert np.array_equal(apply_crop(img, crop), img[20:60, 10:40])
+
+    # 左上、右上、左下、右下の四角形をそのまま切り出す
+    src = np.float32([[10, 20], [40, 20], [10, 60], [40, 60]])
+    out = apply_crop(img, quad_crop(src, 30, 40))
+    assert out.shape == (40, 30, 3)
+    assert np.array_equal(out, img[20:60, 10:40])
+
+    # 求めてある変換行列を使う
+    M = cv2.getPerspectiveTransform(
+        src, np.float32([[0, 0], [30, 0], [0, 40], [30, 40]]))
+    crop = quad_crop(src, 30, 40, M)
+    assert np.array_equal(apply_crop(img, crop), out)
+
+
+def test_crop_pool() -> None:
+    # 並列にしても結果の順番は変わらない
+    items = list(range(20))
+    assert CropPool(4).map(lambda x: x * 2, items) == [x * 2 for x in items]
+    assert CropPool(1).map(lambda x: x * 2, items) == [x * 2 for x in items]
+
+
+def test_spec(tmp_path: Any) -> None:
+    path = str(tmp_path / "a.json")
+    assert read_spec(path) is None
+    write_spec(path, {"source": "src", "crop": rect_crop(1, 2, 3, 4)})
+    assert read_spec(path) == {"source": "src", "crop": {"rect": [1, 2, 3, 4]}}
@@ -0,0 +1,18 @@
+from src.dedup import canonical_params, content_hash, result_key
+
+
+def test_canonical_params() -> None:
+    assert canonical_params({
+        "task_id": "a", "id": "b", "async": True, "threshold": 10,
+        "callback_url": "http://example.com", "blur": 3,
+    }) == '{"blur":3,"threshold":10}'
+
+
+def test_result_key() -> None:
+    source = content_hash(b"image")
+    key = result_key(source, "thre", {"id": "a", "threshold": 10})
+    assert key == result_key(source, "thre", {"threshold": 10, "id": "b"})
+    assert key != result_key(source, "thre", {"threshold": 11})
+    assert key != result_key(source, "gray", {"threshold": 10})
+    assert key != result_key(
+        content_hash(b"other"), "thre", {"threshold": 10})
@@ -0,0 +1,93 @@
+import numpy as np
+import os
+import pytest
+from typing import Any, List, Optional, Tuple
+from src.executor import (INLINE, PROCESS, THREAD, ActionExecutor,
+                          in_action_worker, parse_routes)
+from src.metrics import begin_request, request_timings, stage
+
+# 子プロセスで読み込んだモデル
+loaded: List[str] = []
+
+
+def invert(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, Optional[dict[str, Any]]]:
+    with stage("forward"):
+        out = 255 - img
+    return out, {"pid": os.getpid(), "id": data["id"],
+                 "worker": in_action_worker(), "loaded": list(loaded)}
+
+
+def enlarge(
+        data: dict[str, Any],
+        img: np.ndarray) -> Tuple[np.ndarray, Optional[dict[str, Any]]]:
+    # 共有メモリに入らない大きさの結果
+    return np.repeat(img[..., None], 8, axis=2), None
+
+
+ACTIONS = {"invert": invert, "enlarge": enlarge}
+ACTION_MODELS = {
+    "invert": [lambda: loaded.append("invert")],
+    "enlarge": [lambda: loaded.append("enlarge")],
+}
+
+
+def test_parse_routes() -> None:
+    assert parse_routes("") == {}
+    assert parse_routes("contours=process, ocr = thread") == {
+        "contours": PROCESS, "ocr": THREAD}
+    with pytest.raises(ValueError):
+        parse_routes("contours=gpu")
+
+
+def test_inline_and_thread() -> None:
+    img = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    executor = ActionExecutor({"invert": THREAD}, workers=2)
+    assert executor.backend("blur") == INLINE
+
+    begin_request("/test")
+    out, params = executor.run("invert", invert, {"id": "a"}, img)
+    assert np.array_equal(out, 255 - img)
+    assert params == {
+        "pid": os.getpid(), "id": "a", "worker": False, "loaded": []}
+    # スレッドで計測した時間もリクエストに記録される
+    assert [name for name, _ in request_timings()] == ["forward"]
+    executor.shutdown()
+
+
+def test_process() -> None:
+    img = np.arange(100 * 50 * 3, dtype=np.uint32).reshape(100, 50, 3)
+    img = (img % 256).astype(np.uint8)
+    executor = ActionExecutor(
+        {"invert": PROCESS, "enlarge": PROCESS}, workers=1,
+        module=__name__, registry="ACTIONS")
+    try:
+        executor.warm()
+        begin_request("/test")
+        out, params = executor.run("invert", invert, {"id": "a"}, img)
+        assert np.array_equal(out, 255 - img)
+        assert params is not None and params["pid"] != os.getpid()
+        assert params["worker"]
+        assert sorted(params["loaded"]) == ["enlarge", "invert"]
+        assert [name for name, _ in request_timings()] == ["forward"]
+
+        gray = img[..., 0].copy()
+        out, _ = executor.run("enlarge", enlarge, {}, gray)
+        assert out.shape == (100, 50, 8)
+        assert np.array_equal(out[..., 7], gray)
+    finally:
+        executor.shutdown()
+
+
+def test_process_loads_routed_models() -> None:
+    # process で実行する action のモデルだけを読み込む
+    img = np.zeros((4, 4), np.uint8)
+    executor = ActionExecutor(
+        {"invert": PROCESS, "enlarge": THREAD}, workers=1,
+        module=__name__, registry="ACTIONS")
+    try:
+        _, params = executor.run("invert", invert, {"id": "a"}, img)
+        assert params is not None and params["loaded"] == ["invert"]
+    finally:
+        executor.shutdown()
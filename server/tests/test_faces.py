@@ -0,0 +1,42 @@
+import numpy as np
+from typing import Any, List
+from src.faces import detect_faces, overlap, refine_faces
+
+
+class FakeCascade:
+    def __init__(self, faces: List[Any]) -> None:
+        self.faces = faces
+        self.calls: List[Any] = []
+
+    def detectMultiScale(self, gray: Any, *args: Any, **kwargs: Any) -> Any:
+        self.calls.append((gray.shape, kwargs))
+        return np.array(self.faces, np.int32).reshape(-1, 4)
+
+
+def test_detect_faces() -> None:
+    cascade = FakeCascade([[1, 2, 3, 4]])
+    gray = np.zeros((10, 10), np.uint8)
+    assert detect_faces(cascade, gray, 5) == [(1, 2, 3, 4)]
+    assert cascade.calls == [((10, 10), {"minSize": (5, 5)})]
+
+
+def test_overlap() -> None:
+    assert overlap((0, 0, 10, 10), (0, 0, 10, 10)) == 1
+    assert overlap((0, 0, 10, 10), (5, 0, 10, 10)) == 50 / 150
+    assert overlap((0, 0, 10, 10), (20, 0, 10, 10)) == 0
+
+
+def test_refine_faces() -> None:
+    gray = np.zeros((400, 400), np.uint8)
+    # 探し直す範囲の中での位置を返す
+    cascade = FakeCascade([[0, 0, 30, 30], [12, 10, 42, 42]])
+    faces = refine_faces(cascade, gray, [(25, 25, 10, 10)], 4)
+    # (100, 100, 40, 40) の周りを 40 // 4 + 4 だけ広げて探す
+    shape, kwargs = cascade.calls[0]
+    assert shape == (68, 68)
+    assert kwargs == {"minSize": (26, 26), "maxSize": (60, 60)}
+    assert faces == [(98, 96, 42, 42)]
+
+    # 見つからなければ、縮小した画像での位置を拡大して使う
+    faces = refine_faces(FakeCascade([]), gray, [(25, 25, 10, 10)], 4)
+    assert faces == [(100, 100, 40, 40)]
@@ -0,0 +1,128 @@
+import json
+import os
+import shutil
+from typing import Any
+from src.job import gc_daemon
+from src.job.gc_daemon import (GarbageCollector, LatencyMonitor,
+                               SharedLatencyMonitor, read_metrics)
+from src.metrics import Histogram
+from src.task_index import TaskIndex
+
+
+def test_latency_monitor() -> None:
+    monitor = LatencyMonitor(alpha=0.5)
+    assert monitor.value() == 0
+    monitor.observe(1.0)
+    monitor.observe(1.0)
+    assert monitor.value() == 0.75
+
+    # しばらく更新が無ければ 0
+    monitor.updated_at -= 60
+    assert monitor.value() == 0
+
+
+def write_histogram(path: Any, *seconds: float) -> None:
+    histogram = Histogram()
+    for s in seconds:
+        histogram.observe(("/ocr", "total"), s)
+        histogram.observe(("/ocr", "forward"), s)
+    with open(path, "w") as f:
+        json.dump(histogram.dump(), f)
+
+
+def test_shared_latency_monitor(tmp_path: Any) -> None:
+    monitor = SharedLatencyMonitor(str(tmp_path), interval=0, alpha=0.5)
+    write_histogram(tmp_path / "1.json", 1.0)
+    # 最初に読んだ分は基準にするだけ
+    assert monitor.value() == 0
+
+    # 別の worker のリクエストも、前回から増えた分の平均を加える
+    write_histogram(tmp_path / "1.json", 1.0, 0.5)
+    write_histogram(tmp_path / "2.json", 0.3)
+    assert monitor.value() == 0.2
+    assert monitor.value() == 0.2
+
+    # しばらく増えなければ 0
+    monitor.updated_at -= 60
+    assert monitor.value() == 0
+
+
+def test_sweep(tmp_path: Any) -> None:
+    task_dir = tmp_path / "task"
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    for task_id, now in (("old", 100), ("new", None)):
+        os.makedirs(task_dir / task_id / "jobs")
+        (task_dir / task_id / "a.jpg").write_bytes(b"x" * 10)
+        (task_dir / task_id / "jobs" / "b.json").write_bytes(b"{}")
+        index.touch(task_id, 12, 2, now=now)
+
+    metrics_path = str(tmp_path / "metrics.json")
+    collector = GarbageCollector(
+        index, str(task_dir), metrics_path, LatencyMonitor(),
+        batch_size=1, unlink_rate=0)
+    collector.sweep()
+
+    assert not os.path.exists(task_dir / "old")
+    assert os.path.exists(task_dir / "new")
+    assert index.get("old") is None
+    metrics = read_metrics(metrics_path)
+    assert metrics
+    assert metrics["sweeps"] == 1
+    assert metrics["tasks_expired"] == 1
+    assert metrics["files_removed"] == 2
+    assert metrics["bytes_freed"] == 12
+
+
+def test_sweep_skips_failed(tmp_path: Any, monkeypatch: Any) -> None:
+    task_dir = tmp_path / "task"
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    for i, task_id in enumerate(("stuck1", "stuck2", "old1", "old2")):
+        os.makedirs(task_dir / task_id)
+        index.touch(task_id, 0, 0, now=100 + i)
+
+    rmtree = shutil.rmtree
+
+    def fail_stuck(path: str) -> None:
+        if os.path.basename(path).startswith("stuck"):
+            raise OSError("busy")
+        rmtree(path)
+
+    monkeypatch.setattr(gc_daemon.shutil, "rmtree", fail_stuck)
+    collector = GarbageCollector(
+        index, str(task_dir), str(tmp_path / "metrics.json"),
+        batch_size=2, unlink_rate=0)
+    # 最初のバッチが全て消せなくても、その先のタスクを消す
+    collector.sweep()
+
+    assert sorted(os.listdir(task_dir)) == ["stuck1", "stuck2"]
+    assert index.expired(1000) == ["stuck1", "stuck2"]
+    assert collector.metrics["tasks_expired"] == 2
+
+
+def test_sweep_touched_task(tmp_path: Any, monkeypatch: Any) -> None:
+    task_dir = tmp_path / "task"
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    os.makedirs(task_dir / "old")
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        (task_dir / "old" / name).write_bytes(b"x")
+    index.touch("old", 3, 3, now=100)
+    index.set_result("old", "key", {"image": {"id": "a"}})
+
+    unlink = os.unlink
+
+    def unlink_and_touch(path: str) -> None:
+        # 消している途中で、別の worker がタスクを使う
+        unlink(path)
+        index.touch("old", 1, 1)
+
+    monkeypatch.setattr(gc_daemon.os, "unlink", unlink_and_touch)
+    collector = GarbageCollector(
+        index, str(task_dir), str(tmp_path / "metrics.json"),
+        unlink_rate=0)
+    collector.sweep()
+
+    # 最初の1つを消したところで止め、タスクと索引は残す
+    assert len(os.listdir(task_dir / "old")) == 2
+    assert index.get("old") is not None
+    assert index.get_result("old", "key") is not None
+    assert collector.metrics["tasks_expired"] == 0
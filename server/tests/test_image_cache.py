@@ -0,0 +1,46 @@
+import numpy as np
+from src.image_cache import ImageCache, as_bgr, as_gray
+
+
+def image(size: int) -> np.ndarray:
+    return np.zeros((size, size, 3), np.uint8)
+
+
+def test_get_put() -> None:
+    cache = ImageCache(1024 * 1024)
+    img = image(10)
+    cache.put(("t", "a"), img)
+    assert cache.get(("t", "a")) is img
+    assert cache.get(("t", "b")) is None
+    assert cache.current_bytes == img.nbytes
+
+
+def test_evict_least_recently_used() -> None:
+    cache = ImageCache(image(10).nbytes * 2)
+    cache.put("a", image(10))
+    cache.put("b", image(10))
+    cache.get("a")
+    cache.put("c", image(10))
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.current_bytes == image(10).nbytes * 2
+
+
+def test_skip_too_large_image() -> None:
+    cache = ImageCache(100)
+    cache.put("a", image(10))
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_as_bgr() -> None:
+    assert as_bgr(np.zeros((4, 4), np.uint8)).shape == (4, 4, 3)
+    assert as_bgr(np.zeros((4, 4, 4), np.uint8)).shape == (4, 4, 3)
+
+
+def test_as_gray() -> None:
+    img = np.zeros((4, 4), np.uint8)
+    assert as_gray(img) is img
+    assert as_gray(np.zeros((4, 4, 3), np.uint8)).shape == (4, 4)
+    assert as_gray(np.zeros((4, 4, 4), np.uint8)).shape == (4, 4)
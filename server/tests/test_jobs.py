@@ -0,0 +1,117 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, List
+from src import jobs
+from src.jobs import JobQueue, is_callback_url
+
+
+def wait(queue: JobQueue, job: Any) -> Any:
+    for _ in range(100):
+        job = queue.get(job["task_id"], job["id"])
+        if job["status"] in ("done", "failed"):
+            break
+        time.sleep(0.01)
+    return job
+
+
+def test_job_queue(tmp_path: Any) -> None:
+    queue = JobQueue(str(tmp_path), 1)
+    job = queue.submit("a", lambda: {"x": 1})
+    assert job["status"] == "queued"
+    job = wait(queue, job)
+    assert job["status"] == "done"
+    assert job["result"] == {"x": 1}
+    assert "pid" not in job
+
+    def fail() -> None:
+        raise ValueError("broken")
+
+    job = wait(queue, queue.submit("a", fail))
+    assert job["status"] == "failed"
+    assert job["error"] == "broken"
+
+    assert queue.get("a", "nothing") is None
+
+
+def test_fail_orphans(tmp_path: Any) -> None:
+    queue = JobQueue(str(tmp_path), 1)
+    # 終了したプロセスの pid
+    proc = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True, text=True, check=True)
+    dead = int(proc.stdout)
+    for job_id, status, pid in [
+            ("queued", "queued", dead),
+            ("running", "running", dead),
+            ("done", "done", dead),
+            ("alive", "queued", os.getpid())]:
+        queue._write({
+            "task_id": "a", "id": job_id, "status": status,
+            "result": None, "error": None, "pid": pid})
+
+    assert queue.fail_orphans() == 2
+    statuses = {
+        job_id: queue.get("a", job_id)["status"]  # type: ignore
+        for job_id in ("queued", "running", "done", "alive")}
+    assert statuses == {
+        "queued": "failed", "running": "failed",
+        "done": "done", "alive": "queued"}
+
+
+def test_is_callback_url(monkeypatch: Any) -> None:
+    assert is_callback_url("http://8.8.8.8/cb")
+    assert is_callback_url("https://8.8.8.8:8443/cb")
+    assert not is_callback_url("file:///etc/passwd")
+    assert not is_callback_url("example.com")
+    # ループバック、リンクローカル、プライベートのアドレス
+    assert not is_callback_url("http://localhost/cb")
+    assert not is_callback_url("http://127.0.0.1/cb")
+    assert not is_callback_url("http://[::1]/cb")
+    assert not is_callback_url("http://169.254.169.254/latest/meta-data")
+    assert not is_callback_url("http://10.0.0.1/cb")
+    assert not is_callback_url("http://[::ffff:127.0.0.1]/cb")
+
+    monkeypatch.setattr(jobs, "CALLBACK_HOSTS", frozenset(["localhost"]))
+    assert is_callback_url("http://localhost/cb")
+    assert not is_callback_url("http://8.8.8.8/cb")
+
+
+def serve(received: List[Any]) -> HTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            length = int(self.headers["Content-Length"])
+            received.append(json.loads(self.rfile.read(length)))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_callback(tmp_path: Any, monkeypatch: Any) -> None:
+    received: List[Any] = []
+    server = serve(received)
+    url = f"http://127.0.0.1:{server.server_port}/cb"
+    queue = JobQueue(str(tmp_path), 1)
+    job = {"task_id": "a", "id": "b", "status": "done", "pid": 1}
+    try:
+        # 受け付けた後に内部のアドレスに変わった場合も送らない
+        queue._callback(url, job)
+        assert received == []
+
+        monkeypatch.setattr(jobs, "CALLBACK_HOSTS", frozenset(["127.0.0.1"]))
+        queue._callback(url, job)
+        assert received == [{"result": {"job": {
+            "task_id": "a", "id": "b", "status": "done"}}}]
+    finally:
+        server.shutdown()
+        server.server_close()
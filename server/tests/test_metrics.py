@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+from typing import Any
+from src.metrics import (Histogram, MetricsStore, begin_request, folded_stack,
+                         request_timings, server_timing, stage)
+
+
+def test_histogram() -> None:
+    h = Histogram(buckets=(0.1, 1.0))
+    h.observe(("/a", "compute"), 0.05)
+    h.observe(("/a", "compute"), 0.5)
+    h.observe(("/a", "compute"), 5)
+    assert h.values[("/a", "compute")] == [1, 2, 3, 5.55]
+    assert h.render("x") == [
+        "# TYPE x histogram",
+        'x_bucket{endpoint="/a",stage="compute",le="0.1"} 1',
+        'x_bucket{endpoint="/a",stage="compute",le="1.0"} 2',
+        'x_bucket{endpoint="/a",stage="compute",le="+Inf"} 3',
+        'x_count{endpoint="/a",stage="compute"} 3',
+        'x_sum{endpoint="/a",stage="compute"} 5.55',
+    ]
+
+
+def test_stage() -> None:
+    begin_request("/a")
+    with stage("decode"):
+        pass
+    with stage("crop_write"):
+        pass
+    with stage("crop_write"):
+        pass
+    timings = request_timings()
+    assert [name for name, _ in timings] == [
+        "decode", "crop_write", "crop_write"]
+    assert server_timing([("a", 0.001), ("b", 0.002), ("b", 0.003)]) == \
+        "a;dur=1.0, b;dur=5.0"
+
+
+def test_metrics_store(tmp_path: Any) -> None:
+    # 他の worker が書き出したヒストグラムも合算する
+    other = Histogram()
+    other.observe(("/other", "total"), 0.01)
+    with open(tmp_path / "1.json", "w") as f:
+        json.dump(other.dump(), f)
+
+    begin_request("/mine")
+    with stage("total"):
+        pass
+    text = MetricsStore(str(tmp_path)).render()
+    assert 'stage_duration_seconds_count{endpoint="/other",stage="total"} 1' \
+        in text
+    assert 'endpoint="/mine",stage="total"' in text
+    assert os.path.exists(tmp_path / f"{os.getpid()}.json")
+
+
+def test_folded_stack() -> None:
+    stack = folded_stack(sys._getframe())
+    assert stack.split(";")[-1].startswith("test_folded_stack (test_metrics")
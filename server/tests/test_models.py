@@ -0,0 +1,52 @@
+import torch
+import torch.nn as nn
+from typing import Any
+from src.models import (Darknet, export_inference_model, fuse_conv_and_bn,
+                        routed_layers)
+
+
+def test_fuse_conv_and_bn() -> None:
+    torch.manual_seed(0)
+    conv = nn.Conv2d(3, 8, 3, padding=1, bias=False)
+    bn = nn.BatchNorm2d(8)
+    bn.running_mean.normal_()
+    bn.running_var.uniform_(0.5, 2)
+    bn.weight.data.uniform_(0.5, 1.5)
+    bn.bias.data.normal_()
+    bn.eval()
+
+    x = torch.rand(2, 3, 16, 16)
+    with torch.no_grad():
+        assert torch.allclose(
+            fuse_conv_and_bn(conv, bn)(x), bn(conv(x)), atol=1e-5)
+
+
+def test_routed_layers() -> None:
+    module_defs = [
+        {'type': 'convolutional'},
+        {'type': 'convolutional'},
+        {'type': 'shortcut', 'from': '-2'},
+        {'type': 'convolutional'},
+        {'type': 'route', 'layers': '-1, 1'},
+    ]
+    assert routed_layers(module_defs) == {0, 1, 3}
+
+
+def test_export_inference_model(tiny_cfg: str, tmp_path: Any) -> None:
+    torch.manual_seed(0)
+    model = Darknet(tiny_cfg, 64)
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.normal_()
+            m.running_var.uniform_(0.5, 2)
+    model.eval()
+    x = torch.rand(3, 3, 64, 64)
+    with torch.no_grad():
+        expected = model(x)
+
+    # 保存して読み直したものも、元のモデルと同じ結果になる
+    path = str(tmp_path / "model.jit.pt")
+    torch.jit.save(export_inference_model(model), path)
+    traced = torch.jit.load(path)
+    with torch.no_grad():
+        assert torch.allclose(traced(x), expected, atol=1e-4)
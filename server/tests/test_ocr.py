@@ -0,0 +1,83 @@
+import numpy as np
+from typing import Any, List
+from src.ocr import TextReader, parse_regions, split
+
+
+class FakeReader:
+    def __init__(self) -> None:
+        self.detected: List[Any] = []
+
+    def detect(self, img: Any, canvas_size: int, reformat: bool) -> Any:
+        self.detected.append((img.shape, canvas_size))
+        return [[[1, 11, 2, 12]]], [[[[0, 0], [5, 0], [5, 5], [0, 5]]]]
+
+    def recognize(
+            self,
+            gray: Any,
+            horizontal_list: List[Any],
+            free_list: List[Any],
+            reformat: bool) -> List[Any]:
+        return [("h", b) for b in horizontal_list] + \
+            [("f", b) for b in free_list]
+
+
+def test_parse_regions() -> None:
+    regions = parse_regions([
+        {"x": 10, "y": 20, "width": 30, "height": 40},
+        {"points": [(5.5, 1), (50, 3), (52, 60.2), (4, 58)]},
+        # 画像の外にはみ出した分は切り詰める
+        {"x": 90, "y": -10, "width": 30, "height": 40},
+        {"x": 200, "y": 0, "width": 30, "height": 40},
+    ], (100, 100, 3))
+    assert regions == [
+        (10, 20, 30, 40), (4, 1, 48, 60), (90, 0, 10, 30)]
+
+
+def test_split() -> None:
+    assert split([1, 2, 3, 4, 5], 2) == [[1, 2, 3], [4, 5]]
+    assert split([1], 4) == [[1]]
+    assert split([], 4) == []
+
+
+def test_read() -> None:
+    reader = FakeReader()
+    img = np.zeros((100, 200, 3), np.uint8)
+    text_reader = TextReader(reader, workers=1)
+    assert text_reader.read(img, max_size=64) == [
+        ("h", [1, 11, 2, 12]),
+        ("f", [[0, 0], [5, 0], [5, 5], [0, 5]]),
+    ]
+    assert reader.detected == [((100, 200, 3), 64)]
+
+    # 領域ごとに検出し、座標は画像全体のものに戻す
+    reader.detected = []
+    result = text_reader.read(img, [(10, 20, 30, 40), (100, 0, 50, 50)])
+    assert [s for s, _ in reader.detected] == [(40, 30, 3), (50, 50, 3)]
+    assert result == [
+        ("h", [11, 21, 22, 32]),
+        ("h", [101, 111, 2, 12]),
+        ("f", [[10, 20], [15, 20], [15, 25], [10, 25]]),
+        ("f", [[100, 0], [105, 0], [105, 5], [100, 5]]),
+    ]
+
+    # 並列にしても結果の順番は変わらない
+    parallel = TextReader(reader, workers=2)
+    assert parallel.read(img, [(10, 20, 30, 40), (100, 0, 50, 50)]) == result
+    assert text_reader.read(img, []) == []
+
+
+def test_load() -> None:
+    readers: List[FakeReader] = []
+
+    def load() -> FakeReader:
+        readers.append(FakeReader())
+        return readers[-1]
+
+    # 最初に使う時に1度だけ作る
+    text_reader = TextReader(None, workers=1, loader=load)
+    assert readers == []
+    img = np.zeros((100, 200, 3), np.uint8)
+    text_reader.read(img, max_size=64)
+    text_reader.read(img, max_size=64)
+    assert len(readers) == 1
+    assert text_reader.reader is readers[0]
@@ -0,0 +1,39 @@
+import numpy as np
+from src.image_cache import ImageCache
+from src.pyramid import choose_level, expand, pyramid_level, scale_rect
+
+
+def test_choose_level() -> None:
+    assert choose_level((3000, 4000), 0) == 0
+    assert choose_level((3000, 4000), 4000) == 0
+    assert choose_level((3000, 4000), 1024) == 2
+    assert choose_level((3000, 4001), 1000) == 3
+    # 100px の物体が 24px より小さくならない段数まで
+    assert choose_level((3000, 4000), 500, 100, 24) == 2
+
+
+def test_pyramid_level() -> None:
+    cache = ImageCache(10 * 1024 * 1024)
+    img = np.zeros((400, 600), np.uint8)
+    calls = []
+
+    def base() -> np.ndarray:
+        calls.append(1)
+        return img
+
+    assert pyramid_level(cache, "a", base, 2).shape == (100, 150)
+    assert pyramid_level(cache, "a", base, 1).shape == (200, 300)
+    assert pyramid_level(cache, "a", base, 3).shape == (50, 75)
+    assert pyramid_level(cache, "a", base, 0) is img
+    # 元の画像を作るのは1度だけ
+    assert len(calls) == 1
+    assert len(cache) == 4
+
+    assert pyramid_level(cache, None, base, 1).shape == (200, 300)
+    assert len(cache) == 4
+
+
+def test_rects() -> None:
+    assert scale_rect((1, 2, 3, 4), 4) == (4, 8, 12, 16)
+    assert expand((10, 20, 30, 40), 5, (100, 100)) == (5, 15, 40, 50)
+    assert expand((0, 80, 30, 40), 5, (100, 100)) == (0, 75, 35, 25)
@@ -0,0 +1,62 @@
+import numpy as np
+import os
+from typing import Any
+from src.storage import choose_format, encode, find, is_binary, is_format, read
+
+
+def write(tmp_path: Any, img: np.ndarray, fmt: str) -> str:
+    path = str(tmp_path / f"a.{fmt}")
+    encode(img, fmt).tofile(path)
+    return path
+
+
+def test_is_format() -> None:
+    assert is_format("npy")
+    assert is_format("auto")
+    assert not is_format("gif")
+    assert not is_format(None)
+
+
+def test_choose_format() -> None:
+    mask = np.zeros((4, 4), np.uint8)
+    mask[1:3] = 255
+    assert is_binary(mask)
+    assert choose_format("auto", mask) == "png"
+    assert not is_binary(mask + 1)
+    assert choose_format("auto", mask + 1) == "jpg"
+    assert choose_format("auto", np.zeros((4, 4, 3), np.uint8)) == "jpg"
+    assert choose_format("npy", mask) == "npy"
+
+
+def test_npy(tmp_path: Any) -> None:
+    img = np.random.randint(0, 256, (30, 40, 3), np.uint8)
+    path = write(tmp_path, img, "npy")
+    loaded = read(path)
+    # デコードせずに mmap で読む
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, img)
+
+
+def test_binary_png(tmp_path: Any) -> None:
+    mask = (np.random.rand(100, 100) > 0.5).astype(np.uint8) * 255
+    path = write(tmp_path, mask, "png")
+    loaded = read(path)
+    assert loaded is not None
+    assert loaded.shape == (100, 100)
+    assert np.array_equal(loaded, mask)
+    # 1画素1ビットで保存される
+    assert os.path.getsize(path) < mask.nbytes / 4
+
+
+def test_read_keeps_channels(tmp_path: Any) -> None:
+    gray = np.full((20, 30), 128, np.uint8)
+    loaded = read(write(tmp_path, gray, "jpg"))
+    assert loaded is not None
+    assert loaded.shape == (20, 30)
+
+
+def test_find(tmp_path: Any) -> None:
+    base = str(tmp_path / "a")
+    assert find(base) is None
+    path = write(tmp_path, np.zeros((4, 4), np.uint8), "npy")
+    assert find(base) == path
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pytest
+from typing import Any
+from src.job import image_gabege_collect as gc
+from src.task_index import QuotaExceeded, TaskIndex
+
+
+def test_touch(tmp_path: Any) -> None:
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    index.touch("a", 100, 1, now=10)
+    index.touch("a", 50, 1, now=20)
+    assert index.get("a") == {
+        "task_id": "a",
+        "created_at": 10,
+        "touched_at": 20,
+        "bytes": 150,
+        "files": 2,
+    }
+    assert index.get("b") is None
+
+
+def test_expired(tmp_path: Any) -> None:
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    index.touch("a", 100, 1, now=10)
+    index.touch("b", 100, 1, now=30)
+    index.touch("c", 100, 1, now=20)
+    assert index.expired(25) == ["a", "c"]
+    assert index.expired(25, limit=1) == ["a"]
+
+    assert index.total_bytes() == 300
+    assert index.over_quota(0) == []
+    assert index.over_quota(300) == []
+    assert index.over_quota(150) == ["a", "c"]
+    # 消せなかったタスクの分は次に古いもので補う
+    assert index.over_quota(150, skip={"a"}) == ["c", "b"]
+
+    index.remove(["a", "c"])
+    assert index.expired(100) == ["b"]
+
+
+def test_reserve(tmp_path: Any) -> None:
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    index.reserve("a", 100, 1, 0, now=10)
+    index.reserve("a", 100, 1, 200, now=20)
+    with pytest.raises(QuotaExceeded):
+        index.reserve("a", 1, 1, 200, now=30)
+    # 上限を超えた分は加算しない
+    assert index.get("a") == {
+        "task_id": "a",
+        "created_at": 10,
+        "touched_at": 20,
+        "bytes": 200,
+        "files": 2,
+    }
+    with pytest.raises(QuotaExceeded):
+        index.reserve("b", 201, 1, 200)
+    assert index.get("b") is None
+
+
+def test_reserve_concurrent(tmp_path: Any) -> None:
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+
+    def reserve() -> bool:
+        try:
+            index.reserve("a", 100, 1, 1000)
+            return True
+        except QuotaExceeded:
+            return False
+
+    # 同時に確認しても、上限を超えて加算されない
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: reserve(), range(20)))
+    assert results.count(True) == 10
+    task = index.get("a")
+    assert task is not None and task["bytes"] == 1000
+
+
+def test_dedup_tables(tmp_path: Any) -> None:
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    index.touch("a", 100, 1)
+    index.set_image_hash("a", "x", "hash", 100, 1)
+    assert index.image_hash("a", "x", 100, 1) == "hash"
+    # サイズや更新時刻が変わっていたら無効
+    assert index.image_hash("a", "x", 100, 2) is None
+
+    index.set_result("a", "key", {"image": {"id": "y"}})
+    assert index.get_result("a", "key") == {"image": {"id": "y"}}
+    assert index.get_result("b", "key") is None
+
+    index.set_blob("hash", "a", "/a/x.jpg")
+    assert index.find_blob("hash") == "/a/x.jpg"
+
+    index.remove(["a"])
+    assert index.image_hash("a", "x", 100, 1) is None
+    assert index.get_result("a", "key") is None
+    assert index.find_blob("hash") is None
+
+
+def test_remove_untouched(tmp_path: Any) -> None:
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    index.touch("a", 100, 1, now=10)
+    index.set_result("a", "key", {"image": {"id": "y"}})
+    assert not index.touched_since("a", 20)
+    assert not index.touched_since("b", 20)
+
+    # 取り出した後に使われたタスクは消さない
+    index.touch("a", now=30)
+    assert index.touched_since("a", 20)
+    assert not index.remove_untouched("a", 20)
+    assert index.get("a") is not None
+    assert index.get_result("a", "key") is not None
+
+    assert index.remove_untouched("a", 40)
+    assert index.get("a") is None
+    assert index.get_result("a", "key") is None
+
+
+def test_rebuild_and_collect(tmp_path: Any, monkeypatch: Any) -> None:
+    task_dir = tmp_path / "task"
+    for task_id, mtime in (("old", 100), ("new", None)):
+        os.makedirs(task_dir / task_id)
+        path = task_dir / task_id / "a.jpg"
+        path.write_bytes(b"x" * 10)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    index = TaskIndex(str(tmp_path / "index.sqlite3"))
+    assert index.rebuild(str(task_dir)) == 2
+    old = index.get("old")
+    assert old and old["touched_at"] == 100
+    new = index.get("new")
+    assert new and new["bytes"] == 10
+
+    monkeypatch.setattr(gc, "TASK_PATH", str(task_dir))
+    gc.image_gabege_collect(index)
+    assert not os.path.exists(task_dir / "old")
+    assert os.path.exists(task_dir / "new")
+    assert index.get("old") is None
@@ -0,0 +1,65 @@
+import torch
+from src.utils import (
+    bbox_iou_nms, bbox_iou_nms_shapely, build_targets, non_max_suppression,
+    polygon_iou)
+
+
+def random_quads(n: int, spread: float = 50) -> torch.Tensor:
+    center = torch.rand(n, 1, 2) * 100
+    return (center + (torch.rand(n, 4, 2) - 0.5) * spread).reshape(n, 8)
+
+
+def test_polygon_iou() -> None:
+    square = torch.tensor([0, 0, 10, 0, 10, 10, 0, 10.])
+    # 頂点の順番に依らない
+    assert polygon_iou(square, square[[4, 5, 0, 1, 6, 7, 2, 3]]) == 1
+    # 半分だけ重なる
+    shifted = square + torch.tensor([5, 0.] * 4)
+    assert abs(polygon_iou(square, shifted).item() - 1 / 3) < 1e-6
+    # 重ならない / 面積がない
+    assert polygon_iou(square, square + 20) == 0
+    assert polygon_iou(square, torch.tensor([0, 0, 5, 0, 10, 0, 2, 0.])) == 0
+
+
+def test_bbox_iou_nms_matches_shapely() -> None:
+    torch.manual_seed(0)
+    box1 = random_quads(1)[0]
+    box2 = random_quads(200)
+    assert torch.allclose(
+        bbox_iou_nms(box1, box2), bbox_iou_nms_shapely(box1, box2),
+        atol=1e-5)
+
+
+def test_non_max_suppression_matches_shapely() -> None:
+    torch.manual_seed(0)
+    pred = torch.zeros(1, 300, 13)
+    pred[0, :, :8] = random_quads(300) * 4
+    pred[0, :, 8] = torch.rand(300)
+    pred[0, :, 9:] = torch.randn(300, 4) * 3
+
+    fast = non_max_suppression(pred, 0.1, 0.2)
+    exact = non_max_suppression(pred, 0.1, 0.2, use_shapely=True)
+    assert torch.equal(fast[0], exact[0])
+
+
+def test_build_targets() -> None:
+    nG = 13
+    anchors = torch.tensor([[1.0, 1.0], [3.0, 3.0], [6.0, 6.0]])
+    # class 2 の 3x3 セルの正方形 (中心 6.5, 6.5)
+    square = torch.tensor([[2, 5, 5, 8, 5, 8, 8, 5, 8.]])
+    square[:, 1:] /= nG
+    target = [square, torch.zeros(0, 9)]
+    pred_boxes = torch.zeros(2, 3, nG, nG, 8)
+    pred_conf = torch.zeros(2, 3, nG, nG)
+    pred_cls = torch.zeros(2, 3, nG, nG, 4)
+
+    *tbox, tconf, tcls, TP, FP, FN, TC = build_targets(
+        pred_boxes, pred_conf, pred_cls, target, anchors, 3, 4, nG, True)
+
+    assert tconf.sum() == 1
+    assert tconf[0, 1, 6, 6]
+    assert tcls[0, 1, 6, 6].tolist() == [0, 0, 1, 0]
+    assert [float(t[0, 1, 6, 6]) for t in tbox] == [
+        -1, -1, 2, -1, 2, 2, -1, 2]
+    assert TC.tolist() == [[2], [-1]]
+    assert FN.tolist() == [[1], [0]]